@@ -0,0 +1,70 @@
+"""
+A subliminal provider stand-in for the benchmarks, answering every query after a configurable latency.
+"""
+import time
+
+from babelfish import Language
+from subliminal.providers import Provider
+from subliminal.subtitle import Subtitle
+from subliminal.video import Episode, Movie
+
+PROVIDER_NAME = 'benchmark'
+# A minimal valid SRT file.
+SUBTITLES_CONTENT = b'1\r\n00:00:01,000 --> 00:00:02,000\r\nBenchmark subtitles.\r\n\r\n'
+
+
+class BenchmarkSubtitle(Subtitle):
+    """
+    Subtitles of the benchmark provider, matching any video perfectly.
+    """
+    provider_name = PROVIDER_NAME
+
+    def __init__(self, language, video_name):
+        super().__init__(language)
+        self.video_name = video_name
+
+    @property
+    def id(self):
+        return '{}:{}'.format(self.video_name, self.language)
+
+    def get_matches(self, video):
+        # A hash match is the best possible score.
+        return {'hash'}
+
+
+class BenchmarkProvider(Provider):
+    """
+    A subliminal provider that never touches the network.
+    """
+    languages = {Language('heb'), Language('eng')}
+    video_types = (Episode, Movie)
+
+    def __init__(self, latency=0):
+        """
+        :param latency: The latency of each query and download, in seconds.
+        """
+        self.latency = latency
+
+    def initialize(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def list_subtitles(self, video, languages):
+        time.sleep(self.latency)
+        return [BenchmarkSubtitle(language, video.name) for language in languages]
+
+    def download_subtitle(self, subtitle):
+        time.sleep(self.latency)
+        subtitle.content = SUBTITLES_CONTENT
+
+
+def register():
+    """
+    Register the provider with subliminal (in the current process).
+    """
+    from subliminal.extensions import provider_manager
+    entry_point = '{} = {}:BenchmarkProvider'.format(PROVIDER_NAME, __name__)
+    if entry_point not in provider_manager.registered_extensions:
+        provider_manager.register(entry_point)
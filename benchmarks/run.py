@@ -0,0 +1,264 @@
+"""
+Run py-expander end to end on synthetic torrents, against local stand-ins for 7z, encfs, rclone and the
+subtitle providers, and compare the per-stage timings to a stored baseline.
+No network access (or Google Drive account) is needed.
+
+    $ python -m benchmarks.run [--scenario NAME ...] [--repeat N] [--update-baseline]
+
+The exit code is 1 if any stage regressed, so it can be used in CI.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.scenarios import SCENARIOS
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOLS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools')
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# The stand-in executables, by name.
+STAND_INS = {
+    '7z': 'fake_7z.py',
+    'encfs': 'fake_encfs.py',
+    'fusermount': 'fake_fusermount.py',
+    'rclone': 'fake_rclone.py'
+}
+
+
+def _create_stand_ins(work_dir, use_real_rclone):
+    """
+    Create the stand-in executables and the rclone config (with a local remote).
+
+    :param work_dir: The benchmark work directory.
+    :param use_real_rclone: True to use the installed rclone (with a local remote) instead of its stand-in.
+    :return: A tuple of format (bin dir, rclone path, rclone config path).
+    """
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    for name, script_name in STAND_INS.items():
+        executable_path = os.path.join(bin_dir, name)
+        with open(executable_path, 'w') as executable_file:
+            executable_file.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(
+                sys.executable, os.path.join(TOOLS_PATH, script_name)))
+        os.chmod(executable_path, 0o755)
+    rclone_path = os.path.join(bin_dir, 'rclone')
+    if use_real_rclone:
+        rclone_path = shutil.which('rclone')
+        if not rclone_path:
+            raise Exception('rclone not found or is not in system PATH')
+    remote_dir = os.path.join(work_dir, 'remote')
+    os.makedirs(remote_dir)
+    rclone_config_path = os.path.join(work_dir, 'rclone.conf')
+    with open(rclone_config_path, 'w') as rclone_config:
+        rclone_config.write('[GDrive]\ntype = alias\nremote = {}\n'.format(remote_dir))
+        # The crypt remote stand-in keeps names and content as they are, like the encfs stand-in.
+        rclone_config.write('[GDriveCrypt]\ntype = alias\nremote = {}\n'.format(os.path.join(remote_dir, 'Encrypted')))
+    return bin_dir, rclone_path, rclone_config_path
+
+
+def _configure(work_dir, rclone_path, rclone_config_path, provider_latency, encryption_backend):
+    """
+    Point the py-expander config at the work directory and the stand-ins (inside the worker process).
+
+    :param work_dir: The benchmark work directory.
+    :param rclone_path: The rclone executable path.
+    :param rclone_config_path: The rclone config path.
+    :param provider_latency: The mock subtitle provider latency, in seconds.
+    :param encryption_backend: The encryption backend to use.
+    """
+    from pyexpander import config
+    from benchmarks.mock_provider import PROVIDER_NAME, register
+
+    state_dir = os.path.join(work_dir, 'state')
+    config.DATA_PATH = os.path.join(work_dir, 'data')
+    os.makedirs(config.DATA_PATH)
+    config.LOGFILE = os.path.join(work_dir, 'pyexp.log')
+    config.ORIGINAL_NAMES_LOG = os.path.join(work_dir, 'original_names.log')
+    config.JOURNAL_PATH = os.path.join(state_dir, 'journal.db')
+    config.HISTORY_PATH = os.path.join(state_dir, 'history.db')
+    config.REMOTE_CACHE_PATH = os.path.join(state_dir, 'remote.db')
+    config.DEFERRED_UPLOADS_PATH = os.path.join(state_dir, 'deferred.db')
+    config.SUBTITLES_CACHE_PATH = os.path.join(state_dir, 'subtitles.db')
+    config.SUBTITLES_BACKLOG_PATH = os.path.join(state_dir, 'backlog.db')
+    config.METRICS_TEXTFILE_PATH = os.path.join(work_dir, 'pyexpander.prom')
+    config.SCHEDULER_PATH = os.path.join(work_dir, 'slots')
+    config.MEMOIZATION_CACHE_PATH = None
+    config.SHOULD_USE_DAEMON = False
+    config.RCLONE_PATH = rclone_path
+    config.RCLONE_CONFIG_PATH = rclone_config_path
+    bin_dir = os.path.join(work_dir, 'bin')
+    config.ENCFS_PATH = os.path.join(bin_dir, 'encfs')
+    config.FUSERMOUNT_PATH = os.path.join(bin_dir, 'fusermount')
+    config.EXTRACTION_EXECUTABLE = '7z'
+    config.ENCRYPTION_BACKEND = encryption_backend
+    config.RCLONE_CRYPT_REMOTE = 'GDriveCrypt'
+    # Only the mock provider may be used (this must happen before the subtitles module is imported).
+    config.LANGUAGES_MAP = {'heb': [PROVIDER_NAME], 'eng': [PROVIDER_NAME]}
+    config.PROVIDER_CONFIGS = {PROVIDER_NAME: {'latency': provider_latency}}
+    register()
+    from subliminal.cache import region
+    if not region.is_configured:
+        region.configure('dogpile.cache.memory')
+
+
+def _run_worker(arguments):
+    """
+    Expand a single torrent and print its metrics summary as JSON (inside the worker process).
+
+    :param arguments: The parsed command line arguments.
+    """
+    import logbook
+    _configure(arguments.work_dir, arguments.rclone_path, arguments.rclone_config_path, arguments.provider_latency,
+               arguments.encryption_backend)
+    from pyexpander import metrics
+    from pyexpander.postprocess import backfill_subtitles
+    from pyexpander.torrent_handler import expand_torrent
+    log_level = logbook.DEBUG if arguments.verbose else logbook.WARNING
+    log_handlers = [logbook.NullHandler(), logbook.StderrHandler(level=log_level, bubble=True)]
+    # Application bound, so the pipeline threads log as well.
+    with logbook.NestedSetup(log_handlers).applicationbound():
+        expand_torrent(arguments.torrent_path)
+        # The daemon timer backfills the subtitles that weren't found while the torrent was expanded.
+        backfill_subtitles()
+    remote_dir = os.path.join(arguments.work_dir, 'remote')
+    uploaded_files = sum(len(file_names) for _, _, file_names in os.walk(remote_dir))
+    print(json.dumps({'stages': metrics.get_summary(), 'uploaded_files': uploaded_files}))
+
+
+def _run_scenario(scenario, arguments):
+    """
+    Run a single scenario once, in a fresh work directory and a fresh process.
+
+    :param scenario: The scenario name.
+    :param arguments: The parsed command line arguments.
+    :return: The worker results.
+    """
+    work_dir = tempfile.mkdtemp(prefix='pyexpander-benchmark-', dir=arguments.temp_dir)
+    try:
+        bin_dir, rclone_path, rclone_config_path = _create_stand_ins(work_dir, arguments.real_rclone)
+        torrent_path = SCENARIOS[scenario](os.path.join(work_dir, 'downloads'), arguments.scale)
+        environment = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                           PYTHONPATH=REPOSITORY_PATH + os.pathsep + os.environ.get('PYTHONPATH', ''))
+        process_info = [sys.executable, '-m', 'benchmarks.run', '--worker', '--work-dir', work_dir,
+                        '--torrent-path', torrent_path, '--rclone-path', rclone_path,
+                        '--rclone-config-path', rclone_config_path,
+                        '--provider-latency', str(arguments.provider_latency),
+                        '--encryption-backend', arguments.encryption_backend]
+        if arguments.verbose:
+            process_info.append('--verbose')
+        output = subprocess.check_output(process_info, env=environment, cwd=REPOSITORY_PATH)
+        return json.loads(output.decode('UTF-8').strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def _summarize(runs):
+    """
+    Merge repeated runs of a scenario, using the median of each stage counter.
+
+    :param runs: The worker results of all runs.
+    :return: A dict mapping each stage to its median seconds and MB/s.
+    """
+    stages = {}
+    for stage in sorted({stage for run in runs for stage in run['stages']}):
+        samples = [run['stages'][stage] for run in runs if stage in run['stages']]
+        stages[stage] = {'seconds': statistics.median(sample['seconds'] for sample in samples),
+                         'mb_per_second': statistics.median(sample['mb_per_second'] for sample in samples),
+                         'calls': statistics.median(sample['calls'] for sample in samples)}
+    return stages
+
+
+def _compare(results, baseline, tolerance, minimal_difference):
+    """
+    Print the results next to the baseline, and find regressions.
+
+    :param results: A dict mapping each scenario to its stages summary.
+    :param baseline: The baseline results (same format).
+    :param tolerance: The allowed relative slowdown (0.2 is 20%).
+    :param minimal_difference: Slowdowns shorter than this (in seconds) are considered noise.
+    :return: A list of tuples of format (scenario, stage) of the regressed stages.
+    """
+    regressions = []
+    print('{:<18} {:<18} {:>10} {:>10} {:>10} {:>8}'.format('scenario', 'stage', 'seconds', 'MB/s', 'baseline',
+                                                             'change'))
+    for scenario, stages in results.items():
+        for stage, counters in stages.items():
+            baseline_seconds = baseline.get(scenario, {}).get(stage, {}).get('seconds')
+            change = ''
+            if baseline_seconds:
+                change = '{:+.0%}'.format(counters['seconds'] / baseline_seconds - 1)
+                if counters['seconds'] > baseline_seconds * (1 + tolerance) and \
+                        counters['seconds'] - baseline_seconds > minimal_difference:
+                    regressions.append((scenario, stage))
+                    change += ' !'
+            print('{:<18} {:<18} {:>10.3f} {:>10.1f} {:>10} {:>8}'.format(
+                scenario, stage, counters['seconds'], counters['mb_per_second'],
+                '{:.3f}'.format(baseline_seconds) if baseline_seconds else '-', change))
+    return regressions
+
+
+def _parse_arguments():
+    """
+    Parse the command line arguments.
+
+    :return: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='A scenario to run (all scenarios by default)')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of runs of each scenario')
+    parser.add_argument('--scale', type=int, default=1, help='Multiply the synthetic torrent sizes')
+    parser.add_argument('--provider-latency', type=float, default=0.2,
+                        help='The mock subtitle provider latency, in seconds')
+    parser.add_argument('--encryption-backend', choices=['encfs', 'crypt'], default='encfs',
+                        help='The encryption backend to use')
+    parser.add_argument('--real-rclone', action='store_true',
+                        help='Use the installed rclone (with a local remote) instead of its stand-in')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='The baseline results path')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='The allowed relative slowdown')
+    parser.add_argument('--minimal-difference', type=float, default=0.05,
+                        help='Slowdowns shorter than this (in seconds) are ignored')
+    parser.add_argument('--temp-dir', help='The directory to create work directories in')
+    parser.add_argument('--verbose', action='store_true', help='Show the py-expander log')
+    # Internal arguments, used for running a single torrent in a fresh process.
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--torrent-path', help=argparse.SUPPRESS)
+    parser.add_argument('--rclone-path', help=argparse.SUPPRESS)
+    parser.add_argument('--rclone-config-path', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    arguments = _parse_arguments()
+    if arguments.worker:
+        _run_worker(arguments)
+        return
+    results = {}
+    for scenario in arguments.scenario or sorted(SCENARIOS):
+        runs = [_run_scenario(scenario, arguments) for _ in range(arguments.repeat)]
+        if not all(run['uploaded_files'] for run in runs):
+            sys.exit('Scenario {} uploaded nothing, the results are meaningless'.format(scenario))
+        results[scenario] = _summarize(runs)
+    baseline = {}
+    if os.path.isfile(arguments.baseline):
+        with open(arguments.baseline, encoding='UTF-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = _compare(results, baseline, arguments.tolerance, arguments.minimal_difference)
+    if arguments.update_baseline:
+        with open(arguments.baseline, 'w', encoding='UTF-8') as baseline_file:
+            json.dump(results, baseline_file, indent=4, sort_keys=True)
+        print('Baseline saved to {}'.format(arguments.baseline))
+    elif regressions:
+        sys.exit('Regressions: {}'.format(', '.join('{}/{}'.format(scenario, stage)
+                                                    for scenario, stage in regressions)))
+
+
+if __name__ == '__main__':
+    main()
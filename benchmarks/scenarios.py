@@ -0,0 +1,96 @@
+"""
+Synthetic torrents for the benchmarks.
+Each scenario creates its torrent under the given downloads directory and returns the torrent path.
+"""
+import io
+import os
+import zipfile
+
+MB = 1024 * 1024
+
+
+def _write_file(path, size):
+    """
+    Write a file of random content.
+
+    :param path: The file path.
+    :param size: The file size in bytes.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as output_file:
+        for offset in range(0, size, MB):
+            output_file.write(os.urandom(min(MB, size - offset)))
+
+
+def _build_zip(members):
+    """
+    Build a zip archive in memory. Archives are stored (not compressed), like most scene releases.
+
+    :param members: A list of tuples of format (member path, content).
+    :return: The archive content.
+    """
+    archive_buffer = io.BytesIO()
+    with zipfile.ZipFile(archive_buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for member_path, content in members:
+            archive.writestr(member_path, content)
+    return archive_buffer.getvalue()
+
+
+def single_file(downloads_dir, scale):
+    """
+    A single movie file.
+    """
+    torrent_path = os.path.join(downloads_dir, 'Inception.2010.1080p.BluRay.x264-GRP.mkv')
+    _write_file(torrent_path, 64 * MB * scale)
+    return torrent_path
+
+
+def season_pack(downloads_dir, scale):
+    """
+    A season directory with ten episodes, a sample and an NFO file.
+    """
+    torrent_path = os.path.join(downloads_dir, 'The.Wire.S01.720p.HDTV.x264-GRP')
+    for episode in range(1, 11):
+        _write_file(os.path.join(torrent_path, 'The.Wire.S01E{:02d}.720p.HDTV.x264-GRP.mkv'.format(episode)),
+                    16 * MB * scale)
+    _write_file(os.path.join(torrent_path, 'Sample', 'the.wire.s01e01.sample.mkv'), MB)
+    _write_file(os.path.join(torrent_path, 'The.Wire.S01.720p.HDTV.x264-GRP.nfo'), 4096)
+    return torrent_path
+
+
+def nested_archive(downloads_dir, scale):
+    """
+    A movie inside a rar archive, inside a zip archive.
+    The stand-in 7z reads every archive as a zip file, so the "rar" archive is a zip file as well.
+    """
+    torrent_path = os.path.join(downloads_dir, 'The.Matrix.1999.720p.BluRay.x264-GRP')
+    inner_archive = _build_zip([('The.Matrix.1999.720p.BluRay.x264-GRP.mkv', os.urandom(48 * MB * scale)),
+                                ('the.matrix.1999.nfo', os.urandom(4096))])
+    outer_archive = _build_zip([('the.matrix.1999.720p.rar', inner_archive)])
+    os.makedirs(torrent_path)
+    with open(os.path.join(torrent_path, 'the.matrix.1999.720p.zip'), 'wb') as archive_file:
+        archive_file.write(outer_archive)
+    return torrent_path
+
+
+def many_small_files(downloads_dir, scale):
+    """
+    Three episodes among thousands of small extras files.
+    """
+    torrent_path = os.path.join(downloads_dir, 'Planet.Earth.S01.1080p.BluRay.x264-GRP')
+    for episode in range(1, 4):
+        _write_file(os.path.join(torrent_path, 'Planet.Earth.S01E{:02d}.1080p.BluRay.x264-GRP.mkv'.format(episode)),
+                    8 * MB * scale)
+    for index in range(3000 * scale):
+        _write_file(os.path.join(torrent_path, 'Extras', 'Gallery {:02d}'.format(index // 500),
+                                 'image_{:05d}.jpg'.format(index)), 4096)
+    return torrent_path
+
+
+# All scenarios, by name.
+SCENARIOS = {
+    'single_file': single_file,
+    'season_pack': season_pack,
+    'nested_archive': nested_archive,
+    'many_small_files': many_small_files
+}
@@ -0,0 +1,89 @@
+"""
+A 7-Zip stand-in for the benchmarks.
+Every archive is a zip file (whatever its extension is), and only the commands py-expander uses are supported:
+    7z e -y -scsUTF-8 <archive> [@<list file>] [-x@<list file>]
+    7z e -so -scsUTF-8 <archive> <member>
+    7z l -slt -scsUTF-8 <archive>
+"""
+import os
+import shutil
+import sys
+import zipfile
+
+
+def _read_list_file(list_file_path):
+    """
+    Read a 7-Zip list file.
+
+    :param list_file_path: The list file path.
+    :return: The set of member paths.
+    """
+    with open(list_file_path, encoding='UTF-8') as list_file:
+        return {line.rstrip('\n') for line in list_file if line.strip()}
+
+
+def _extract(archive_path, arguments):
+    """
+    Extract the archive members to the current directory, without their paths (like 7z e).
+
+    :param archive_path: The archive path.
+    :param arguments: The other command line arguments.
+    """
+    included_members = None
+    excluded_members = set()
+    for argument in arguments:
+        if argument.startswith('-x@'):
+            excluded_members |= _read_list_file(argument[3:])
+        elif argument.startswith('@'):
+            included_members = (included_members or set()) | _read_list_file(argument[1:])
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.infolist():
+            if member.is_dir() or member.filename in excluded_members or \
+                    (included_members is not None and member.filename not in included_members):
+                continue
+            with archive.open(member) as source, open(os.path.basename(member.filename), 'wb') as destination:
+                shutil.copyfileobj(source, destination, 1024 * 1024)
+
+
+def _extract_to_stdout(archive_path, member_path):
+    """
+    Write a single archive member to stdout (like 7z e -so).
+
+    :param archive_path: The archive path.
+    :param member_path: The member path.
+    """
+    with zipfile.ZipFile(archive_path) as archive, archive.open(member_path) as source:
+        shutil.copyfileobj(source, sys.stdout.buffer, 1024 * 1024)
+
+
+def _list(archive_path):
+    """
+    List the archive members in the technical format (like 7z l -slt).
+
+    :param archive_path: The archive path.
+    """
+    lines = ['Listing archive: {}'.format(archive_path), '', '--', 'Path = {}'.format(archive_path),
+             'Type = zip', '', '----------']
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.infolist():
+            lines.extend(['Path = {}'.format(member.filename.rstrip('/')),
+                          'Folder = {}'.format('+' if member.is_dir() else '-'),
+                          'Size = {}'.format(member.file_size), ''])
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
+def main():
+    command, arguments = sys.argv[1], [argument for argument in sys.argv[2:] if argument not in ('-y', '-scsUTF-8')]
+    if command == 'l':
+        _list(arguments[-1])
+    elif command == 'e' and '-so' in arguments:
+        arguments.remove('-so')
+        _extract_to_stdout(arguments[0], arguments[1])
+    elif command == 'e':
+        _extract(arguments[0], arguments[1:])
+    else:
+        sys.exit('Unsupported command: {}'.format(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+"""
+An encfs stand-in for the benchmarks: "mounts" the plain directory by linking it to the encrypted one,
+so file names and content stay as they are.
+    encfs -S <encrypted dir> <plain dir>
+"""
+import os
+import sys
+
+
+def main():
+    encrypted_dir, plain_dir = sys.argv[-2:]
+    # The password is read from stdin, like the real encfs does.
+    sys.stdin.read()
+    if os.path.islink(plain_dir) or os.listdir(plain_dir):
+        sys.exit('Mount point {} is not empty'.format(plain_dir))
+    os.rmdir(plain_dir)
+    os.symlink(os.path.abspath(encrypted_dir), plain_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+"""
+A fusermount stand-in for the benchmarks, undoing the fake encfs "mount".
+    fusermount -u <plain dir>
+"""
+import os
+import sys
+
+
+def main():
+    plain_dir = sys.argv[-1]
+    if not os.path.islink(plain_dir):
+        sys.exit('{} is not mounted'.format(plain_dir))
+    os.remove(plain_dir)
+    os.mkdir(plain_dir)
+
+
+if __name__ == '__main__':
+    main()
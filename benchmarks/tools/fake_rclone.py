@@ -0,0 +1,184 @@
+"""
+An rclone stand-in for the benchmarks, for machines without rclone.
+Remotes must be alias remotes pointing at local directories (as written by the benchmark runner),
+and only the commands py-expander uses are supported:
+    rclone --config <path> copy [--update] [--ignore-times] [--files-from-raw <path>] [...] <source dir> <remote>:<path>
+    rclone --config <path> lsjson [--recursive] [--hash] [--files-from-raw <path>] [...] <remote>:<path>
+    rclone --config <path> delete [--files-from-raw <path>] <remote>:<path>
+    rclone --config <path> cryptcheck [--one-way] --combined - [--files-from-raw <path>] <source dir> <remote>:<path>
+Crypt remotes are plain alias remotes as well, so cryptcheck compares the files as they are.
+"""
+import configparser
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+# Options that take a value.
+VALUE_OPTIONS = {'--combined', '--config', '--files-from-raw', '--transfers'}
+
+
+def _parse_arguments(arguments):
+    """
+    Split the command line into options and positional arguments.
+
+    :param arguments: The command line arguments.
+    :return: A tuple of format (options, positional arguments).
+    """
+    options = {}
+    positional_arguments = []
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument in VALUE_OPTIONS:
+            options[argument] = next(arguments)
+        elif argument.startswith('--'):
+            options[argument] = True
+        else:
+            positional_arguments.append(argument)
+    return options, positional_arguments
+
+
+def _resolve_remote(config_path, remote_path):
+    """
+    Resolve a remote path to its local directory.
+
+    :param config_path: The rclone config path.
+    :param remote_path: The remote path (for example 'GDrive:Media').
+    :return: The local directory path.
+    """
+    remote_name, path = remote_path.split(':', 1)
+    rclone_config = configparser.ConfigParser()
+    rclone_config.read(config_path)
+    return os.path.join(rclone_config[remote_name]['remote'], path)
+
+
+def _log(level, message, object_path=None):
+    """
+    Write a JSON log line, like rclone does with --use-json-log.
+
+    :param level: The log level.
+    :param message: The log message.
+    :param object_path: The object the message is about, if any.
+    """
+    log_record = {'level': level, 'msg': message, 'source': 'fake_rclone', 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if object_path:
+        log_record['object'] = object_path
+    sys.stderr.write(json.dumps(log_record) + '\n')
+
+
+def _get_relative_paths(options, directory):
+    """
+    Get the files to work on: the --files-from-raw list, or all files under the given directory.
+
+    :param options: The command line options.
+    :param directory: The directory.
+    :return: A list of file paths, relative to the directory.
+    """
+    if '--files-from-raw' in options:
+        with open(options['--files-from-raw'], encoding='UTF-8') as list_file:
+            return [line.rstrip('\n') for line in list_file if line.strip()]
+    return [os.path.relpath(os.path.join(dir_path, file_name), directory)
+            for dir_path, _, file_names in os.walk(directory) for file_name in file_names]
+
+
+def _copy(options, source_dir, destination_dir):
+    """
+    Copy the source directory into the destination directory.
+
+    :param options: The command line options.
+    :param source_dir: The source directory.
+    :param destination_dir: The destination directory.
+    """
+    for relative_path in _get_relative_paths(options, source_dir):
+        source_path = os.path.join(source_dir, relative_path)
+        destination_path = os.path.join(destination_dir, relative_path)
+        if '--update' in options and '--ignore-times' not in options and os.path.isfile(destination_path):
+            source_stat = os.stat(source_path)
+            destination_stat = os.stat(destination_path)
+            if destination_stat.st_mtime > source_stat.st_mtime or \
+                    (destination_stat.st_size == source_stat.st_size and
+                     int(destination_stat.st_mtime) == int(source_stat.st_mtime)):
+                _log('info', 'Destination is newer than source, skipping', relative_path)
+                continue
+        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+        shutil.copy2(source_path, destination_path)
+        _log('info', 'Copied (new)', relative_path)
+
+
+def _list(options, directory):
+    """
+    List the given directory recursively, in rclone's JSON format (files only).
+
+    :param options: The command line options.
+    :param directory: The directory to list.
+    """
+    entries = []
+    for relative_path in _get_relative_paths(options, directory):
+        file_path = os.path.join(directory, relative_path)
+        if not os.path.isfile(file_path):
+            continue
+        file_stat = os.stat(file_path)
+        modification_time = datetime.datetime.fromtimestamp(file_stat.st_mtime, datetime.timezone.utc)
+        entry = {'Path': relative_path, 'Name': os.path.basename(relative_path), 'Size': file_stat.st_size,
+                 'ModTime': modification_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), 'IsDir': False}
+        if '--hash' in options:
+            with open(file_path, 'rb') as remote_file:
+                entry['Hashes'] = {'md5': hashlib.md5(remote_file.read()).hexdigest()}
+        entries.append(entry)
+    sys.stdout.write(json.dumps(entries) + '\n')
+
+
+def _delete(options, directory):
+    """
+    Delete the files under the given directory.
+
+    :param options: The command line options.
+    :param directory: The directory.
+    """
+    for relative_path in _get_relative_paths(options, directory):
+        os.remove(os.path.join(directory, relative_path))
+
+
+def _check(options, source_dir, destination_dir):
+    """
+    Compare the source files with the destination ones, writing a combined report to stdout.
+
+    :param options: The command line options.
+    :param source_dir: The source directory.
+    :param destination_dir: The destination directory.
+    """
+    has_differences = False
+    for relative_path in _get_relative_paths(options, source_dir):
+        destination_path = os.path.join(destination_dir, relative_path)
+        if not os.path.isfile(destination_path):
+            symbol = '-'
+        else:
+            with open(os.path.join(source_dir, relative_path), 'rb') as source_file, \
+                    open(destination_path, 'rb') as destination_file:
+                symbol = '=' if source_file.read() == destination_file.read() else '*'
+        has_differences |= symbol != '='
+        sys.stdout.write('{} {}\n'.format(symbol, relative_path))
+    if has_differences:
+        sys.exit(1)
+
+
+def main():
+    options, positional_arguments = _parse_arguments(sys.argv[1:])
+    command = positional_arguments[0]
+    if command == 'copy':
+        _copy(options, positional_arguments[1], _resolve_remote(options['--config'], positional_arguments[2]))
+    elif command == 'lsjson':
+        _list(options, _resolve_remote(options['--config'], positional_arguments[1]))
+    elif command == 'cryptcheck':
+        _check(options, positional_arguments[1], _resolve_remote(options['--config'], positional_arguments[2]))
+    elif command == 'delete':
+        _delete(options, _resolve_remote(options['--config'], positional_arguments[1]))
+    else:
+        sys.exit('Unsupported command: {}'.format(command))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import json
+import time
+
+import logbook
+
+from . import config
+from .utils import open_database
+
+logger = logbook.Logger('backlog')
+
+_is_initialized = False
+
+
+def _open_backlog():
+    """
+    Open the subtitles backlog database, creating its table if needed.
+
+    :return: The backlog connection context manager.
+    """
+    global _is_initialized
+    if not _is_initialized:
+        with open_database(config.SUBTITLES_BACKLOG_PATH) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS videos (cloud_path TEXT PRIMARY KEY, video_name TEXT, '
+                               'fingerprint TEXT, hashes TEXT, languages TEXT, added REAL, tries INTEGER, '
+                               'next_try REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS videos_next_try ON videos (next_try)')
+        _is_initialized = True
+    return open_database(config.SUBTITLES_BACKLOG_PATH)
+
+
+def is_enabled():
+    """
+    Check whether the subtitles backlog is enabled.
+
+    :return: True if the backlog is enabled, and False otherwise.
+    """
+    return bool(config.SUBTITLES_BACKLOG_PATH)
+
+
+def add_video(cloud_path, video_name, fingerprint, hashes, languages):
+    """
+    Add an uploaded video to the backlog, so its missing subtitles are searched for later (starting right away).
+
+    :param cloud_path: The cloud path of the video.
+    :param video_name: The original video file name (used for matching subtitles).
+    :param fingerprint: The video content fingerprint.
+    :param hashes: The video subtitle provider hashes.
+    :param languages: The missing subtitles languages.
+    """
+    if not is_enabled() or not languages:
+        return
+    logger.info('Adding {} to the subtitles backlog ({})'.format(
+        cloud_path, ', '.join(str(language) for language in languages)))
+    with _open_backlog() as connection:
+        connection.execute('INSERT OR REPLACE INTO videos (cloud_path, video_name, fingerprint, hashes, languages, '
+                           'added, tries, next_try) VALUES (?, ?, ?, ?, ?, ?, 0, 0)',
+                           (cloud_path, video_name, fingerprint, json.dumps(hashes),
+                            ','.join(sorted(str(language) for language in languages)), time.time()))
+
+
+def get_due_videos():
+    """
+    Get the backlog videos that should be searched again, oldest first.
+    Videos that waited longer than config.SUBTITLES_BACKFILL_MAX_AGE are given up on.
+
+    :return: A list of tuples of format (cloud_path, video_name, fingerprint, hashes, languages).
+    """
+    if not is_enabled():
+        return []
+    now = time.time()
+    with _open_backlog() as connection:
+        expired_videos = connection.execute('DELETE FROM videos WHERE added < ?',
+                                            (now - config.SUBTITLES_BACKFILL_MAX_AGE,)).rowcount
+        rows = connection.execute('SELECT cloud_path, video_name, fingerprint, hashes, languages FROM videos '
+                                  'WHERE next_try <= ? ORDER BY added', (now,)).fetchall()
+    if expired_videos:
+        logger.info('Gave up on subtitles for {} videos'.format(expired_videos))
+    if not rows:
+        return []
+    # Babelfish is only needed (and imported) when there is something to search.
+    import babelfish
+    return [(cloud_path, video_name, fingerprint, json.loads(hashes),
+             {babelfish.Language.fromietf(code) for code in languages.split(',')})
+            for cloud_path, video_name, fingerprint, hashes, languages in rows]
+
+
+def update_video(cloud_path, languages, is_searched=True):
+    """
+    Update the missing languages of a backlog video after a search, and schedule its next search
+    (exponential backoff, from config.SUBTITLES_BACKFILL_INTERVAL up to a day).
+    The video is removed from the backlog once it has all languages.
+
+    :param cloud_path: The cloud path of the video.
+    :param languages: The still missing subtitles languages.
+    :param is_searched: False if the search failed, so it isn't counted as a try (and the backoff doesn't grow).
+    """
+    if not is_enabled():
+        return
+    with _open_backlog() as connection:
+        if not languages:
+            connection.execute('DELETE FROM videos WHERE cloud_path = ?', (cloud_path,))
+            return
+        tries = (connection.execute('SELECT tries FROM videos WHERE cloud_path = ?',
+                                    (cloud_path,)).fetchone() or (0,))[0] + int(is_searched)
+        delay = min(config.SUBTITLES_BACKFILL_INTERVAL * 2 ** max(tries - 1, 0), 24 * 60 * 60)
+        connection.execute('UPDATE videos SET languages = ?, tries = ?, next_try = ? WHERE cloud_path = ?',
+                           (','.join(sorted(str(language) for language in languages)), tries, time.time() + delay,
+                            cloud_path))
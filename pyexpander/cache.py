@@ -0,0 +1,154 @@
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
+
+import logbook
+
+from . import config, metrics
+from .utils import open_database
+
+logger = logbook.Logger('cache')
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class MemoizationCache:
+    """
+    A bounded in-process LRU cache, optionally backed by an on-disk SQLite cache shared between processes.
+    Values must be JSON serializable.
+    """
+
+    def __init__(self, name, max_size, database_path=None, expiration=None):
+        """
+        :param name: The cache name (used as the on-disk namespace).
+        :param max_size: The maximal number of in-process entries.
+        :param database_path: The on-disk cache database path, or None for an in-process cache only.
+        :param expiration: The on-disk entries expiration time in seconds, or None for no expiration.
+        """
+        self.name = name
+        self.max_size = max_size
+        self.database_path = database_path
+        self.expiration = expiration
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.database_path:
+            with open_database(self.database_path) as connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS cache (name TEXT, key TEXT, value TEXT, '
+                                   'created REAL, PRIMARY KEY (name, key))')
+
+    def _load(self, key):
+        """
+        Load the given key from the on-disk cache.
+
+        :param key: The key to load.
+        :return: A tuple of format (found, value).
+        """
+        try:
+            with open_database(self.database_path) as connection:
+                row = connection.execute('SELECT value, created FROM cache WHERE name = ? AND key = ?',
+                                         (self.name, key)).fetchone()
+        except sqlite3.Error:
+            logger.exception('Failed to read {} cache from {}'.format(self.name, self.database_path))
+            return False, None
+        if row is None or (self.expiration and row[1] + self.expiration < time.time()):
+            return False, None
+        return True, json.loads(row[0])
+
+    def _store(self, key, value):
+        """
+        Store the given key in the on-disk cache.
+
+        :param key: The key to store.
+        :param value: The value to store.
+        """
+        try:
+            with open_database(self.database_path) as connection:
+                connection.execute('INSERT OR REPLACE INTO cache (name, key, value, created) VALUES (?, ?, ?, ?)',
+                                   (self.name, key, json.dumps(value), time.time()))
+        except sqlite3.Error:
+            logger.exception('Failed to write {} cache to {}'.format(self.name, self.database_path))
+
+    def _remember(self, key, value):
+        """
+        Keep the given key in memory, evicting the least recently used entry if needed.
+
+        :param key: The key to keep.
+        :param value: The value to keep.
+        """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """
+        Get the cached value of the given key, computing (and caching) it on a miss.
+
+        :param key: The key to look for.
+        :param compute: A function that computes the value when it is not cached.
+        :return: The value.
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                metrics.add(self.name, cache_hits=1)
+                return self._entries[key]
+        if self.database_path:
+            found, value = self._load(key)
+            if found:
+                with self._lock:
+                    self.disk_hits += 1
+                self._remember(key, value)
+                metrics.add(self.name, cache_hits=1)
+                return value
+        with self._lock:
+            self.misses += 1
+        metrics.add(self.name, cache_misses=1)
+        value = compute()
+        # Normalize the value, so hits and misses return the same thing.
+        value = json.loads(json.dumps(value))
+        self._remember(key, value)
+        if self.database_path:
+            self._store(key, value)
+        return value
+
+    def get_statistics(self):
+        """
+        Get the cache hit/miss counters.
+
+        :return: A dict of format {'hits': ..., 'disk_hits': ..., 'misses': ...}.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+
+def get_cache(name):
+    """
+    Get the memoization cache with the given name, creating it if needed.
+
+    :param name: The cache name.
+    :return: The memoization cache.
+    """
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = MemoizationCache(name, config.MEMOIZATION_CACHE_SIZE, config.MEMOIZATION_CACHE_PATH,
+                                             config.MEMOIZATION_CACHE_EXPIRATION)
+        return _caches[name]
+
+
+def get_statistics():
+    """
+    Get the hit/miss counters of all caches.
+
+    :return: A dict mapping each cache name to its counters.
+    """
+    with _caches_lock:
+        return {name: cache.get_statistics() for name, cache in _caches.items()}
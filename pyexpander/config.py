@@ -1,5 +1,3 @@
-import babelfish
-
 # Directories settings.
 DATA_PATH = '/data/directory'
 DEFAULT_PATH = '/'
@@ -17,35 +15,138 @@ CLOUD_VIDEOS_PATH = 'Videos'
 SHOULD_WIPE_CONTENT = True
 SHOULD_DELETE = False
 FINISHED_UPLOAD_PREFIX = 'ZZ '
+# Transfer settings.
+# Allow hardlinking instead of copying (only used when the original files are kept, so both share the same data).
+# Hardlinked files keep the original permissions, since EXTRACTION_FILES_MASK would apply to the original files too.
+TRANSFER_ALLOW_HARDLINKS = True
+TRANSFER_CHUNK_SIZE = 64 * 1024 * 1024
+# Compute the MD5 of uploaded files while copying them (user space copy), so they are never read again just for
+# checksums (reflinks and hardlinks still win, since they don't copy any data).
+# Only applies to verified plain uploads, the only ones whose MD5 is compared with the remote.
+TRANSFER_COMPUTE_CHECKSUMS = True
 
 # Log settings.
 LOGFILE = '/var/log/pyexp.log'
 ORIGINAL_NAMES_LOG = '/var/log/original_names.log'
+# A Prometheus node-exporter textfile with the per-stage metrics of the last torrent (None to disable).
+# A JSON summary line of each torrent is written to the log either way.
+METRICS_TEXTFILE_PATH = None
+# The job journal used for resuming interrupted runs (None to disable).
+JOURNAL_PATH = '/var/lib/pyexpander/journal.db'
+# The indexed upload history (None to disable). The original names log is imported when it is first created.
+HISTORY_PATH = '/var/lib/pyexpander/history.db'
+HISTORY_FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
+SHOULD_SKIP_DUPLICATE_UPLOADS = True
+
+# Daemon settings.
+# When enabled, pyexpand forwards torrents to a running daemon (started with 'pyexpand --daemon') if it can reach it.
+SHOULD_USE_DAEMON = False
+DAEMON_SOCKET_PATH = '/run/pyexpander/pyexpander.sock'
+DAEMON_SOCKET_MASK = '770'
+DAEMON_CLIENT_TIMEOUT = 10
+# The daemon runs its periodic tasks (draining deferred uploads, etc.) every this many seconds.
+DAEMON_TIMER_INTERVAL = 10 * 60
+
+# Admission control settings.
+# Host-wide slots shared by all pyexpander processes (None to disable), so torrents that finish together
+# wait in line (by priority, then FIFO) instead of competing for the disk and the Drive quota.
+SCHEDULER_PATH = '/run/pyexpander/slots'
+SCHEDULER_POLL_INTERVAL = 0.2
+EXTRACTION_SLOTS = 2
+UPLOAD_SLOTS = 1
+# A single slot also keeps the subliminal cache to one process at a time.
+SUBTITLES_SLOTS = 1
+# Torrents up to this size get ahead of bigger ones in the queues.
+SCHEDULER_SMALL_TORRENT_SIZE = 4 * 1024 * 1024 * 1024
 
 # Extraction settings.
 EXTRACTION_FILES_MASK = '770'
 EXTRACTION_TEMP_DIR_NAME = '_extracted'
 EXTRACTION_EXECUTABLE = '7z'
+# The maximal number of archives to extract at the same time.
+EXTRACTION_MAX_WORKERS = 4
+# Pipe nested archives (zip in rar, etc.) straight into a streaming extractor, so only their content hits the disk.
+SHOULD_STREAM_NESTED_ARCHIVES = False
+STREAMING_EXTRACTION_EXECUTABLE = 'bsdtar'
+# Only extract files that pass the white list and black list (and nested archives). Applies only when uploading.
+SHOULD_EXTRACT_SELECTIVELY = True
+
+# Pipeline settings.
+# Extraction, subtitles and upload run at the same time, connected by queues of this many units (extracted archives).
+PIPELINE_QUEUE_SIZE = 4
+# Units waiting for a stage are handled together, up to this many files.
+PIPELINE_BATCH_SIZE = 8
 
 # Subtitle settings.
 SHOULD_FIND_SUBTITLES = True
-# A map between each language and its favorite Subliminal providers (None for all providers).
+# A map between each language (ISO 639-3 code) and its favorite Subliminal providers (None for all providers).
 LANGUAGES_MAP = {
-    babelfish.Language('heb'): ['wizdom'],
-    babelfish.Language('eng'): []
+    'heb': ['wizdom'],
+    'eng': []
 }
+# Subliminal provider settings (credentials, etc.).
+PROVIDER_CONFIGS = {}
+# The number of concurrent provider queries per languages group.
+SUBTITLES_MAX_WORKERS = 4
+# A subtitles cache shared by all pyexpander processes (None for subliminal's own single-process cache).
+SUBTITLES_CACHE_PATH = '/var/lib/pyexpander/subtitles.db'
+SUBTITLES_CACHE_EXPIRATION = 30 * 24 * 60 * 60
+# Searches that found nothing are not repeated for this long (in seconds), subtitles may show up later.
+SUBTITLES_NEGATIVE_CACHE_TTL = 6 * 60 * 60
+# Videos are uploaded without waiting for missing subtitles, which are searched for later by the backfill
+# (None to search them before uploading).
+SUBTITLES_BACKLOG_PATH = '/var/lib/pyexpander/backlog.db'
+# The backfill searches each video again after this delay (in seconds), doubling it every time (up to a day).
+SUBTITLES_BACKFILL_INTERVAL = 60 * 60
+# The backfill gives up on videos after this long (in seconds).
+SUBTITLES_BACKFILL_MAX_AGE = 30 * 24 * 60 * 60
+# Backfilled subtitles are kept in this directory (under DATA_PATH) until they are uploaded.
+SUBTITLES_BACKFILL_DIR_NAME = '_backfill'
 
 # Upload settings.
 SHOULD_UPLOAD = True
 MAX_UPLOAD_TRIES = 3
+# Upload retries back off exponentially (with jitter) from this delay, up to the maximal delay (in seconds).
+UPLOAD_BACKOFF = 10
+# The initial retry delay after rate limit errors (in seconds).
+UPLOAD_RATE_LIMIT_BACKOFF = 60
+UPLOAD_MAX_BACKOFF = 15 * 60
+# Files that hit the upload quota are queued here and uploaded once the quota resets (None to just fail them).
+DEFERRED_UPLOADS_PATH = '/var/lib/pyexpander/deferred.db'
+# Deferred files are kept in this directory (under DATA_PATH) until they are uploaded.
+DEFERRED_FILES_DIR_NAME = '_deferred'
+# How long the upload quota takes to reset (in seconds).
+UPLOAD_QUOTA_WINDOW = 24 * 60 * 60
+# The number of files rclone uploads in parallel.
+UPLOAD_TRANSFERS = 4
+# Compare the uploaded files with their remote copies (with one remote call per batch): sizes, and checksums for
+# plain uploads (when the MD5 was computed while copying) and crypt uploads (rclone cryptcheck, which reads the files
+# again). Encfs uploads are only checked by size.
+SHOULD_VERIFY_UPLOADS = True
+# The number of times mismatched files are uploaded again.
+UPLOAD_VERIFY_TRIES = 2
 RCLONE_PATH = '/usr/bin/rclone'
 RCLONE_CONFIG_PATH = '/rclone/config/path.conf'
+# guessit results and cloud paths memoization (set a path to share the cache between runs, or None).
+MEMOIZATION_CACHE_SIZE = 4096
+MEMOIZATION_CACHE_PATH = None
+MEMOIZATION_CACHE_EXPIRATION = 30 * 24 * 60 * 60
+# A local cache of the remote tree listing, used for skipping files that are already uploaded (None to disable).
+REMOTE_CACHE_PATH = '/var/lib/pyexpander/remote.db'
+# The remote tree is listed again once its cached listing is older than this (in seconds).
+REMOTE_CACHE_TTL = 6 * 60 * 60
 DEFAULT_VIDEO_EXTENSION = '.mkv'
 DEFAULT_LANGUAGE_EXTENSION = '.en'
 SUBTITLES_EXTENSIONS = ['.srt']
 LANGUAGE_EXTENSIONS = ['.he', '.en']
-# encfs settings.
+# Encryption settings.
 SHOULD_ENCRYPT = True
+# 'encfs' mounts the staging tree with encfs, and uploads the encrypted tree to GDrive:{CLOUD_ENCRYPTED_PATH}.
+# 'crypt' uploads the plain staging tree through an rclone crypt remote, which encrypts in-stream (no mount at all).
+# The crypt remote should wrap GDrive:{CLOUD_ENCRYPTED_PATH} to keep the same layout, but the formats differ:
+# files uploaded with one backend can only be read with the same backend (and the same keys).
+ENCRYPTION_BACKEND = 'encfs'
+RCLONE_CRYPT_REMOTE = 'GDriveCrypt'
 ENCFS_PATH = '/usr/bin/encfs'
 FUSERMOUNT_PATH = '/usr/bin/fusermount'
 ENCFS_ENVIRONMENT_VARIABLE = 'ENCFS6_CONFIG'
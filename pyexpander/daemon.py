@@ -0,0 +1,132 @@
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+
+import logbook
+
+from . import config
+
+logger = logbook.Logger('daemon')
+
+ACCEPTED_REPLY = b'OK\n'
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+def _read_request(connection):
+    """
+    Read a single newline-terminated request from the given connection.
+
+    :param connection: The client connection.
+    :return: The decoded request (without the trailing newline).
+    """
+    data = b''
+    while not data.endswith(b'\n') and len(data) < MAX_REQUEST_SIZE:
+        chunk = connection.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode('UTF-8').rstrip('\n')
+
+
+def _process_jobs(jobs, process_torrent, run_periodic_tasks=None):
+    """
+    Process queued torrents one after another, forever.
+    Periodic tasks run between torrents, every config.DAEMON_TIMER_INTERVAL seconds.
+
+    :param jobs: The queue of torrent paths to process.
+    :param process_torrent: The function that processes a single torrent path.
+    :param run_periodic_tasks: The function that runs the periodic tasks, or None.
+    """
+    next_tasks_time = time.monotonic()
+    while True:
+        if run_periodic_tasks and time.monotonic() >= next_tasks_time:
+            try:
+                run_periodic_tasks()
+            except Exception:
+                logger.exception('Failed to run periodic tasks!')
+            next_tasks_time = time.monotonic() + config.DAEMON_TIMER_INTERVAL
+        try:
+            timeout = max(next_tasks_time - time.monotonic(), 0) if run_periodic_tasks else None
+            torrent_path = jobs.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        try:
+            process_torrent(torrent_path)
+        except Exception:
+            logger.exception('Failed to process torrent {}!'.format(torrent_path))
+        finally:
+            jobs.task_done()
+
+
+def serve(process_torrent, run_periodic_tasks=None):
+    """
+    Run the expander daemon.
+    Torrent paths are received over a Unix socket, queued, and processed by a single resident worker,
+    so imports, caches and log handlers stay warm between torrents.
+
+    :param process_torrent: The function that processes a single torrent path.
+    :param run_periodic_tasks: The function that runs the periodic tasks (in the worker), or None.
+    """
+    socket_path = config.DAEMON_SOCKET_PATH
+    # Remove leftovers from a previous run.
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    socket_dir = os.path.dirname(socket_path)
+    if socket_dir:
+        os.makedirs(socket_dir, exist_ok=True)
+    # Make sure the socket is removed when we are asked to stop.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    jobs = queue.Queue()
+    worker = threading.Thread(target=_process_jobs, args=(jobs, process_torrent, run_periodic_tasks),
+                              name='expander', daemon=True)
+    worker.start()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+        os.chmod(socket_path, int(config.DAEMON_SOCKET_MASK, 8))
+        server.listen()
+        logger.info('Daemon is listening on {}'.format(socket_path))
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                try:
+                    torrent_path = _read_request(connection)
+                    if not torrent_path:
+                        logger.error('Received an empty request. Ignoring...')
+                        continue
+                    logger.info('Queueing torrent {} ({} waiting)'.format(torrent_path, jobs.qsize()))
+                    jobs.put(torrent_path)
+                    connection.sendall(ACCEPTED_REPLY)
+                except (OSError, UnicodeDecodeError):
+                    logger.exception('Failed to handle daemon request!')
+    except (KeyboardInterrupt, SystemExit):
+        logger.info('Daemon stopped.')
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def send_torrent(torrent_path):
+    """
+    Forward the given torrent path to a running daemon.
+
+    :param torrent_path: The torrent path to expand.
+    :return: True if the daemon accepted the torrent, and False otherwise.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(config.DAEMON_CLIENT_TIMEOUT)
+            client.connect(config.DAEMON_SOCKET_PATH)
+            # The daemon runs in another working directory, so relative paths mean nothing to it.
+            client.sendall(os.path.abspath(torrent_path).encode('UTF-8') + b'\n')
+            return client.recv(len(ACCEPTED_REPLY)) == ACCEPTED_REPLY
+    except OSError as ex:
+        logger.warning('Failed to reach daemon at {}: {}'.format(config.DAEMON_SOCKET_PATH, ex))
+        return False
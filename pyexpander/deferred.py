@@ -0,0 +1,80 @@
+import time
+
+import logbook
+
+from . import config
+from .utils import open_database
+
+logger = logbook.Logger('deferred')
+
+_is_initialized = False
+
+
+def _open_queue():
+    """
+    Open the deferred uploads database, creating its table if needed.
+
+    :return: The deferred uploads connection context manager.
+    """
+    global _is_initialized
+    if not _is_initialized:
+        with open_database(config.DEFERRED_UPLOADS_PATH) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS uploads (file_path TEXT PRIMARY KEY, original_path TEXT, '
+                               'cloud_path TEXT, fingerprint TEXT, deferred REAL, not_before REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS uploads_not_before ON uploads (not_before)')
+        _is_initialized = True
+    return open_database(config.DEFERRED_UPLOADS_PATH)
+
+
+def is_enabled():
+    """
+    Check whether the deferred uploads queue is enabled.
+
+    :return: True if the queue is enabled, and False otherwise.
+    """
+    return bool(config.DEFERRED_UPLOADS_PATH)
+
+
+def add_upload(file_path, original_path, cloud_path, fingerprint, not_before):
+    """
+    Defer the upload of the given file (or postpone it, if it was already deferred).
+
+    :param file_path: The file path (in the deferred files directory).
+    :param original_path: The original file path.
+    :param cloud_path: The precomputed cloud path of the file.
+    :param fingerprint: The file content fingerprint, if known.
+    :param not_before: The time the upload may be tried again.
+    """
+    if not is_enabled():
+        return
+    logger.info('Deferring upload of {} to {} until {}'.format(original_path, cloud_path, time.ctime(not_before)))
+    with _open_queue() as connection:
+        connection.execute('INSERT INTO uploads (file_path, original_path, cloud_path, fingerprint, deferred, '
+                           'not_before) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (file_path) DO UPDATE SET '
+                           'not_before = excluded.not_before',
+                           (file_path, original_path, cloud_path, fingerprint, time.time(), not_before))
+
+
+def get_due_uploads():
+    """
+    Get the deferred uploads that may be tried again, oldest first.
+
+    :return: A list of tuples of format (file_path, original_path, cloud_path, fingerprint).
+    """
+    if not is_enabled():
+        return []
+    with _open_queue() as connection:
+        return connection.execute('SELECT file_path, original_path, cloud_path, fingerprint FROM uploads '
+                                  'WHERE not_before <= ? ORDER BY deferred', (time.time(),)).fetchall()
+
+
+def remove_upload(file_path):
+    """
+    Remove the given file from the queue (after it was uploaded, or if it is gone).
+
+    :param file_path: The file path (in the deferred files directory).
+    """
+    if not is_enabled():
+        return
+    with _open_queue() as connection:
+        connection.execute('DELETE FROM uploads WHERE file_path = ?', (file_path,))
@@ -1,114 +1,444 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 import re
 import shutil
 import subprocess
+import tempfile
 
 import logbook
 
-from . import config
-from .utils import find_executable
+from . import config, journal, metrics, scheduler
+from .utils import find_executable, is_wanted_file
 
 ARCHIVE_EXTENSIONS = ['.rar', '.zip', '.7z']
 
+# Archive volume name patterns.
+# Each pattern is a tuple of format: (regex, archive format, can open the set, volume order).
+VOLUME_PATTERNS = [
+    # New style RAR parts (.part01.rar, .part02.rar, ...).
+    (re.compile(r'^(?P<name>.+)\.part(?P<part>\d+)\.rar$', re.IGNORECASE), 'rar', True, lambda part: int(part)),
+    # Old style RAR parts (.rar, .r00, .r01, ..., .s00, ...).
+    (re.compile(r'^(?P<name>.+)\.rar$', re.IGNORECASE), 'rar', True, lambda part: 0),
+    (re.compile(r'^(?P<name>.+)\.(?P<part>[rs]\d{2})$', re.IGNORECASE), 'rar', False,
+     lambda part: 1 + int(part[1:]) + (100 if part[0].lower() == 's' else 0)),
+    # Split 7z and zip archives (.7z.001, .zip.001, ...).
+    (re.compile(r'^(?P<name>.+)\.7z\.(?P<part>\d{3})$', re.IGNORECASE), '7z', True, lambda part: int(part)),
+    (re.compile(r'^(?P<name>.+)\.7z$', re.IGNORECASE), '7z', True, lambda part: 0),
+    (re.compile(r'^(?P<name>.+)\.zip\.(?P<part>\d{3})$', re.IGNORECASE), 'zip', True, lambda part: int(part)),
+    # Zip spanned archives (.z01, .z02, ..., .zip), where the .zip file is the last volume.
+    (re.compile(r'^(?P<name>.+)\.z(?P<part>\d{2})$', re.IGNORECASE), 'zip', False, lambda part: int(part)),
+    (re.compile(r'^(?P<name>.+)\.zip$', re.IGNORECASE), 'zip', True, lambda part: 1000)
+]
+
+# Archive volume extensions, as POSIX regular expressions (for filtering in the streaming extractor).
+VOLUME_EXTENSION_REGEXES = [r'\.[rR][aA][rR]', r'\.[rRsS][0-9][0-9]', r'\.7[zZ]', r'\.7[zZ]\.[0-9][0-9][0-9]',
+                            r'\.[zZ][iI][pP]', r'\.[zZ][iI][pP]\.[0-9][0-9][0-9]', r'\.[zZ][0-9][0-9]']
+
+# Formats the streaming extractor can read from a pipe (no seeking).
+STREAMABLE_ARCHIVE_FORMATS = ['rar', 'zip']
+
+# Files that are always extracted, although they aren't uploaded, since other stages look for them
+# (a 'hebits' file marks the subtitles next to it as Hebrew).
+MARKER_NAMES = ['hebits']
+
+ArchiveSet = namedtuple('ArchiveSet', ['first_volume', 'volumes', 'size', 'format'])
+
 logger = logbook.Logger('extractor')
 
 
-def _extract_archive(archive_path, destination):
+def _run_extractor(archive_path, destination, included_members=None, excluded_members=None):
     """
     Extract archive content to destination.
 
-    :param  archive_path: The archive to extract.
-    :param  destination: The destination to extract to.
+    :param archive_path: The archive to extract.
+    :param destination: The destination to extract to.
+    :param included_members: The only archive member paths to extract, or None to extract everything.
+    :param excluded_members: The archive member paths to skip, or None to skip nothing.
     """
     # 'e': extract to current working dir.
     # '-y': assume yes to all (overwrite).
-    process_info = [find_executable(config.EXTRACTION_EXECUTABLE), 'e', '-y', archive_path]
+    process_info = [find_executable(config.EXTRACTION_EXECUTABLE), 'e', '-y', '-scsUTF-8', archive_path]
+    list_file_paths = []
+    try:
+        if included_members:
+            list_file_paths.append(_write_list_file(included_members))
+            process_info.append('@{}'.format(list_file_paths[-1]))
+        if excluded_members:
+            list_file_paths.append(_write_list_file(excluded_members))
+            process_info.append('-x@{}'.format(list_file_paths[-1]))
+        logger.debug('Running {}'.format(process_info))
+        # Change current working directory since 7Zip only works with e flag.
+        output = subprocess.check_output(process_info, cwd=destination)
+        logger.debug('Output: {}'.format(output))
+    finally:
+        for list_file_path in list_file_paths:
+            os.remove(list_file_path)
+
+
+def _write_list_file(members):
+    """
+    Write the given archive member paths to a temporary 7Zip list file.
+
+    :param members: The archive member paths.
+    :return: The list file path.
+    """
+    with tempfile.NamedTemporaryFile('w', encoding='UTF-8', suffix='.lst', delete=False) as list_file:
+        list_file.write('\n'.join(members) + '\n')
+    return list_file.name
+
+
+def _list_archive(archive_path):
+    """
+    List the members of the given archive without extracting it.
+
+    :param archive_path: The archive to list.
+    :return: The list of archive members, as tuples of format (member path, size).
+    """
+    # 'l': list archive content.
+    # '-slt': show technical information, one property per line.
+    process_info = [find_executable(config.EXTRACTION_EXECUTABLE), 'l', '-slt', '-scsUTF-8', archive_path]
     logger.debug('Running {}'.format(process_info))
-    # Change current working directory since 7Zip only works with e flag.
-    output = subprocess.check_output(process_info, cwd=destination)
-    logger.debug('Output: {}'.format(output))
+    output = subprocess.check_output(process_info).decode('UTF-8', errors='replace')
+    members = []
+    # Properties of the archive itself come before the separator line.
+    for block in output.split('----------', 1)[-1].strip().split('\n\n'):
+        properties = dict(line.split(' = ', 1) for line in block.splitlines() if ' = ' in line)
+        if 'Path' not in properties or properties.get('Folder') == '+' or \
+                properties.get('Attributes', '').startswith('D'):
+            continue
+        members.append((properties['Path'], int(properties.get('Size') or 0)))
+    return members
+
 
+def _find_streamable_archives(members):
+    """
+    Find nested archives that can be piped straight into the streaming extractor.
+    Only single-volume archives in streamable formats qualify, multi-volume ones must hit the disk.
+
+    :param members: The outer archive members, as returned by _list_archive.
+    :return: The list of streamable archive member paths.
+    """
+    volumes_by_set = {}
+    for member_path, _ in members:
+        volume_info = _match_volume(os.path.basename(member_path))
+        if volume_info:
+            set_key, archive_format, is_first_volume, _ = volume_info
+            volumes_by_set.setdefault((os.path.dirname(member_path), set_key), []).append(
+                (member_path, archive_format, is_first_volume))
+    return [volumes[0][0] for volumes in volumes_by_set.values()
+            if len(volumes) == 1 and volumes[0][2] and volumes[0][1] in STREAMABLE_ARCHIVE_FORMATS]
+
+
+def _to_regex(text):
+    """
+    Convert the given text to a case insensitive POSIX basic regular expression.
 
-def _delete_archive(archive_path):
+    :param text: The text to match.
+    :return: The regular expression.
+    """
+    return ''.join('[{}{}]'.format(character.lower(), character.upper()) if character.isalpha() else
+                   '\\' + character if character in '.[]*^$\\' else character for character in text)
+
+
+def _get_streaming_filter():
+    """
+    Get the streaming extractor arguments that skip the unwanted members, like _find_wanted_members does.
+    Name substitutions are used, since include patterns fail the extraction when any of them matches nothing:
+    the first matching rule applies, and members whose name becomes empty are skipped.
+
+    :return: The list of streaming extractor arguments.
+    """
+    # '~' is the matched name, so wanted members keep their names.
+    rules = [',.*{}[^/]*$,~,'.format(_to_regex(name)) for name in MARKER_NAMES]
+    rules += [',.*{}$,~,'.format(regex) for regex in VOLUME_EXTENSION_REGEXES]
+    rules += [',.*{}.*,,'.format(_to_regex(word)) for word in config.NAMES_BLACK_LIST]
+    rules += [',.*{}$,~,'.format(_to_regex(extension)) for extension in config.EXTENSIONS_WHITE_LIST]
+    rules.append(',.*,,')
+    return [argument for rule in rules for argument in ('-s', rule)]
+
+
+def _stream_nested_archive(archive_path, member_path, destination, is_selective=False):
+    """
+    Pipe a nested archive from its outer archive straight into the streaming extractor,
+    so the nested archive itself is never written to disk.
+
+    :param archive_path: The outer archive.
+    :param member_path: The nested archive path inside the outer archive.
+    :param destination: The destination to extract the nested archive content to.
+    :param is_selective: True to extract only wanted files (and nested archives), like the outer archive.
+    """
+    # '-so': write extracted data to stdout.
+    outer_process_info = [find_executable(config.EXTRACTION_EXECUTABLE), 'e', '-so', '-scsUTF-8', archive_path,
+                          member_path]
+    # '-f -': read the archive from stdin.
+    inner_process_info = [find_executable(config.STREAMING_EXTRACTION_EXECUTABLE), '-x', '-f', '-',
+                          '-C', destination] + (_get_streaming_filter() if is_selective else [])
+    logger.debug('Running {} | {}'.format(outer_process_info, inner_process_info))
+    outer_process = subprocess.Popen(outer_process_info, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    inner_process = subprocess.Popen(inner_process_info, stdin=outer_process.stdout)
+    # Allow the outer process to receive SIGPIPE if the inner one exits.
+    outer_process.stdout.close()
+    inner_return_code = inner_process.wait()
+    outer_return_code = outer_process.wait()
+    if outer_return_code != 0:
+        raise subprocess.CalledProcessError(outer_return_code, outer_process_info)
+    if inner_return_code != 0:
+        raise subprocess.CalledProcessError(inner_return_code, inner_process_info)
+
+
+def _is_marker_file(file_path):
+    """
+    Check whether the given file is a marker file (see MARKER_NAMES).
+
+    :param file_path: The file path to check.
+    :return: True if the file is a marker file, and False otherwise.
+    """
+    return any(marker_name in os.path.basename(file_path).lower() for marker_name in MARKER_NAMES)
+
+
+def _find_wanted_members(members):
+    """
+    Find the archive members that would survive the upload filters, plus nested archives and marker files.
+
+    :param members: The archive members, as returned by _list_archive.
+    :return: The list of wanted archive member paths.
+    """
+    return [member_path for member_path, _ in members
+            if is_wanted_file(member_path) or _match_volume(os.path.basename(member_path)) or
+            _is_marker_file(member_path)]
+
+
+def _extract_archive(archive_path, destination):
+    """
+    Extract archive content to destination.
+    When nested archive streaming is enabled, nested archives are piped straight into their own extraction
+    (under destination/{nested archive name}) instead of being written to disk first.
+    When selective extraction is enabled, only wanted files (and nested archives) are extracted.
+
+    :param  archive_path: The archive to extract.
+    :param  destination: The destination to extract to.
+    """
+    # Extracted files are only thrown away by the upload filters, so keep everything if we don't upload.
+    is_selective = config.SHOULD_EXTRACT_SELECTIVELY and config.SHOULD_UPLOAD
+    members = None
+    if config.SHOULD_STREAM_NESTED_ARCHIVES or is_selective:
+        members = _list_archive(archive_path)
+    nested_archives = []
+    if config.SHOULD_STREAM_NESTED_ARCHIVES:
+        nested_archives = _find_streamable_archives(members)
+    if is_selective:
+        wanted_members = [member_path for member_path in _find_wanted_members(members)
+                          if member_path not in nested_archives]
+        logger.debug('Extracting {} out of {} members of {}'.format(
+            len(wanted_members), len(members), archive_path))
+        if wanted_members:
+            _run_extractor(archive_path, destination, included_members=wanted_members)
+        else:
+            logger.info('No wanted files in {}'.format(archive_path))
+    else:
+        _run_extractor(archive_path, destination, excluded_members=nested_archives)
+    for member_path in nested_archives:
+        nested_destination = _get_archive_destination(os.path.basename(member_path), destination)
+        logger.info('Streaming nested archive {} from {} to {}'.format(member_path, archive_path, nested_destination))
+        _stream_nested_archive(archive_path, member_path, nested_destination, is_selective)
+
+
+def _delete_archive(archive_set, manifest):
     """
     Delete all archive-related files.
 
-    :param archive_path: The path of the archive file to delete.
-    """
-    files_to_delete = {archive_path}
-    # Find all related archives.
-    archive_name, archive_extension = os.path.splitext(archive_path)
-    archive_name = os.path.basename(archive_name)
-    archive_directory = os.path.dirname(archive_path)
-    for file_name in os.listdir(archive_directory):
-        file_path = os.path.join(archive_directory, file_name)
-        file_parts = os.path.splitext(file_name)
-        # Delete all RAR parts (.rar, .r01, .r02, ...).
-        if file_parts[0] == archive_name and file_parts[1].lower().startswith('.r'):
-            files_to_delete.add(file_path)
-        # Delete all parts (.part01.rar, .part02.rar, ...).
-        elif file_parts[1] == archive_extension and archive_name in file_parts[0] and 'part' in file_parts[0].lower():
-            files_to_delete.add(file_path)
-    # Delete everything.
-    for file_path in files_to_delete:
+    :param archive_set: The archive set to delete.
+    :param manifest: The torrent manifest to update.
+    """
+    for file_path in archive_set.volumes:
         logger.info('Deleting {}'.format(file_path))
         os.remove(file_path)
+        manifest.remove(file_path)
+
+
+def _match_volume(file_name):
+    """
+    Match the given file name against the known archive volume patterns.
+
+    :param file_name: The file name to match.
+    :return: A tuple of format (set key, archive format, can open the set, volume order), or None if it's not a volume.
+    """
+    for pattern, archive_format, is_first_volume, get_order in VOLUME_PATTERNS:
+        match = pattern.match(file_name)
+        if match:
+            part = match.groupdict().get('part')
+            return (match.group('name').lower(), archive_format), archive_format, is_first_volume, get_order(part)
+    return None
+
+
+def _get_archive_name(file_name):
+    """
+    Get the archive set name of the given volume file name (without any volume or archive extensions).
+
+    :param file_name: The volume file name.
+    :return: The archive set name.
+    """
+    for pattern, _, _, _ in VOLUME_PATTERNS:
+        match = pattern.match(file_name)
+        if match:
+            return match.group('name')
+    return os.path.splitext(file_name)[0]
+
+
+def is_archive_volume(file_name):
+    """
+    Check whether the given file name is an archive volume.
 
+    :param file_name: The file name to check.
+    :return: True if the file is an archive volume, and False otherwise.
+    """
+    return _match_volume(file_name) is not None
+
+
+def _index_directory_archives(file_entries):
+    """
+    Group the archive volumes of a single directory into archive sets.
+
+    :param file_entries: The directory archive volumes (as manifest entries).
+    :return: The list of archive sets in the directory.
+    """
+    volumes_by_set = {}
+    for entry in file_entries:
+        volume_info = _match_volume(os.path.basename(entry.path))
+        if volume_info:
+            set_key, archive_format, is_first_volume, order = volume_info
+            volumes_by_set.setdefault(set_key, []).append(
+                (order, is_first_volume, entry.path, entry.size, archive_format))
+    archive_sets = []
+    for volumes in volumes_by_set.values():
+        volumes.sort()
+        first_volumes = [volume for volume in volumes if volume[1]]
+        if not first_volumes:
+            logger.debug('Archive volumes {} have no first volume - not extracting'.format(
+                [volume[2] for volume in volumes]))
+            continue
+        archive_sets.append(ArchiveSet(first_volume=first_volumes[0][2], volumes=[volume[2] for volume in volumes],
+                                       size=sum(volume[3] for volume in volumes), format=first_volumes[0][4]))
+    return archive_sets
 
-def _find_target_archives(directory):
+
+def _find_target_archives(directory, manifest):
     """
-    Look for archives in source_dir + subdirectories.
+    Look for archives in source_dir + subdirectories, according to the torrent manifest.
+    Multi-volume archives are grouped into a single set.
 
     :param directory: The directory to look for archives in.
-    :return: The list of archives to extract.
-    """
-    archives_list = []
-    for dir_path, _, file_names in os.walk(directory):
-        for f in file_names:
-            candidate_extension = os.path.splitext(f)[1]
-            if candidate_extension in ARCHIVE_EXTENSIONS:
-                logger.debug('Found archive {} in {}'.format(os.path.join(dir_path, f), directory))
-                archives_list.append(os.path.join(dir_path, f))
-    # Filter out redundant part files.
-    filtered_archives_list = []
-    for archive_path in archives_list:
-        match = re.search('part(?P<part_num>\d+).rar', archive_path, re.IGNORECASE)
-        # If parts pattern is not present, or part number is 1, don't filter out the file.
-        if not match or int(match.group('part_num')) == 1:
-            filtered_archives_list.append(archive_path)
-        else:
-            logger.debug('{} is redundant - not extracting'.format(archive_path))
-    return filtered_archives_list
+    :param manifest: The torrent manifest.
+    :return: The list of archive sets to extract.
+    """
+    archive_sets = []
+    volumes_by_directory = {}
+    for entry in manifest.get_files(directory, kind='archive'):
+        volumes_by_directory.setdefault(os.path.dirname(entry.path), []).append(entry)
+    for file_entries in volumes_by_directory.values():
+        for archive_set in _index_directory_archives(file_entries):
+            logger.debug('Found archive {} ({} volumes) in {}'.format(
+                archive_set.first_volume, len(archive_set.volumes), directory))
+            archive_sets.append(archive_set)
+    return archive_sets
+
+
+def _get_archive_destination(archive_file_name, parent_dir):
+    """
+    Create a dedicated destination directory for the given archive, so parallel extractions can't collide.
+
+    :param archive_file_name: The file name of the archive (first volume) to extract.
+    :param parent_dir: The directory to create the destination under.
+    :return: The destination directory path.
+    """
+    archive_name = _get_archive_name(archive_file_name)
+    destination = os.path.join(parent_dir, archive_name)
+    suffix = 1
+    while os.path.exists(destination):
+        suffix += 1
+        destination = os.path.join(parent_dir, '{}_{}'.format(archive_name, suffix))
+    os.mkdir(destination)
+    return destination
+
+
+def _extract_and_delete_archive(archive_set, destination, manifest, on_extracted=None):
+    """
+    Extract the given archive set, and delete it once extraction succeeded.
+
+    :param archive_set: The archive set to extract.
+    :param destination: The destination to extract to.
+    :param manifest: The torrent manifest to update.
+    :param on_extracted: A function to call with the destination once extraction is done, or None.
+    """
+    logger.info('Extracting {} to {}'.format(archive_set.first_volume, destination))
+    journal.set_file_stage(archive_set.first_volume, journal.FILE_EXTRACTING, location=destination)
+    with scheduler.slot('extraction', config.EXTRACTION_SLOTS), metrics.measure('extract_archive', archive_set.size):
+        _extract_archive(archive_set.first_volume, destination)
+    manifest.add_tree(destination)
+    logger.info('Deleting original archives of {}...'.format(archive_set.first_volume))
+    _delete_archive(archive_set, manifest)
+    journal.set_file_stage(archive_set.first_volume, journal.FILE_EXTRACTED, location=destination)
+    if on_extracted:
+        on_extracted(destination)
+
+
+def discard_partial_extractions(directory, manifest):
+    """
+    Throw away partial output of extractions interrupted by a previous run, they will be extracted again.
+
+    :param directory: The directory the archives were extracted in.
+    :param manifest: The torrent manifest to update.
+    """
+    for archive_path, _, destination in journal.get_files(directory, journal.FILE_EXTRACTING):
+        if destination and os.path.isdir(destination):
+            logger.info('Deleting partial extraction of {} in {}'.format(archive_path, destination))
+            shutil.rmtree(destination)
+            manifest.remove_tree(destination)
+        journal.remove_file(archive_path)
 
 
-def extract_all(directory):
+@metrics.measure('extract_all')
+def extract_all(directory, manifest=None, on_extracted=None):
     """
     recursively extracts all archives in directory, and deletes original archive files.
     recursive extraction is iterative and is saved under:
-    /directory/{config.EXTRACTION_TEMP_DIR_NAME}/unpacked_{iteration number}
+    /directory/{config.EXTRACTION_TEMP_DIR_NAME}/unpacked_{iteration number}/{archive name}
+    archives of the same iteration are extracted in parallel (up to config.EXTRACTION_MAX_WORKERS at once).
 
     :param directory: The directory to extract archives from.
+    :param manifest: The torrent manifest to use and update, or None to build a new one.
+    :param on_extracted: A function to call with each archive destination as soon as it is extracted, or None.
     """
+    if manifest is None:
+        from .manifest import TorrentManifest
+        manifest = TorrentManifest.build(directory)
+    discard_partial_extractions(directory, manifest)
     current_dir = directory
-    archives_to_extract = _find_target_archives(current_dir)
+    archives_to_extract = _find_target_archives(current_dir, manifest)
 
     if len(archives_to_extract) > 0:
         iteration = 1
         extracted_root = os.path.join(directory, config.EXTRACTION_TEMP_DIR_NAME)
-        os.mkdir(extracted_root)
+        # Might already exist when resuming an interrupted run.
+        os.makedirs(extracted_root, exist_ok=True)
 
-        while len(archives_to_extract) > 0:
-            current_dir = os.path.join(extracted_root, 'unpacked_{}'.format(iteration))
-            os.mkdir(current_dir)
+        with ThreadPoolExecutor(max_workers=config.EXTRACTION_MAX_WORKERS) as executor:
+            while len(archives_to_extract) > 0:
+                current_dir = os.path.join(extracted_root, 'unpacked_{}'.format(iteration))
+                os.makedirs(current_dir, exist_ok=True)
 
-            for target_archive in archives_to_extract:
-                logger.info('Extracting {} to {}'.format(target_archive, current_dir))
-                _extract_archive(target_archive, current_dir)
-                logger.info('Deleting original archives...')
-                _delete_archive(target_archive)
+                futures = [executor.submit(_extract_and_delete_archive, archive_set,
+                                           _get_archive_destination(
+                                               os.path.basename(archive_set.first_volume), current_dir),
+                                           manifest, on_extracted)
+                           for archive_set in archives_to_extract]
+                # Wait for the whole iteration, since the next one looks for archives in its output.
+                for future in as_completed(futures):
+                    future.result()
 
-            iteration += 1
-            archives_to_extract = _find_target_archives(current_dir)
+                iteration += 1
+                archives_to_extract = _find_target_archives(current_dir, manifest)
 
     else:
         logger.info('Found no archives in {}!'.format(current_dir))
@@ -0,0 +1,174 @@
+from collections import OrderedDict
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+import logbook
+
+from . import config, metrics
+
+# Provider hashes are only computed for files bigger than this (like subliminal does).
+PROVIDER_HASHES_MIN_SIZE = 10 * 1024 * 1024
+# The block size of the OpenSubtitles and TheSubDB hashes (head and tail blocks).
+HEAD_TAIL_BLOCK_SIZE = 64 * 1024
+# The head size of the NapiProjekt hash.
+NAPIPROJEKT_HEAD_SIZE = 10 * 1024 * 1024
+# The block size of the Shooter hash.
+SHOOTER_BLOCK_SIZE = 4096
+# The maximal number of remembered files.
+MAX_RECORDS = 4096
+
+logger = logbook.Logger('fingerprint')
+
+# File key -> file record (a dict of 'content', 'md5' and 'hashes'), kept in memory for the process lifetime.
+_records = OrderedDict()
+_records_lock = threading.Lock()
+
+
+def _get_key(file_path):
+    """
+    Get the key of the given file, which survives renames (and hardlinks) but not content changes.
+
+    :param file_path: The file path.
+    :return: The file key.
+    """
+    file_stat = os.stat(file_path)
+    return file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+
+
+def _get_record(file_path):
+    """
+    Get the record of the given file, creating an empty one if needed.
+
+    :param file_path: The file path.
+    :return: The file record.
+    """
+    key = _get_key(file_path)
+    with _records_lock:
+        record = _records.pop(key, None) or {}
+        _records[key] = record
+        while len(_records) > MAX_RECORDS:
+            _records.popitem(last=False)
+    return record
+
+
+def _compute_provider_hashes(data, size):
+    """
+    Compute the subtitle provider hashes (the same algorithms subliminal uses) from the head and tail blocks.
+
+    :param data: The mapped file content.
+    :param size: The file size.
+    :return: A dict mapping each provider name to the file hash.
+    """
+    head = data[:HEAD_TAIL_BLOCK_SIZE]
+    tail = data[size - HEAD_TAIL_BLOCK_SIZE:]
+    opensubtitles_format = '<{}q'.format(HEAD_TAIL_BLOCK_SIZE // 8)
+    opensubtitles_hash = '{:016x}'.format((size + sum(struct.unpack(opensubtitles_format, head)) +
+                                           sum(struct.unpack(opensubtitles_format, tail))) & 0xFFFFFFFFFFFFFFFF)
+    shooter_offsets = (SHOOTER_BLOCK_SIZE, size // 3 * 2, size // 3, size - SHOOTER_BLOCK_SIZE * 2)
+    return {
+        'opensubtitles': opensubtitles_hash,
+        'opensubtitlesvip': opensubtitles_hash,
+        'thesubdb': hashlib.md5(head + tail).hexdigest(),
+        'napiprojekt': hashlib.md5(data[:NAPIPROJEKT_HEAD_SIZE]).hexdigest(),
+        'shooter': ';'.join(hashlib.md5(data[offset:offset + SHOOTER_BLOCK_SIZE]).hexdigest()
+                            for offset in shooter_offsets)
+    }
+
+
+@metrics.measure('fingerprint')
+def _compute(file_path, record):
+    """
+    Compute the provider hashes of the given file, reading only its head and tail pages.
+
+    :param file_path: The file path.
+    :param record: The file record to update.
+    """
+    size = os.path.getsize(file_path)
+    if size <= PROVIDER_HASHES_MIN_SIZE:
+        record['hashes'] = {}
+        return
+    logger.debug('Computing provider hashes of {}'.format(file_path))
+    with open(file_path, 'rb') as file_handle, \
+            mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        record['hashes'] = _compute_provider_hashes(data, size)
+
+
+@metrics.measure('fingerprint')
+def _compute_content_fingerprint(file_path):
+    """
+    Compute a fast content fingerprint of the given file: its size and a hash of a few sampled blocks.
+
+    :param file_path: The file path.
+    :return: The fingerprint string.
+    """
+    size = os.path.getsize(file_path)
+    sample_size = config.HISTORY_FINGERPRINT_SAMPLE_SIZE
+    content_hash = hashlib.sha1()
+    with open(file_path, 'rb') as file_handle:
+        # Sample the head, middle and tail of the file (or all of it, if it's small).
+        for offset in sorted({0, max(0, size // 2 - sample_size // 2), max(0, size - sample_size)}):
+            file_handle.seek(offset)
+            content_hash.update(file_handle.read(sample_size))
+    return '{}:{}'.format(size, content_hash.hexdigest())
+
+
+def get_content_fingerprint(file_path):
+    """
+    Get the content fingerprint of the given file (used by the upload history, the subtitles cache and backlog),
+    computing it only once per file.
+
+    :param file_path: The file path.
+    :return: The fingerprint string.
+    """
+    record = _get_record(file_path)
+    if 'content' not in record:
+        record['content'] = _compute_content_fingerprint(file_path)
+    return record['content']
+
+
+def add_md5(file_path, md5):
+    """
+    Remember the MD5 of the given file, which was computed while the file was written.
+
+    :param file_path: The file path.
+    :param md5: The MD5 hex digest.
+    """
+    _get_record(file_path)['md5'] = md5
+
+
+def link(source, destination):
+    """
+    Share the record of the source file with its copy (for copies that didn't read the data).
+
+    :param source: The source file path.
+    :param destination: The destination file path (with the same content).
+    """
+    record = _get_record(source)
+    with _records_lock:
+        _records[_get_key(destination)] = record
+
+
+def find_md5(file_path):
+    """
+    Find the MD5 of the given file, if it was already computed (usually while the file was copied).
+
+    :param file_path: The file path.
+    :return: The MD5 hex digest, or None if it is unknown.
+    """
+    return _get_record(file_path).get('md5')
+
+
+def get_provider_hashes(file_path):
+    """
+    Get the subtitle provider hashes of the given file (computed from its head and tail blocks).
+
+    :param file_path: The file path.
+    :return: A dict mapping each provider name to the file hash (empty for small files).
+    """
+    record = _get_record(file_path)
+    if 'hashes' not in record:
+        _compute(file_path, record)
+    return record['hashes']
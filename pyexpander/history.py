@@ -0,0 +1,112 @@
+import os
+import time
+
+import logbook
+
+from . import config
+from .utils import open_database
+
+logger = logbook.Logger('history')
+
+_is_initialized = False
+
+
+def _open_history():
+    """
+    Open the upload history database, creating it (and importing the original names log) if needed.
+
+    :return: The history connection context manager.
+    """
+    global _is_initialized
+    if not _is_initialized:
+        is_new = not os.path.exists(config.HISTORY_PATH)
+        with open_database(config.HISTORY_PATH) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS uploads (original_path TEXT, cloud_path TEXT, '
+                               'fingerprint TEXT, size INTEGER, uploaded REAL, remote_path TEXT, upload_path TEXT, '
+                               'upload_size INTEGER)')
+            # Histories from before the remote locations were recorded.
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(uploads)')}
+            for column, column_type in (('remote_path', 'TEXT'), ('upload_path', 'TEXT'), ('upload_size', 'INTEGER')):
+                if column not in columns:
+                    connection.execute('ALTER TABLE uploads ADD COLUMN {} {}'.format(column, column_type))
+            connection.execute('CREATE INDEX IF NOT EXISTS uploads_original_path ON uploads (original_path)')
+            connection.execute('CREATE INDEX IF NOT EXISTS uploads_cloud_path ON uploads (cloud_path)')
+            connection.execute('CREATE INDEX IF NOT EXISTS uploads_fingerprint ON uploads (fingerprint)')
+        _is_initialized = True
+        if is_new and os.path.isfile(config.ORIGINAL_NAMES_LOG):
+            import_original_names_log(config.ORIGINAL_NAMES_LOG)
+    return open_database(config.HISTORY_PATH)
+
+
+def is_enabled():
+    """
+    Check whether the upload history is enabled.
+
+    :return: True if the history is enabled, and False otherwise.
+    """
+    return bool(config.HISTORY_PATH)
+
+
+def find_upload(original_path=None, cloud_path=None, fingerprint=None):
+    """
+    Find a past upload by any of its keys.
+
+    :param original_path: The original file path.
+    :param cloud_path: The cloud path the file was uploaded to.
+    :param fingerprint: The file content fingerprint.
+    :return: A tuple of format (original_path, cloud_path, fingerprint, uploaded, remote_path, upload_path,
+             upload_size), or None if nothing was found. The remote location (see add_upload) may be None.
+    """
+    if not is_enabled():
+        return None
+    conditions = [(column, value) for column, value in
+                  (('original_path', original_path), ('cloud_path', cloud_path), ('fingerprint', fingerprint))
+                  if value is not None]
+    if not conditions:
+        return None
+    with _open_history() as connection:
+        return connection.execute(
+            'SELECT original_path, cloud_path, fingerprint, uploaded, remote_path, upload_path, upload_size '
+            'FROM uploads WHERE {} ORDER BY uploaded DESC LIMIT 1'.format(
+                ' AND '.join('{} = ?'.format(column) for column, _ in conditions)),
+            [value for _, value in conditions]).fetchone()
+
+
+def add_upload(original_path, cloud_path, fingerprint, size, remote_path=None, upload_path=None, upload_size=None):
+    """
+    Record a successful upload.
+
+    :param original_path: The original file path.
+    :param cloud_path: The cloud path the file was uploaded to.
+    :param fingerprint: The file content fingerprint.
+    :param size: The file size.
+    :param remote_path: The remote root path the file was uploaded to (for example 'GDrive:Encrypted'), or None.
+    :param upload_path: The uploaded file path, relative to the remote root (encrypted with encfs), or None.
+    :param upload_size: The uploaded file size (as the remote reports it), or None.
+    """
+    if not is_enabled():
+        return
+    with _open_history() as connection:
+        connection.execute('INSERT INTO uploads (original_path, cloud_path, fingerprint, size, uploaded, remote_path, '
+                           'upload_path, upload_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           (original_path, cloud_path, fingerprint, size, time.time(), remote_path, upload_path,
+                            upload_size))
+
+
+def import_original_names_log(log_path):
+    """
+    Import the original names log into the upload history.
+    Only original paths are known for these uploads, so they can't be used for content deduplication.
+
+    :param log_path: The original names log path.
+    :return: The number of imported entries.
+    """
+    with open(log_path, encoding='UTF-8') as log_file:
+        original_paths = list(dict.fromkeys(line.rstrip('\n') for line in log_file if line.strip()))
+    with _open_history() as connection:
+        known_paths = {row[0] for row in connection.execute('SELECT original_path FROM uploads')}
+        new_paths = [path for path in original_paths if path not in known_paths]
+        connection.executemany('INSERT INTO uploads (original_path, uploaded) VALUES (?, NULL)',
+                               [(path,) for path in new_paths])
+    logger.info('Imported {} entries from {}'.format(len(new_paths), log_path))
+    return len(new_paths)
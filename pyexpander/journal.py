@@ -0,0 +1,199 @@
+import os
+import time
+
+import logbook
+
+from . import config
+from .utils import open_database
+
+logger = logbook.Logger('journal')
+
+# Torrent stages.
+TORRENT_MOVED = 'moved'
+TORRENT_EXTRACTED = 'extracted'
+# File stages.
+FILE_EXTRACTING = 'extracting'
+FILE_EXTRACTED = 'extracted'
+FILE_SUBTITLES_FETCHED = 'subtitles fetched'
+FILE_STAGED = 'staged'
+FILE_UPLOADED = 'uploaded'
+FILE_LOGGED = 'logged'
+
+_is_initialized = False
+
+
+def _open_journal():
+    """
+    Open the journal database, creating its tables if needed.
+
+    :return: The journal connection context manager.
+    """
+    global _is_initialized
+    if not _is_initialized:
+        with open_database(config.JOURNAL_PATH) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS torrents (torrent_path TEXT PRIMARY KEY, new_path TEXT, '
+                               'stage TEXT, updated REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS files (file_path TEXT PRIMARY KEY, stage TEXT, '
+                               'staging_dir TEXT, location TEXT, updated REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS files_staging_dir ON files (staging_dir)')
+            connection.execute('CREATE TABLE IF NOT EXISTS staging_dirs (staging_dir TEXT PRIMARY KEY, '
+                               'created REAL)')
+        _is_initialized = True
+    return open_database(config.JOURNAL_PATH)
+
+
+def is_enabled():
+    """
+    Check whether the job journal is enabled.
+
+    :return: True if the journal is enabled, and False otherwise.
+    """
+    return bool(config.JOURNAL_PATH)
+
+
+def get_torrent(torrent_path):
+    """
+    Get the last completed stage of the given torrent.
+
+    :param torrent_path: The original torrent path.
+    :return: A tuple of format (stage, new_path), or (None, None) if the torrent is unknown.
+    """
+    if not is_enabled():
+        return None, None
+    with _open_journal() as connection:
+        row = connection.execute('SELECT stage, new_path FROM torrents WHERE torrent_path = ?',
+                                 (torrent_path,)).fetchone()
+    return row if row else (None, None)
+
+
+def set_torrent_stage(torrent_path, stage, new_path=None):
+    """
+    Record the last completed stage of the given torrent.
+
+    :param torrent_path: The original torrent path.
+    :param stage: The completed stage.
+    :param new_path: The torrent path in the data directory (kept if None).
+    """
+    if not is_enabled():
+        return
+    logger.debug('Torrent {} is {}'.format(torrent_path, stage))
+    with _open_journal() as connection:
+        connection.execute('INSERT INTO torrents (torrent_path, new_path, stage, updated) VALUES (?, ?, ?, ?) '
+                           'ON CONFLICT (torrent_path) DO UPDATE SET stage = excluded.stage, '
+                           'new_path = COALESCE(excluded.new_path, new_path), updated = excluded.updated',
+                           (torrent_path, new_path, stage, time.time()))
+
+
+def remove_torrent(torrent_path):
+    """
+    Forget the given torrent (once it is done, so the journal only keeps unfinished torrents).
+
+    :param torrent_path: The original torrent path.
+    """
+    if not is_enabled():
+        return
+    logger.debug('Torrent {} is done'.format(torrent_path))
+    with _open_journal() as connection:
+        connection.execute('DELETE FROM torrents WHERE torrent_path = ?', (torrent_path,))
+
+
+def set_file_stage(file_path, stage, staging_dir=None, location=None):
+    """
+    Record the last completed stage of the given file.
+
+    :param file_path: The file path (in the data directory).
+    :param stage: The completed stage.
+    :param staging_dir: The staging directory holding the file, if any.
+    :param location: The current file location (staged path, extraction destination), if any.
+    """
+    if not is_enabled():
+        return
+    with _open_journal() as connection:
+        connection.execute('INSERT OR REPLACE INTO files (file_path, stage, staging_dir, location, updated) '
+                           'VALUES (?, ?, ?, ?, ?)', (file_path, stage, staging_dir, location, time.time()))
+
+
+def remove_file(file_path):
+    """
+    Forget the given file.
+
+    :param file_path: The file path (in the data directory).
+    """
+    if not is_enabled():
+        return
+    with _open_journal() as connection:
+        connection.execute('DELETE FROM files WHERE file_path = ?', (file_path,))
+
+
+def get_files(directory, stage):
+    """
+    Get the files under the given directory that completed the given stage (and nothing after it).
+
+    :param directory: The directory the files were under.
+    :param stage: The completed stage.
+    :return: A list of tuples of format (file_path, staging_dir, location).
+    """
+    if not is_enabled():
+        return []
+    prefix = os.path.join(directory, '')
+    with _open_journal() as connection:
+        rows = connection.execute('SELECT file_path, staging_dir, location FROM files WHERE stage = ? AND '
+                                  'substr(file_path, 1, length(?)) = ?', (stage, prefix, prefix)).fetchall()
+    return rows
+
+
+def remove_files(directory):
+    """
+    Forget all files under the given directory.
+
+    :param directory: The directory the files were under.
+    """
+    if not is_enabled():
+        return
+    prefix = os.path.join(directory, '')
+    with _open_journal() as connection:
+        connection.execute('DELETE FROM files WHERE substr(file_path, 1, length(?)) = ?', (prefix, prefix))
+
+
+def add_staging_dir(staging_dir):
+    """
+    Record a newly created staging directory.
+
+    :param staging_dir: The staging directory path.
+    """
+    if not is_enabled():
+        return
+    with _open_journal() as connection:
+        connection.execute('INSERT OR REPLACE INTO staging_dirs (staging_dir, created) VALUES (?, ?)',
+                           (staging_dir, time.time()))
+
+
+def remove_staging_dir(staging_dir):
+    """
+    Forget a staging directory (after it was deleted).
+
+    :param staging_dir: The staging directory path.
+    """
+    if not is_enabled():
+        return
+    with _open_journal() as connection:
+        connection.execute('DELETE FROM staging_dirs WHERE staging_dir = ?', (staging_dir,))
+
+
+def get_staging_dirs(path):
+    """
+    Get the recorded staging directories holding files of the given torrent path.
+
+    :param path: The torrent path (in the data directory), either a file or a directory.
+    :return: A list of tuples of format (staging_dir, [(file_path, stage, location), ...]).
+    """
+    if not is_enabled():
+        return []
+    prefix = os.path.join(path, '')
+    with _open_journal() as connection:
+        staging_dirs = [row[0] for row in connection.execute(
+            'SELECT DISTINCT staging_dir FROM files WHERE (file_path = ? OR substr(file_path, 1, length(?)) = ?) AND '
+            'staging_dir IN (SELECT staging_dir FROM staging_dirs)', (path, prefix, prefix))]
+        return [(staging_dir, connection.execute('SELECT file_path, stage, location FROM files '
+                                                 'WHERE staging_dir = ?', (staging_dir,)).fetchall())
+                for staging_dir in staging_dirs]
@@ -0,0 +1,194 @@
+from collections import namedtuple
+import os
+import threading
+
+import logbook
+
+from . import config
+from .extract import is_archive_volume
+
+logger = logbook.Logger('manifest')
+
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'size', 'extension', 'kind'])
+
+
+def _classify(file_name, extension):
+    """
+    Classify the given file.
+
+    :param file_name: The file name.
+    :param extension: The lowercase file extension.
+    :return: One of 'archive', 'subtitles', 'video' or 'other'.
+    """
+    if extension in config.SUBTITLES_EXTENSIONS:
+        return 'subtitles'
+    if extension in config.EXTENSIONS_WHITE_LIST:
+        return 'video'
+    if is_archive_volume(file_name):
+        return 'archive'
+    return 'other'
+
+
+class TorrentManifest:
+    """
+    An in-memory index of all files and directories of a torrent, built with a single scan.
+    Pipeline stages update it as they add (extraction) or remove (upload) files, instead of walking the tree again.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: The torrent root path (a file or a directory).
+        """
+        self.root = root
+        self.is_file = False
+        self._entries = {}
+        # Directory path -> the set of file paths directly under it.
+        self._directories = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, root):
+        """
+        Build the manifest of the given torrent path.
+
+        :param root: The torrent root path (a file or a directory).
+        :return: The manifest.
+        """
+        manifest = cls(root)
+        if os.path.isfile(root):
+            manifest.is_file = True
+            manifest.add(root)
+        else:
+            manifest.add_tree(root)
+        logger.debug('Built manifest of {}: {} files in {} directories'.format(
+            root, len(manifest._entries), len(manifest._directories)))
+        return manifest
+
+    def _add_entry(self, path, size):
+        """
+        Add a single file entry (without locking).
+
+        :param path: The file path.
+        :param size: The file size.
+        """
+        file_name = os.path.basename(path)
+        extension = os.path.splitext(file_name)[1].lower()
+        self._entries[path] = ManifestEntry(path, size, extension, _classify(file_name, extension))
+        self._directories.setdefault(os.path.dirname(path), set()).add(path)
+
+    def add(self, path):
+        """
+        Add a single file to the manifest.
+
+        :param path: The file path.
+        """
+        size = os.path.getsize(path)
+        with self._lock:
+            self._add_entry(path, size)
+
+    def add_tree(self, directory):
+        """
+        Add a directory and everything under it to the manifest, scanning each directory once.
+
+        :param directory: The directory path.
+        """
+        directories = [directory]
+        found_directories = []
+        found_files = []
+        while directories:
+            dir_path = directories.pop()
+            found_directories.append(dir_path)
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file():
+                        found_files.append((entry.path, entry.stat().st_size))
+        with self._lock:
+            for dir_path in found_directories:
+                self._directories.setdefault(dir_path, set())
+            for path, size in found_files:
+                self._add_entry(path, size)
+
+    def remove(self, path):
+        """
+        Remove a file from the manifest (if present).
+
+        :param path: The file path.
+        """
+        with self._lock:
+            if self._entries.pop(path, None):
+                self._directories[os.path.dirname(path)].discard(path)
+
+    def remove_tree(self, directory):
+        """
+        Remove a directory and everything under it from the manifest.
+
+        :param directory: The directory path.
+        """
+        prefix = os.path.join(directory, '')
+        with self._lock:
+            for path in [path for path in self._entries if path.startswith(prefix)]:
+                del self._entries[path]
+            for dir_path in [dir_path for dir_path in self._directories
+                             if dir_path == directory or dir_path.startswith(prefix)]:
+                del self._directories[dir_path]
+
+    def get_files(self, directory=None, kind=None):
+        """
+        Get the manifest file entries.
+
+        :param directory: Only return files under this directory, or None for all files.
+        :param kind: Only return files of this kind, or None for all kinds.
+        :return: A list of manifest entries, sorted by path.
+        """
+        prefix = os.path.join(directory, '') if directory else None
+        with self._lock:
+            entries = list(self._entries.values())
+        return sorted((entry for entry in entries
+                       if (prefix is None or entry.path.startswith(prefix)) and (kind is None or entry.kind == kind)),
+                      key=lambda entry: entry.path)
+
+    def get_directories(self):
+        """
+        Get all the manifest directories.
+
+        :return: A sorted list of directory paths.
+        """
+        with self._lock:
+            return sorted(self._directories)
+
+    def list_directory(self, directory):
+        """
+        List the file names directly under the given directory.
+
+        :param directory: The directory path.
+        :return: The list of file names, or None if the directory is not in the manifest.
+        """
+        with self._lock:
+            if directory not in self._directories:
+                return None
+            return [os.path.basename(path) for path in self._directories[directory]]
+
+    def apply_permissions(self, mode, should_skip_linked_files=False):
+        """
+        Apply the given permissions to all files and directories, in-process.
+
+        :param mode: The permissions mode (for example 0o770).
+        :param should_skip_linked_files: True to leave files with more than one link alone, since they are hardlinks
+            of the original (seeding) files, whose permissions would change as well.
+        """
+        with self._lock:
+            # A single file torrent has no directories of its own.
+            directories = [] if self.is_file else list(self._directories)
+            files = list(self._entries)
+        for path in directories:
+            os.chmod(path, mode)
+        skipped_files = 0
+        for path in files:
+            if should_skip_linked_files and os.stat(path).st_nlink > 1:
+                skipped_files += 1
+                continue
+            os.chmod(path, mode)
+        if skipped_files:
+            logger.debug('Kept the permissions of {} hardlinked files under {}'.format(skipped_files, self.root))
@@ -0,0 +1,133 @@
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+import logbook
+
+from . import config
+
+# The counters kept for each stage.
+COUNTERS = ['calls', 'seconds', 'bytes', 'retries', 'cache_hits', 'cache_misses']
+
+logger = logbook.Logger('metrics')
+
+_stages = {}
+_lock = threading.Lock()
+
+
+def reset():
+    """
+    Forget all the collected metrics (called when a new torrent starts).
+    """
+    with _lock:
+        _stages.clear()
+
+
+def add(stage, **counters):
+    """
+    Add to the counters of the given stage.
+
+    :param stage: The stage name.
+    :param counters: The counters to add to (see COUNTERS).
+    """
+    with _lock:
+        _stages.setdefault(stage, Counter()).update(counters)
+
+
+@contextmanager
+def measure(stage, size=0):
+    """
+    Measure the wall time of a stage. Can be used as a decorator as well.
+    The yielded dict may be updated with the number of bytes processed, if it is only known later.
+
+    :param stage: The stage name.
+    :param size: The number of bytes processed.
+    """
+    sample = {'bytes': size}
+    start_time = time.monotonic()
+    try:
+        yield sample
+    finally:
+        add(stage, calls=1, seconds=time.monotonic() - start_time, bytes=sample['bytes'])
+
+
+def get_summary():
+    """
+    Get the collected metrics of all stages.
+
+    :return: A dict mapping each stage to its counters (and its throughput in MB/s).
+    """
+    with _lock:
+        stages = {stage: dict(counters) for stage, counters in _stages.items()}
+    for counters in stages.values():
+        for counter in COUNTERS:
+            counters.setdefault(counter, 0)
+        counters['mb_per_second'] = counters['bytes'] / 1024 / 1024 / counters['seconds'] \
+            if counters['seconds'] > 0 else 0
+    return stages
+
+
+def _escape_label(value):
+    """
+    Escape the given value for a Prometheus label.
+
+    :param value: The label value.
+    :return: The escaped value.
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_textfile(stages, is_done, finished):
+    """
+    Write the given metrics as a Prometheus node-exporter textfile (replacing it atomically).
+
+    :param stages: The stages summary.
+    :param is_done: True if the torrent was processed successfully, and False otherwise.
+    :param finished: The time the torrent was finished.
+    """
+    lines = []
+    for counter, metric_name, description in (
+            ('calls', 'pyexpander_stage_calls', 'Number of times each stage ran for the last torrent.'),
+            ('seconds', 'pyexpander_stage_seconds', 'Wall time of each stage for the last torrent.'),
+            ('bytes', 'pyexpander_stage_bytes', 'Bytes processed by each stage for the last torrent.'),
+            ('mb_per_second', 'pyexpander_stage_mb_per_second', 'Throughput of each stage for the last torrent.'),
+            ('retries', 'pyexpander_stage_retries', 'Retries of each stage for the last torrent.'),
+            ('cache_hits', 'pyexpander_stage_cache_hits', 'Cache hits of each stage for the last torrent.'),
+            ('cache_misses', 'pyexpander_stage_cache_misses', 'Cache misses of each stage for the last torrent.')):
+        lines.append('# HELP {} {}'.format(metric_name, description))
+        lines.append('# TYPE {} gauge'.format(metric_name))
+        for stage, counters in sorted(stages.items()):
+            lines.append('{}{{stage="{}"}} {}'.format(metric_name, _escape_label(stage), counters[counter]))
+    lines.append('# HELP pyexpander_last_torrent_success Whether the last torrent was processed successfully.')
+    lines.append('# TYPE pyexpander_last_torrent_success gauge')
+    lines.append('pyexpander_last_torrent_success {}'.format(int(is_done)))
+    lines.append('# HELP pyexpander_last_torrent_timestamp_seconds The time the last torrent was finished.')
+    lines.append('# TYPE pyexpander_last_torrent_timestamp_seconds gauge')
+    lines.append('pyexpander_last_torrent_timestamp_seconds {}'.format(finished))
+    # node-exporter may read the file at any moment, so never let it see a partial file.
+    temp_path = '{}.{}.tmp'.format(config.METRICS_TEXTFILE_PATH, os.getpid())
+    with open(temp_path, 'w', encoding='UTF-8') as textfile:
+        textfile.write('\n'.join(lines) + '\n')
+    os.replace(temp_path, config.METRICS_TEXTFILE_PATH)
+
+
+def report(torrent_path, is_done):
+    """
+    Report the metrics collected for the given torrent: a JSON summary line in the log,
+    and a Prometheus textfile (if config.METRICS_TEXTFILE_PATH is set).
+
+    :param torrent_path: The torrent path.
+    :param is_done: True if the torrent was processed successfully, and False otherwise.
+    """
+    stages = get_summary()
+    finished = time.time()
+    logger.info(json.dumps({'torrent': torrent_path, 'is_done': is_done, 'finished': finished, 'stages': stages},
+                           sort_keys=True))
+    if config.METRICS_TEXTFILE_PATH:
+        try:
+            _write_textfile(stages, is_done, finished)
+        except OSError:
+            logger.exception('Failed to write metrics to {}'.format(config.METRICS_TEXTFILE_PATH))
@@ -1,13 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
 import os
+import queue
+import shutil
+import tempfile
 
 import logbook
 
-from pyexpander.upload import upload_file
-from . import config
-from .subtitles import find_file_subtitles
+from . import backlog, config, journal, scheduler
+from .extract import discard_partial_extractions, extract_all
 
 logger = logbook.Logger('post_process')
 
+# Marks the end of a pipeline queue.
+_END_OF_QUEUE = None
+
+
+def _fetch_subtitles(file_paths, manifest=None):
+    """
+    Finds subtitles for the videos of the given batch.
+
+    :param file_paths: The file paths to process.
+    :param manifest: The torrent manifest to use and update, or None.
+    :return: A tuple of format (upload_paths, missing_languages), where upload_paths is the list of file paths to
+             upload (the given files and their subtitles), and missing_languages maps videos to the languages that
+             are left for the subtitles backlog.
+    """
+    # Heavy dependencies (subliminal, guessit) are only imported when their stage actually runs.
+    upload_paths = dict.fromkeys(file_paths)
+    # With a backlog, only existing and cached subtitles are used, so the videos are uploaded right away.
+    # The backlog only holds uploaded videos, so without uploads the subtitles are searched right away.
+    missing_languages = {} if config.SHOULD_UPLOAD and backlog.is_enabled() else None
+    if config.SHOULD_FIND_SUBTITLES:
+        from .subtitles import find_subtitles
+        videos_paths = [file_path for file_path in file_paths
+                        if os.path.splitext(file_path)[-1] not in config.SUBTITLES_EXTENSIONS]
+        for video_path, subtitles_paths in find_subtitles(videos_paths, manifest, missing_languages).items():
+            upload_paths.update(dict.fromkeys(subtitles_paths))
+            journal.set_file_stage(video_path, journal.FILE_SUBTITLES_FETCHED)
+    return list(upload_paths), missing_languages or {}
+
+
+def _upload(file_paths, upload_paths, missing_languages=None, manifest=None):
+    """
+    Uploads a batch of files to Google Drive.
+
+    :param file_paths: The processed file paths.
+    :param upload_paths: The file paths to upload (the processed files and their subtitles).
+    :param missing_languages: A dict mapping videos to the languages left for the subtitles backlog, or None.
+    :param manifest: The torrent manifest to update, or None.
+    :return: A dict mapping each processed file path to True if its processing was successful, and False otherwise.
+    """
+    if config.SHOULD_UPLOAD:
+        from .upload import upload_files
+        # Files may be gone since the batch was made (for example, subtitles uploaded along with their video).
+        existing_paths = [upload_path for upload_path in upload_paths if os.path.exists(upload_path)]
+        if len(existing_paths) < len(upload_paths):
+            logger.warning('Skipping {} files that no longer exist'.format(len(upload_paths) - len(existing_paths)))
+        upload_results = upload_files(existing_paths, missing_languages)
+        # Uploaded files are no longer part of the torrent.
+        if manifest:
+            for file_path, is_uploaded in upload_results.items():
+                if is_uploaded:
+                    manifest.remove(file_path)
+        return {file_path: upload_results.get(file_path, False) for file_path in file_paths}
+    return {file_path: True for file_path in file_paths}
+
+
+def _process_files(file_paths, manifest=None):
+    """
+    Processes a batch of files: finds subtitles for the videos, and uploads everything together.
+
+    :param file_paths: The file paths to process.
+    :param manifest: The torrent manifest to use and update, or None.
+    :return: A dict mapping each given file path to True if its processing was successful, and False otherwise.
+    """
+    upload_paths, missing_languages = _fetch_subtitles(file_paths, manifest)
+    return _upload(file_paths, upload_paths, missing_languages, manifest)
+
 
 def process_file(file_path):
     """
@@ -16,37 +85,212 @@ def process_file(file_path):
     :param file_path: The file path to process.
     :return: True if file processing was successful, and False otherwise.
     """
-    # Get subtitles.
-    subtitles_paths = None
-    if config.SHOULD_FIND_SUBTITLES and os.path.splitext(file_path)[-1] not in config.SUBTITLES_EXTENSIONS:
-        subtitles_paths = find_file_subtitles(file_path)
-    # Upload files to Google Drive.
-    if config.SHOULD_UPLOAD:
-        if subtitles_paths:
-            for subtitles_path in subtitles_paths:
-                upload_file(subtitles_path)
-        return upload_file(file_path)
-    return True
+    return _process_files([file_path])[file_path]
 
 
-def process_directory(directory):
+def process_directory(directory, manifest=None):
     """
     The main directory processing function.
     It searches for files in the directories matching the known extensions and moves/copies them to
     the relevant path in the destination (/path/category/torrent_name).
+    All files are processed as a single batch (one staging tree and one upload).
 
     :param directory: The directory to process.
+    :param manifest: The torrent manifest to take the files from (instead of walking the directory), or None.
+    :return: The number of successfully processed files.
+    """
+    if manifest:
+        logger.info('Processing directory {}'.format(directory))
+        file_paths = [entry.path for entry in manifest.get_files(directory)]
+    else:
+        file_paths = []
+        for directory_path, _, file_names in os.walk(directory):
+            logger.info('Processing directory {}'.format(directory_path))
+            file_paths.extend(os.path.join(directory_path, filename) for filename in file_names)
+    return sum(_process_files(file_paths, manifest).values())
+
+
+def _group_by_video(file_paths):
+    """
+    Group the given files by video: each video with its subtitles files (in the same directory).
+
+    :param file_paths: The file paths to group.
+    :return: A list of file path lists, in the order of the first file of each group.
+    """
+    groups = {}
+    for file_path in file_paths:
+        directory, file_name = os.path.split(file_path)
+        video_name, file_extension = os.path.splitext(file_name)
+        if file_extension in config.SUBTITLES_EXTENSIONS:
+            real_video_name, language_extension = os.path.splitext(video_name)
+            if language_extension in config.LANGUAGE_EXTENSIONS:
+                video_name = real_video_name
+        groups.setdefault((directory, video_name.lower()), []).append(file_path)
+    return list(groups.values())
+
+
+def _get_batch(input_queue):
+    """
+    Get the next batch of units from a pipeline queue: wait for the first unit, then take whatever else is
+    ready (up to config.PIPELINE_BATCH_SIZE files). Waiting units are batched together when the stage is slow.
+
+    :param input_queue: The queue to take units from.
+    :return: A tuple of format (units, is_last).
+    """
+    units = []
+    unit = input_queue.get()
+    while unit is not _END_OF_QUEUE:
+        units.append(unit)
+        if sum(len(unit[0]) for unit in units) >= config.PIPELINE_BATCH_SIZE:
+            return units, False
+        try:
+            unit = input_queue.get_nowait()
+        except queue.Empty:
+            return units, False
+    return units, True
+
+
+def _run_subtitles_stage(input_queue, output_queue, manifest):
+    """
+    The subtitles stage of the pipeline: finds subtitles for each batch, and passes it on to the upload stage.
+
+    :param input_queue: The queue of extracted units, as tuples of format (file_paths,).
+    :param output_queue: The queue of units to upload, as tuples of format
+                         (file_paths, upload_paths, missing_languages).
+    :param manifest: The torrent manifest to use and update.
+    """
+    is_last = False
+    while not is_last:
+        units, is_last = _get_batch(input_queue)
+        file_paths = [file_path for unit in units for file_path in unit[0]]
+        if not file_paths:
+            continue
+        try:
+            upload_paths, missing_languages = _fetch_subtitles(file_paths, manifest)
+        except Exception:
+            # The files can still be uploaded without subtitles.
+            logger.exception('Failed to find subtitles for {} files. Moving on...'.format(len(file_paths)))
+            upload_paths, missing_languages = file_paths, {}
+        output_queue.put((file_paths, upload_paths, missing_languages))
+    output_queue.put(_END_OF_QUEUE)
+
+
+def _run_upload_stage(input_queue, manifest):
+    """
+    The upload stage of the pipeline: uploads each batch as soon as it is ready.
+
+    :param input_queue: The queue of units to upload, as tuples of format
+                        (file_paths, upload_paths, missing_languages).
+    :param manifest: The torrent manifest to update.
     :return: The number of successfully processed files.
     """
     successful_files = 0
-    for directory_path, _, file_names in os.walk(directory):
-        logger.info('Processing directory {}'.format(directory_path))
-        # Process subtitles last, since videos will search for them.
-        sorted_file_names = sorted(file_names, key=lambda f: os.path.splitext(f)[-1] in config.SUBTITLES_EXTENSIONS)
-        for filename in sorted_file_names:
-            file_path = os.path.join(directory_path, filename)
-            # Old files might be removed by previous processing.
-            if os.path.exists(file_path):
-                if process_file(file_path):
-                    successful_files += 1
+    is_last = False
+    while not is_last:
+        units, is_last = _get_batch(input_queue)
+        if not units:
+            continue
+        file_paths = [file_path for unit in units for file_path in unit[0]]
+        missing_languages = {}
+        for unit in units:
+            missing_languages.update(unit[2])
+        try:
+            successful_files += sum(_upload(file_paths, [file_path for unit in units for file_path in unit[1]],
+                                            missing_languages, manifest).values())
+        except Exception:
+            # Keep draining the queue, so earlier stages are never blocked.
+            logger.exception('Failed to upload {} files. Moving on...'.format(len(file_paths)))
     return successful_files
+
+
+def process_torrent_directory(directory, manifest, should_extract=True):
+    """
+    Processes a torrent directory as a pipeline: extraction, subtitles and upload run at the same time,
+    connected by bounded queues. Each extracted archive is passed on as soon as it is ready, so the first
+    files are uploaded while others are still extracted.
+
+    :param directory: The torrent directory to process.
+    :param manifest: The torrent manifest to use and update.
+    :param should_extract: True to extract the archives in the directory, and False if they were already extracted.
+    :return: The number of successfully processed files (once all stages are drained).
+    """
+    logger.info('Processing directory {}'.format(directory))
+    subtitles_queue = queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    upload_queue = queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+
+    def add_files(unit_directory):
+        # Archives are not processed, they are extracted (and deleted) instead.
+        file_paths = [entry.path for entry in manifest.get_files(unit_directory)
+                      if not (should_extract and entry.kind == 'archive')]
+        # Big directories are split, so their first files don't wait for the last ones.
+        # A video and its subtitles are never split, since the subtitles are uploaded along with the video.
+        batch = []
+        for group in _group_by_video(file_paths):
+            if batch and len(batch) + len(group) > config.PIPELINE_BATCH_SIZE:
+                subtitles_queue.put((batch,))
+                batch = []
+            batch.extend(group)
+        if batch:
+            subtitles_queue.put((batch,))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        executor.submit(_run_subtitles_stage, subtitles_queue, upload_queue, manifest)
+        upload_future = executor.submit(_run_upload_stage, upload_queue, manifest)
+        try:
+            if should_extract:
+                discard_partial_extractions(directory, manifest)
+            add_files(directory)
+            if should_extract:
+                extract_all(directory, manifest, on_extracted=add_files)
+        finally:
+            # Let all stages drain, even if extraction failed.
+            subtitles_queue.put(_END_OF_QUEUE)
+        return upload_future.result()
+
+
+def backfill_subtitles():
+    """
+    Search the subtitles backlog videos that are due, and upload the subtitles found next to the uploaded videos.
+    Videos that still miss languages are searched again later.
+
+    :return: The number of uploaded subtitles.
+    """
+    # Subliminal and guessit are only imported when there is something to search.
+    if not backlog.get_due_videos():
+        return 0
+    from .subtitles import LANGUAGES_MAP, find_missing_subtitles
+    from .upload import reclaim_staging_dirs, upload_subtitles
+    backfill_root = os.path.join(config.DATA_PATH, config.SUBTITLES_BACKFILL_DIR_NAME)
+    # A single backfill runs at a time, so anything left in its directory is from an interrupted one.
+    with scheduler.slot('backfill', 1):
+        videos = backlog.get_due_videos()
+        if not videos:
+            return 0
+        logger.info('Searching subtitles for {} backlog videos...'.format(len(videos)))
+        reclaim_staging_dirs(backfill_root)
+        shutil.rmtree(backfill_root, ignore_errors=True)
+        os.makedirs(backfill_root)
+        work_dir = tempfile.mkdtemp(dir=backfill_root)
+        try:
+            # Each video gets a directory of its own, for its subtitles.
+            video_paths = []
+            for index, (_, video_name, _, _, _) in enumerate(videos):
+                os.makedirs(os.path.join(work_dir, str(index)))
+                video_paths.append(os.path.join(work_dir, str(index), video_name))
+            failed_paths = set()
+            found_subtitles = find_missing_subtitles([(video_path, fingerprint, hashes, languages) for video_path, (
+                _, _, fingerprint, hashes, languages) in zip(video_paths, videos)], failed_paths)
+            upload_results = upload_subtitles({cloud_path: list(found_subtitles[video_path].values())
+                                               for video_path, (cloud_path, _, _, _, _) in zip(video_paths, videos)})
+            uploaded_subtitles = 0
+            for video_path, (cloud_path, _, _, _, languages) in zip(video_paths, videos):
+                uploaded_languages = {language for language, subtitles_path in found_subtitles[video_path].items()
+                                      if upload_results.get(subtitles_path)}
+                uploaded_subtitles += len(uploaded_languages)
+                # A failed search (provider errors) is not counted as a try.
+                backlog.update_video(cloud_path, {language for language in languages if language in
+                                                  LANGUAGES_MAP and language not in uploaded_languages},
+                                     is_searched=video_path not in failed_paths)
+            return uploaded_subtitles
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,127 @@
+import datetime
+import json
+import re
+import subprocess
+import time
+
+import logbook
+
+from . import config
+from .utils import open_database
+
+logger = logbook.Logger('remote')
+
+_is_initialized = False
+
+
+def _open_cache():
+    """
+    Open the remote listing cache database, creating its tables if needed.
+
+    :return: The cache connection context manager.
+    """
+    global _is_initialized
+    if not _is_initialized:
+        with open_database(config.REMOTE_CACHE_PATH) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS remote_roots (root TEXT PRIMARY KEY, listed REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS remote_files (root TEXT, path TEXT, size INTEGER, '
+                               'modified REAL, PRIMARY KEY (root, path))')
+        _is_initialized = True
+    return open_database(config.REMOTE_CACHE_PATH)
+
+
+def is_enabled():
+    """
+    Check whether the remote listing cache is enabled.
+
+    :return: True if the cache is enabled, and False otherwise.
+    """
+    return bool(config.REMOTE_CACHE_PATH)
+
+
+def _parse_modification_time(modification_time):
+    """
+    Parse an rclone (RFC 3339) modification time.
+
+    :param modification_time: The modification time string.
+    :return: The modification time as a POSIX timestamp.
+    """
+    modification_time = modification_time.replace('Z', '+00:00')
+    # Python only parses up to microseconds, while rclone reports up to nanoseconds.
+    modification_time = re.sub(r'(\.\d{6})\d+', r'\1', modification_time)
+    return datetime.datetime.fromisoformat(modification_time).timestamp()
+
+
+def _list_remote(remote_path):
+    """
+    List the given remote path recursively, with a single rclone call.
+
+    :param remote_path: The remote path (for example 'GDrive:Media').
+    :return: A list of tuples of format (path, size, modified), or None if listing failed.
+    """
+    process_result = subprocess.run(
+        [config.RCLONE_PATH, '--config', config.RCLONE_CONFIG_PATH, 'lsjson', '--recursive', '--files-only',
+         '--fast-list', remote_path], text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    if process_result.returncode != 0:
+        logger.error('Failed to list {} ({}): {}'.format(remote_path, process_result.returncode,
+                                                        process_result.stderr))
+        return None
+    return [(entry['Path'], entry['Size'], _parse_modification_time(entry['ModTime']))
+            for entry in json.loads(process_result.stdout or '[]')]
+
+
+def refresh(remote_path, force=False):
+    """
+    Refresh the cached listing of the given remote path, if it is older than config.REMOTE_CACHE_TTL.
+
+    :param remote_path: The remote path (for example 'GDrive:Media').
+    :param force: True to refresh even if the cached listing is still fresh.
+    :return: True if a fresh listing is available, and False otherwise.
+    """
+    if not is_enabled():
+        return False
+    with _open_cache() as connection:
+        row = connection.execute('SELECT listed FROM remote_roots WHERE root = ?', (remote_path,)).fetchone()
+    if not force and row and row[0] + config.REMOTE_CACHE_TTL > time.time():
+        return True
+    logger.info('Listing remote path {}...'.format(remote_path))
+    listed = time.time()
+    remote_files = _list_remote(remote_path)
+    if remote_files is None:
+        return False
+    with _open_cache() as connection:
+        connection.execute('DELETE FROM remote_files WHERE root = ?', (remote_path,))
+        connection.executemany('INSERT INTO remote_files (root, path, size, modified) VALUES (?, ?, ?, ?)',
+                               [(remote_path, path, size, modified) for path, size, modified in remote_files])
+        connection.execute('INSERT OR REPLACE INTO remote_roots (root, listed) VALUES (?, ?)', (remote_path, listed))
+    logger.info('Cached {} remote files of {}'.format(len(remote_files), remote_path))
+    return True
+
+
+def get_file(remote_path, path):
+    """
+    Get the cached details of a remote file.
+
+    :param remote_path: The remote root path (for example 'GDrive:Media').
+    :param path: The file path, relative to the remote root path.
+    :return: A tuple of format (size, modified), or None if the file is not known to exist.
+    """
+    if not is_enabled():
+        return None
+    with _open_cache() as connection:
+        return connection.execute('SELECT size, modified FROM remote_files WHERE root = ? AND path = ?',
+                                  (remote_path, path)).fetchone()
+
+
+def add_files(remote_path, files):
+    """
+    Add our own uploads to the cached listing, so it stays fresh without listing the remote again.
+
+    :param remote_path: The remote root path (for example 'GDrive:Media').
+    :param files: A list of tuples of format (path, size, modified).
+    """
+    if not is_enabled():
+        return
+    with _open_cache() as connection:
+        connection.executemany('INSERT OR REPLACE INTO remote_files (root, path, size, modified) VALUES (?, ?, ?, ?)',
+                               [(remote_path, path, size, modified) for path, size, modified in files])
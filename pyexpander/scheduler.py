@@ -0,0 +1,141 @@
+from contextlib import contextmanager
+import fcntl
+import os
+import threading
+import time
+
+import logbook
+
+from . import config, metrics
+
+# Queue priorities (lower values are served first).
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 1
+
+logger = logbook.Logger('scheduler')
+
+_priority = NORMAL_PRIORITY
+
+
+def set_priority(priority):
+    """
+    Set the queue priority of the current torrent.
+
+    :param priority: The priority (HIGH_PRIORITY or NORMAL_PRIORITY).
+    """
+    global _priority
+    _priority = priority
+
+
+def _try_lock(path):
+    """
+    Try to lock the given file exclusively, without waiting.
+
+    :param path: The file path (created if needed).
+    :return: The locked file descriptor, or None if the file is locked by someone else.
+    """
+    file_descriptor = os.open(path, os.O_CREAT | os.O_RDWR, 0o660)
+    try:
+        fcntl.flock(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(file_descriptor)
+        return None
+    return file_descriptor
+
+
+def _create_ticket(queue_dir):
+    """
+    Take a ticket in the given queue. The ticket file stays locked as long as its owner is alive.
+
+    :param queue_dir: The queue directory.
+    :return: A tuple of format (ticket name, ticket file descriptor).
+    """
+    ticket_name = '{:03d}-{:020d}-{}-{}'.format(_priority, time.time_ns(), os.getpid(), threading.get_ident())
+    # Lock the ticket before it shows up in the queue, so no one mistakes it for a stale one.
+    temp_path = os.path.join(queue_dir, '.{}'.format(ticket_name))
+    ticket_descriptor = _try_lock(temp_path)
+    os.rename(temp_path, os.path.join(queue_dir, ticket_name))
+    return ticket_name, ticket_descriptor
+
+
+def _is_first(queue_dir, ticket_name):
+    """
+    Check whether the given ticket is the first live ticket in the queue, removing stale tickets on the way.
+
+    :param queue_dir: The queue directory.
+    :param ticket_name: The ticket name.
+    :return: True if the ticket is first in line, and False otherwise.
+    """
+    for other_ticket_name in sorted(os.listdir(queue_dir)):
+        if other_ticket_name >= ticket_name:
+            return True
+        if other_ticket_name.startswith('.'):
+            continue
+        other_ticket_path = os.path.join(queue_dir, other_ticket_name)
+        try:
+            other_ticket_descriptor = _try_lock(other_ticket_path)
+        except FileNotFoundError:
+            continue
+        if other_ticket_descriptor is None:
+            return False
+        # Its owner died without removing it (or just removed it).
+        try:
+            os.remove(other_ticket_path)
+            logger.debug('Removed stale ticket {}'.format(other_ticket_path))
+        except FileNotFoundError:
+            pass
+        os.close(other_ticket_descriptor)
+    return True
+
+
+def _wait_for_slot(resource, limit):
+    """
+    Wait in line (by priority, then FIFO) for one of the host-wide slots of the given resource.
+
+    :param resource: The resource name.
+    :param limit: The number of slots.
+    :return: The locked slot file descriptor.
+    """
+    queue_dir = os.path.join(config.SCHEDULER_PATH, '{}.queue'.format(resource))
+    os.makedirs(queue_dir, exist_ok=True)
+    ticket_name, ticket_descriptor = _create_ticket(queue_dir)
+    try:
+        while True:
+            if _is_first(queue_dir, ticket_name):
+                for index in range(limit):
+                    slot_descriptor = _try_lock(os.path.join(config.SCHEDULER_PATH, '{}.{}.lock'.format(
+                        resource, index)))
+                    if slot_descriptor is not None:
+                        return slot_descriptor
+            time.sleep(config.SCHEDULER_POLL_INTERVAL)
+    finally:
+        os.remove(os.path.join(queue_dir, ticket_name))
+        os.close(ticket_descriptor)
+
+
+@contextmanager
+def slot(resource, limit):
+    """
+    Hold one of the host-wide slots of the given resource, shared by all pyexpander processes.
+    Does nothing if the scheduler is disabled (config.SCHEDULER_PATH is None) or the resource is unlimited.
+
+    :param resource: The resource name.
+    :param limit: The number of slots, or None for no limit.
+    """
+    slot_descriptor = None
+    if config.SCHEDULER_PATH and limit:
+        start_time = time.monotonic()
+        try:
+            slot_descriptor = _wait_for_slot(resource, limit)
+        except OSError:
+            logger.exception('Failed to get a {} slot. Going on without it...'.format(resource))
+        waiting_time = time.monotonic() - start_time
+        metrics.add('{}_queue'.format(resource), calls=1, seconds=waiting_time)
+        if waiting_time >= 1:
+            logger.info('Waited {:.1f} seconds for a {} slot'.format(waiting_time, resource))
+    try:
+        yield
+    finally:
+        if slot_descriptor is not None:
+            # Closing the file releases its lock.
+            os.close(slot_descriptor)
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import deepcopy
 import datetime
 import os
@@ -5,102 +6,353 @@ import os
 import babelfish
 import logbook
 import subliminal
+from dogpile.cache import register_backend
 from subliminal.cache import region
+from subliminal.core import AsyncProviderPool
 from subliminal.cli import dirs, cache_file, MutexLock
+from subliminal.extensions import default_providers
 from subliminal.subtitle import get_subtitle_path
+from subliminal.video import VIDEO_EXTENSIONS
 
-from .config import LANGUAGES_MAP, PROVIDER_CONFIGS, LANGUAGE_EXTENSIONS, SUBTITLES_EXTENSIONS, \
-    DEFAULT_LANGUAGE_EXTENSION
+from . import config, fingerprint, metrics, scheduler, subtitles_cache
+from .config import PROVIDER_CONFIGS, LANGUAGE_EXTENSIONS, SUBTITLES_EXTENSIONS, \
+    DEFAULT_LANGUAGE_EXTENSION, SUBTITLES_MAX_WORKERS, SUBTITLES_SLOTS, SUBTITLES_CACHE_EXPIRATION
 
 logger = logbook.Logger('subtitles')
 
+# The wanted languages (config.LANGUAGES_MAP by babelfish languages, so the config doesn't import babelfish).
+LANGUAGES_MAP = {babelfish.Language(code): providers for code, providers in config.LANGUAGES_MAP.items()}
 
-def _check_hebits_dir(path):
-    for file_name in os.listdir(path):
-        if 'hebits' in file_name.lower():
-            return True
-    return False
 
+def _build_directory_snapshot(directory, manifest):
+    """
+    Build a snapshot of the existing subtitles in the given directory, with a single listing.
 
-def find_file_subtitles(path):
+    :param directory: The directory to snapshot.
+    :param manifest: The torrent manifest to list the directory from, or None to list it from the disk.
+    :return: A dict mapping each lowercase video name to a dict of its existing subtitles (language -> path).
     """
-    Finds subtitles for the given video file path.
+    file_names = manifest.list_directory(directory) if manifest else None
+    if file_names is None:
+        file_names = os.listdir(directory)
+    is_hebits_dir = any('hebits' in file_name.lower() for file_name in file_names)
+    snapshot = {}
+    for file_name, file_extension in [os.path.splitext(p) for p in file_names]:
+        if file_extension not in SUBTITLES_EXTENSIONS:
+            continue
+        real_file_name, language_extension = os.path.splitext(file_name)
+        # Switch empty extension with default one.
+        if language_extension not in LANGUAGE_EXTENSIONS:
+            language_extension = '.he' if is_hebits_dir else DEFAULT_LANGUAGE_EXTENSION
+            real_file_name = file_name
+        if language_extension not in LANGUAGE_EXTENSIONS:
+            continue
+        language = babelfish.Language.fromalpha2(language_extension.strip('.'))
+        snapshot.setdefault(real_file_name.lower(), {}).setdefault(
+            language, os.path.join(directory, file_name + file_extension))
+    logger.debug('Found existing subtitles for {} files in {}'.format(len(snapshot), directory))
+    return snapshot
+
+
+def _find_existing_subtitles(path, languages_map, snapshots, manifest):
+    """
+    Finds existing subtitles files for the given video file path, and removes their languages from the map.
 
     :param path: The path of the video file to find subtitles to.
-    :return: The list of subtitles file paths, or None if a problem occurred.
+    :param languages_map: The map of wanted languages (modified in place).
+    :param snapshots: The directory snapshots cache, as a dict of directory -> snapshot.
+    :param manifest: The torrent manifest, or None.
+    :return: The list of existing subtitles file paths.
     """
     results_list = []
-    # We don't want to mess with the original map.
-    languages_map = deepcopy(LANGUAGES_MAP)
-    # Check for existing subtitle files first.
     logger.debug('Checking for existing subtitles for file: {}'.format(path))
+    directory = os.path.dirname(path)
+    if directory not in snapshots:
+        snapshots[directory] = _build_directory_snapshot(directory, manifest)
     video_name = os.path.splitext(os.path.basename(path))[0]
-    for file_name, file_extension in [os.path.splitext(p) for p in os.listdir(os.path.dirname(path))]:
-        logger.debug('Checking file {} with extension {}'.format(file_name, file_extension))
-        if file_extension in SUBTITLES_EXTENSIONS:
-            real_file_name, language_extension = os.path.splitext(file_name)
-            # Switch empty extension with default one.
-            if language_extension not in LANGUAGE_EXTENSIONS:
-                language_extension = '.he' if _check_hebits_dir(os.path.dirname(path)) else DEFAULT_LANGUAGE_EXTENSION
-                real_file_name = file_name
-            logger.debug('Language extension is now {}'.format(language_extension))
-            logger.debug('Comparing {} with {}'.format(real_file_name.lower(), video_name.lower()))
-            if real_file_name.lower() == video_name.lower() and language_extension in LANGUAGE_EXTENSIONS:
-                language = babelfish.Language.fromalpha2(language_extension.strip('.'))
-                logger.debug('Language is now {}'.format(language))
-                if language in languages_map:
-                    subtitles_path = os.path.join(os.path.dirname(path), real_file_name + file_extension)
-                    languages_map.pop(language)
-                    results_list.append(subtitles_path)
-                    logger.info('Found existing subtitles ({}) file: {}'.format(language, subtitles_path))
-    if not languages_map:
-        return results_list
-    # Get new ones if needed.
-    logger.info('Searching subtitles for file: {}'.format(path))
+    for language, subtitles_path in snapshots[directory].get(video_name.lower(), {}).items():
+        if language in languages_map:
+            languages_map.pop(language)
+            results_list.append(subtitles_path)
+            logger.info('Found existing subtitles ({}) file: {}'.format(language, subtitles_path))
+    return results_list
+
+
+def _save_subtitles(path, language, content, manifest):
+    """
+    Save subtitles alongside the given video file.
+
+    :param path: The path of the video file.
+    :param language: The subtitles language.
+    :param content: The subtitles content.
+    :param manifest: The torrent manifest to update, or None.
+    :return: The subtitles file path.
+    """
+    subtitles_path = get_subtitle_path(path, language)
+    open(subtitles_path, 'wb').write(content)
+    if manifest:
+        manifest.add(subtitles_path)
+    return subtitles_path
+
+
+def _find_cached_subtitles(path, content_fingerprint, languages_map, manifest):
+    """
+    Use the cached search results of the given video file, and remove their languages from the map.
+    Languages that none of their providers had recently are removed as well, so they aren't searched again.
+
+    :param path: The path of the video file.
+    :param content_fingerprint: The video content fingerprint.
+    :param languages_map: The map of wanted languages (modified in place).
+    :param manifest: The torrent manifest to update, or None.
+    :return: A dict of the saved subtitles (language -> path).
+    """
+    results = {}
+    for language, providers in list(languages_map.items()):
+        cached_results = subtitles_cache.get_results(content_fingerprint, language, providers or default_providers)
+        if cached_results is None:
+            continue
+        languages_map.pop(language)
+        if cached_results is True:
+            logger.info('No {} subtitles were found for {} recently. Skipping search...'.format(language, path))
+            continue
+        content, provider = cached_results
+        subtitles_path = _save_subtitles(path, language, content, manifest)
+        logger.info('Saved cached {} subtitles (from {}) to: {}'.format(language, provider, subtitles_path))
+        results[language] = subtitles_path
+    return results
+
+
+def _cache_search_results(content_fingerprint, searched_languages, subtitles_list):
+    """
+    Cache the search results of a video: the downloaded subtitles, and the languages nothing was found for.
+
+    :param content_fingerprint: The video content fingerprint.
+    :param searched_languages: A dict mapping each searched language to its list of provider names.
+    :param subtitles_list: The downloaded subliminal subtitles.
+    """
+    found_languages = set()
+    for subtitles in subtitles_list:
+        if subtitles.content is not None:
+            found_languages.add(subtitles.language)
+            subtitles_cache.add_results(content_fingerprint, subtitles.language, [subtitles.provider_name], subtitles)
+    for language, providers in searched_languages.items():
+        if language not in found_languages:
+            subtitles_cache.add_results(content_fingerprint, language, providers)
+
+
+def _scan_video(path, missing_languages):
+    """
+    Scan the given video file for subliminal.
+
+    :param path: The path of the video file.
+    :param missing_languages: The languages the video still needs.
+    :return: The subliminal video, or None if the file is not a video.
+    """
     try:
-        # Get required video information.
         video = subliminal.scan_video(path)
-        other_languages = []
-        subtitle_results = []
-        for language, providers in languages_map.items():
-            # Filter providers the user didn't ask for.
-            if not providers:
-                other_languages.append(language)
-            else:
-                current_result = subliminal.download_best_subtitles(
-                    {video}, languages={language}, providers=providers, provider_configs=PROVIDER_CONFIGS).values()
-                if len(current_result) > 0:
-                    subtitle_results.extend(list(current_result)[0])
-        # Download all other languages.
-        for language in other_languages:
-            current_result = subliminal.download_best_subtitles(
-                {video}, languages={language}, provider_configs=PROVIDER_CONFIGS).values()
-            if len(current_result) > 0:
-                subtitle_results.extend(list(current_result)[0])
-        # Handle results.
-        if len(subtitle_results) == 0:
-            logger.info('No subtitles were found. Moving on...')
-        else:
-            logger.info('Found {} subtitles. Saving files...'.format(len(subtitle_results)))
-            # Save subtitles alongside the video file.
-            for subtitles in subtitle_results:
-                # Filter empty subtitles files.
-                if subtitles.content is None:
-                    logger.debug('Skipping subtitle {}: no content'.format(subtitles))
-                    continue
-                subtitles_path = get_subtitle_path(video.name, subtitles.language)
-                logger.info('Saving {} to: {}'.format(subtitles, subtitles_path))
-                open(subtitles_path, 'wb').write(subtitles.content)
-                results_list.append(subtitles_path)
-            return results_list
     except ValueError:
         # Subliminal raises a ValueError if the given file is not a video file.
-        logger.info('Not a video file. Moving on...')
-        return []
-    except Exception:
-        # Subliminal crashes randomly sometimes.
-        logger.exception('Error while searching for subtitles. Moving on...')
-        return []
+        logger.info('{} is not a video file. Moving on...'.format(path))
+        return None
+    # Subliminal skips languages the video already has.
+    video.subtitle_languages = set(LANGUAGES_MAP) - set(missing_languages)
+    # Hash matching providers get the hashes that were already computed (subliminal doesn't compute them here).
+    video.hashes.update(fingerprint.get_provider_hashes(path))
+    return video
+
+
+def _download_subtitles(videos, languages, providers):
+    """
+    Download the best subtitles for all given videos, using a single provider pool.
+    Providers are queried concurrently, and their connections are reused for all videos.
+
+    :param videos: The set of videos to download subtitles for.
+    :param languages: The set of languages to download.
+    :param providers: The list of providers to use, or None for all providers.
+    :return: A dict mapping each video to its list of downloaded subtitles.
+    """
+    logger.info('Searching {} subtitles for {} files using {} providers'.format(
+        ', '.join(str(language) for language in languages), len(videos), providers or 'all'))
+    return subliminal.download_best_subtitles(
+        videos, languages=languages, pool_class=AsyncProviderPool, max_workers=SUBTITLES_MAX_WORKERS,
+        providers=providers, provider_configs=PROVIDER_CONFIGS)
+
+
+def _search_subtitles(videos_languages, fingerprints, manifest=None, failed_videos=None):
+    """
+    Search the missing subtitles of all given videos together, and save them alongside the videos.
+
+    :param videos_languages: A dict mapping each subliminal video to its wanted languages (language -> providers).
+    :param fingerprints: A dict mapping each video to its content fingerprint (or None, to skip caching).
+    :param manifest: The torrent manifest to update, or None.
+    :param failed_videos: A set to fill with the videos whose search failed (for some of their languages), or None.
+    :return: A dict mapping each video to a dict of its saved subtitles (language -> path).
+    """
+    # Languages are grouped by their favorite providers, so each group is searched with a single pool.
+    languages_by_providers = {}
+    for language, providers in LANGUAGES_MAP.items():
+        languages_by_providers.setdefault(tuple(providers) if providers else None, set()).add(language)
+    videos_by_providers = {}
+    for video, languages_map in videos_languages.items():
+        for providers, languages in languages_by_providers.items():
+            if languages & set(languages_map):
+                videos_by_providers.setdefault(providers, set()).add(video)
+
+    # Search all provider groups at the same time.
+    subtitle_results = {}
+    failed_providers = set()
+    with scheduler.slot('subtitles', SUBTITLES_SLOTS), \
+            ThreadPoolExecutor(max_workers=len(videos_by_providers)) as executor:
+        futures = {executor.submit(_download_subtitles, videos, languages_by_providers[providers],
+                                   list(providers) if providers else None): providers
+                   for providers, videos in videos_by_providers.items()}
+        for future in as_completed(futures):
+            try:
+                for video, subtitles in future.result().items():
+                    subtitle_results.setdefault(video, []).extend(subtitles)
+            except Exception:
+                # Subliminal crashes randomly sometimes.
+                failed_providers.add(futures[future])
+                logger.exception('Error while searching for subtitles ({}). Moving on...'.format(
+                    futures[future] or 'all providers'))
+
+    # Save subtitles alongside the video files.
+    results = {}
+    for video, languages_map in videos_languages.items():
+        results[video] = {}
+        subtitles_list = subtitle_results.get(video, [])
+        # Failed searches prove nothing, so their languages aren't cached.
+        searched_languages = {language: providers for language, providers in languages_map.items()
+                              if (tuple(LANGUAGES_MAP[language]) or None) not in failed_providers}
+        if failed_videos is not None and len(searched_languages) < len(languages_map):
+            failed_videos.add(video)
+        if fingerprints.get(video):
+            _cache_search_results(fingerprints[video], searched_languages, subtitles_list)
+        if len(subtitles_list) == 0:
+            logger.info('No subtitles were found for {}. Moving on...'.format(video.name))
+            continue
+        logger.info('Found {} subtitles for {}. Saving files...'.format(len(subtitles_list), video.name))
+        for subtitles in subtitles_list:
+            # Filter empty subtitles files.
+            if subtitles.content is None:
+                logger.debug('Skipping subtitle {}: no content'.format(subtitles))
+                continue
+            subtitles_path = _save_subtitles(video.name, subtitles.language, subtitles.content, manifest)
+            logger.info('Saved {} to: {}'.format(subtitles, subtitles_path))
+            results[video][subtitles.language] = subtitles_path
+    return results
+
+
+@metrics.measure('subtitles')
+def find_subtitles(paths, manifest=None, missing_languages=None):
+    """
+    Finds subtitles for all the given video file paths.
+    Existing subtitles are used first, and missing ones are searched for all videos together.
+
+    :param paths: The paths of the video files to find subtitles to.
+    :param manifest: The torrent manifest to use and update, or None.
+    :param missing_languages: A dict to fill with the languages each video still misses (without searching them,
+                              so they can be backfilled later), or None to search them now.
+    :return: A dict mapping each path to its list of subtitles file paths.
+    """
+    results = {}
+    videos_paths = {}
+    # The languages searched for each video (by their providers), and the video fingerprints.
+    videos_languages = {}
+    fingerprints = {}
+    # Each directory is listed once, no matter how many videos it holds.
+    snapshots = {}
+    for path in paths:
+        if not path.lower().endswith(VIDEO_EXTENSIONS):
+            logger.debug('{} is not a video file. Moving on...'.format(path))
+            results[path] = []
+            continue
+        # We don't want to mess with the original map.
+        languages_map = deepcopy(LANGUAGES_MAP)
+        results[path] = _find_existing_subtitles(path, languages_map, snapshots, manifest)
+        if not languages_map:
+            continue
+        content_fingerprint = None
+        if subtitles_cache.is_enabled():
+            content_fingerprint = fingerprint.get_content_fingerprint(path)
+            results[path].extend(_find_cached_subtitles(path, content_fingerprint, languages_map, manifest).values())
+            if not languages_map:
+                continue
+        if missing_languages is not None:
+            missing_languages[path] = set(languages_map)
+            continue
+        try:
+            video = _scan_video(path, languages_map)
+        except Exception:
+            # Subliminal crashes randomly sometimes.
+            logger.exception('Error while scanning {}. Moving on...'.format(path))
+            continue
+        if video is None:
+            continue
+        videos_paths[video] = path
+        videos_languages[video] = {language: providers or default_providers
+                                   for language, providers in languages_map.items()}
+        fingerprints[video] = content_fingerprint
+    if not videos_paths:
+        return results
+
+    for video, subtitles_paths in _search_subtitles(videos_languages, fingerprints, manifest).items():
+        results[videos_paths[video]].extend(subtitles_paths.values())
+    return results
+
+
+@metrics.measure('backfill')
+def find_missing_subtitles(videos, failed_paths=None):
+    """
+    Finds subtitles for videos that are no longer on the disk (they were already uploaded), by their names.
+    Subtitles are saved next to the given (virtual) video paths.
+
+    :param videos: A list of tuples of format (video_path, fingerprint, hashes, languages), where video_path has
+                   the original video file name (inside an existing directory), and hashes are its provider hashes.
+    :param failed_paths: A set to fill with the video paths whose search failed (for some of their languages), or None.
+    :return: A dict mapping each video path to a dict of its saved subtitles (language -> path).
+    """
+    results = {}
+    videos_paths = {}
+    videos_languages = {}
+    fingerprints = {}
+    for path, content_fingerprint, hashes, languages in videos:
+        # Languages that are no longer wanted are dropped.
+        languages_map = {language: LANGUAGES_MAP[language] for language in languages if language in LANGUAGES_MAP}
+        results[path] = _find_cached_subtitles(path, content_fingerprint, languages_map, None)
+        if not languages_map:
+            continue
+        try:
+            video = subliminal.Video.fromname(path)
+        except ValueError:
+            logger.info('{} is not a video name. Moving on...'.format(path))
+            continue
+        # The size and hashes help providers that match by them (the file itself is gone).
+        video.size = int(content_fingerprint.split(':', 1)[0])
+        video.hashes.update(hashes)
+        video.subtitle_languages = set()
+        videos_paths[video] = path
+        videos_languages[video] = {language: providers or default_providers
+                                   for language, providers in languages_map.items()}
+        fingerprints[video] = content_fingerprint
+    if videos_paths:
+        failed_videos = set()
+        for video, subtitles_paths in _search_subtitles(videos_languages, fingerprints,
+                                                        failed_videos=failed_videos).items():
+            results[videos_paths[video]].update(subtitles_paths)
+        if failed_paths is not None:
+            failed_paths.update(videos_paths[video] for video in failed_videos)
+    return results
+
+
+def find_file_subtitles(path):
+    """
+    Finds subtitles for the given video file path.
+
+    :param path: The path of the video file to find subtitles to.
+    :return: The list of subtitles file paths.
+    """
+    return find_subtitles([path])[path]
 
 
 def configure_subtitles_cache():
@@ -108,7 +360,14 @@ def configure_subtitles_cache():
     Configure the subliminal cache settings.
     Should be called once when the program starts.
     """
-    # Configure the subliminal cache.
+    if subtitles_cache.is_enabled():
+        # A cache all pyexpander processes can share.
+        register_backend(subtitles_cache.BACKEND_NAME, 'pyexpander.subtitles_cache', 'SQLiteBackend')
+        region.configure(subtitles_cache.BACKEND_NAME,
+                         expiration_time=datetime.timedelta(seconds=SUBTITLES_CACHE_EXPIRATION))
+        subtitles_cache.purge()
+        return
+    # Configure the subliminal cache (a single process at a time).
     cache_dir = dirs.user_cache_dir
     if not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
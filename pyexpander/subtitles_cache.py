@@ -0,0 +1,143 @@
+import time
+
+from dogpile.cache.api import BytesBackend, NO_VALUE
+import logbook
+
+from . import config
+from .utils import open_database
+
+logger = logbook.Logger('subtitles_cache')
+
+# The dogpile backend name of the shared subliminal cache.
+BACKEND_NAME = 'pyexpander.sqlite'
+
+_is_initialized = False
+
+
+def _open_cache():
+    """
+    Open the subtitles cache database, creating its tables if needed.
+
+    :return: The subtitles cache connection context manager.
+    """
+    global _is_initialized
+    if not _is_initialized:
+        with open_database(config.SUBTITLES_CACHE_PATH) as connection:
+            # Subliminal's own cache (provider lookups, show ids, etc.), as pickled dogpile values.
+            connection.execute('CREATE TABLE IF NOT EXISTS region (key TEXT PRIMARY KEY, value BLOB, created REAL)')
+            # Search results per video, language and provider (content is NULL when nothing was found).
+            connection.execute('CREATE TABLE IF NOT EXISTS results (fingerprint TEXT, language TEXT, '
+                               'provider TEXT, content BLOB, searched REAL, '
+                               'PRIMARY KEY (fingerprint, language, provider))')
+        _is_initialized = True
+    return open_database(config.SUBTITLES_CACHE_PATH)
+
+
+def is_enabled():
+    """
+    Check whether the shared subtitles cache is enabled.
+
+    :return: True if the cache is enabled, and False otherwise.
+    """
+    return bool(config.SUBTITLES_CACHE_PATH)
+
+
+def purge():
+    """
+    Remove expired entries, so the cache doesn't grow forever.
+    """
+    if not is_enabled():
+        return
+    now = time.time()
+    with _open_cache() as connection:
+        connection.execute('DELETE FROM region WHERE created < ?', (now - config.SUBTITLES_CACHE_EXPIRATION,))
+        connection.execute('DELETE FROM results WHERE searched < ? OR (content IS NULL AND searched < ?)',
+                           (now - config.SUBTITLES_CACHE_EXPIRATION, now - config.SUBTITLES_NEGATIVE_CACHE_TTL))
+
+
+def get_results(fingerprint, language, providers):
+    """
+    Get the cached search results of the given video and language.
+
+    :param fingerprint: The video content fingerprint.
+    :param language: The subtitles language.
+    :param providers: The provider names that would be searched.
+    :return: A tuple of format (content, provider) if subtitles were found by one of the providers,
+             True if none of the providers found subtitles recently, or None if a search is needed.
+    """
+    if not is_enabled():
+        return None
+    now = time.time()
+    with _open_cache() as connection:
+        rows = connection.execute(
+            'SELECT provider, content FROM results WHERE fingerprint = ? AND language = ? AND '
+            '((content IS NOT NULL AND searched >= ?) OR (content IS NULL AND searched >= ?))',
+            (fingerprint, str(language), now - config.SUBTITLES_CACHE_EXPIRATION,
+             now - config.SUBTITLES_NEGATIVE_CACHE_TTL)).fetchall()
+    for provider, content in rows:
+        if content is not None:
+            return content, provider
+    # Any provider without a recent answer may have subtitles by now.
+    if set(providers) <= {provider for provider, _ in rows}:
+        return True
+    return None
+
+
+def add_results(fingerprint, language, providers, subtitles=None):
+    """
+    Cache the search results of the given video and language.
+
+    :param fingerprint: The video content fingerprint.
+    :param language: The subtitles language.
+    :param providers: The provider names that were searched.
+    :param subtitles: The downloaded subliminal subtitles, or None if nothing was found.
+    """
+    if not is_enabled():
+        return
+    now = time.time()
+    if subtitles is not None:
+        rows = [(fingerprint, str(language), subtitles.provider_name, subtitles.content, now)]
+    else:
+        rows = [(fingerprint, str(language), provider, None, now) for provider in providers]
+    with _open_cache() as connection:
+        connection.executemany('INSERT OR REPLACE INTO results (fingerprint, language, provider, content, searched) '
+                               'VALUES (?, ?, ?, ?, ?)', rows)
+
+
+class SQLiteBackend(BytesBackend):
+    """
+    A dogpile cache backend for subliminal, stored in the subtitles cache database.
+    Unlike the dbm backend, it is safe to share between processes (SQLite in WAL mode).
+    Dogpile locks stay in-process: at worst, two processes compute the same value at the same time.
+    """
+
+    def __init__(self, arguments):
+        """
+        :param arguments: The backend arguments (unused, the database is config.SUBTITLES_CACHE_PATH).
+        """
+        self.arguments = arguments
+
+    def get_serialized(self, key):
+        return self.get_serialized_multi([key])[0]
+
+    def get_serialized_multi(self, keys):
+        with _open_cache() as connection:
+            values = dict(connection.execute('SELECT key, value FROM region WHERE key IN ({})'.format(
+                ', '.join('?' * len(keys))), list(keys)).fetchall())
+        return [values.get(key, NO_VALUE) for key in keys]
+
+    def set_serialized(self, key, value):
+        self.set_serialized_multi({key: value})
+
+    def set_serialized_multi(self, mapping):
+        now = time.time()
+        with _open_cache() as connection:
+            connection.executemany('INSERT OR REPLACE INTO region (key, value, created) VALUES (?, ?, ?)',
+                                   [(key, value, now) for key, value in mapping.items()])
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        with _open_cache() as connection:
+            connection.executemany('DELETE FROM region WHERE key = ?', [(key,) for key in keys])
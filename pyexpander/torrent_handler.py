@@ -1,15 +1,14 @@
 #!/usr/local/bin/python3.5
 import os
-import shutil
-import subprocess
 import sys
 
 import logbook
 
-from pyexpander import config
-from pyexpander.extract import extract_all, cleanup
-from pyexpander.postprocess import process_directory, process_file
-from pyexpander.subtitles import configure_subtitles_cache
+from pyexpander import backlog, config, deferred, history, journal, metrics, scheduler, transfer
+from pyexpander.daemon import serve, send_torrent
+from pyexpander.extract import cleanup
+from pyexpander.manifest import TorrentManifest
+from pyexpander.postprocess import process_file, process_torrent_directory
 from pyexpander.transmission import get_environment_variables_from_transmission
 
 logger = logbook.Logger('handler')
@@ -29,18 +28,15 @@ def _get_log_handlers():
     ]
 
 
-def _recreate_empty_torrent(current_path, recreate_path, is_file):
+def _recreate_empty_torrent(manifest, recreate_path):
     logger.debug("Recreating empty torrent...")
-    if is_file:
+    if manifest.is_file:
         open(recreate_path, "wb").truncate()
     else:
-        for dir_path, dir_names, file_names in os.walk(current_path):
-            base_path = dir_path.replace(current_path, recreate_path)
-            os.makedirs(base_path, exist_ok=True)
-            for dir_name in dir_names:
-                os.makedirs(os.path.join(base_path, dir_name), exist_ok=True)
-            for file_name in file_names:
-                open(os.path.join(base_path, file_name), "wb").truncate()
+        for dir_path in manifest.get_directories():
+            os.makedirs(os.path.join(recreate_path, os.path.relpath(dir_path, manifest.root)), exist_ok=True)
+        for entry in manifest.get_files():
+            open(os.path.join(recreate_path, os.path.relpath(entry.path, manifest.root)), "wb").truncate()
 
 
 def expand_torrent(torrent_path):
@@ -52,39 +48,88 @@ def expand_torrent(torrent_path):
     logger.info('Processing torrent {}'.format(torrent_path))
     torrent_path = os.path.abspath(torrent_path)
     is_file = os.path.isfile(torrent_path)
+    metrics.reset()
+    with metrics.measure('torrent') as torrent_metrics:
+        is_done = _expand_torrent(torrent_path, is_file, torrent_metrics)
+    metrics.report(torrent_path, is_done)
+    logger.info('Done!')
+
+
+def _expand_torrent(torrent_path, is_file, torrent_metrics):
+    """
+    Perform the torrent expansion steps (see expand_torrent).
+
+    :param torrent_path: The absolute torrent path to expand.
+    :param is_file: True if the torrent is a single file, and False otherwise.
+    :param torrent_metrics: The torrent metrics sample, updated with the torrent size.
+    :return: True if the torrent was processed successfully, and False otherwise.
+    """
+    is_done = False
 
     # If upload was finished in the past, recreate and skip upload.
     if os.path.basename(torrent_path).startswith(config.FINISHED_UPLOAD_PREFIX):
-        _recreate_empty_torrent(torrent_path, torrent_path, is_file)
+        _recreate_empty_torrent(TorrentManifest.build(torrent_path), torrent_path)
         logger.info('File was uploaded in the past. Skipping!')
-        return
+        return True
 
     # Move/Copy all relevant files to their location (keep original files for uploading).
-    handler = shutil.move
+    handler = transfer.move
     if not config.SHOULD_DELETE and not config.SHOULD_WIPE_CONTENT:
-        handler = shutil.copy if is_file else shutil.copytree
+        handler = transfer.copy
     new_path = os.path.join(config.DATA_PATH, os.path.basename(torrent_path))
-    logger.info('{} {} to {}'.format(handler.__name__, torrent_path, new_path))
+    # Resume an interrupted run from its last completed stage.
+    stage, journal_new_path = journal.get_torrent(torrent_path)
+    is_resumed = stage in (journal.TORRENT_MOVED, journal.TORRENT_EXTRACTED) and journal_new_path and \
+        os.path.exists(journal_new_path)
     try:
-        handler(torrent_path, new_path)
+        if is_resumed:
+            new_path = journal_new_path
+            is_file = os.path.isfile(new_path)
+            logger.info('Resuming {} from stage: {}'.format(new_path, stage))
+            if config.SHOULD_UPLOAD:
+                from pyexpander.upload import reclaim_staging_dirs
+                reclaim_staging_dirs(new_path)
+        else:
+            logger.info('{} {} to {}'.format(handler.__name__, torrent_path, new_path))
+            handler(torrent_path, new_path)
+            journal.set_torrent_stage(torrent_path, journal.TORRENT_MOVED, new_path)
+        # A single scan of the torrent, kept up to date by all following stages.
+        manifest = TorrentManifest.build(new_path)
+        torrent_metrics['bytes'] = sum(entry.size for entry in manifest.get_files())
+        # Small torrents shouldn't wait for big ones.
+        is_small = torrent_metrics['bytes'] <= config.SCHEDULER_SMALL_TORRENT_SIZE
+        scheduler.set_priority(scheduler.HIGH_PRIORITY if is_small else scheduler.NORMAL_PRIORITY)
         # Leave an empty file if requested, to avoid hit & runs.
-        if not config.SHOULD_DELETE and config.SHOULD_WIPE_CONTENT:
-            _recreate_empty_torrent(new_path, torrent_path, is_file=is_file)
+        if not is_resumed and not config.SHOULD_DELETE and config.SHOULD_WIPE_CONTENT:
+            _recreate_empty_torrent(manifest, torrent_path)
 
-        # Set relevant permissions.
+        # Set relevant permissions (hardlinked copies share their inodes with the original files, so they are skipped).
         if os.name != 'nt':
-            subprocess.check_output(['chmod', config.EXTRACTION_FILES_MASK, '-R', new_path])
+            is_linked = handler is transfer.copy and config.TRANSFER_ALLOW_HARDLINKS
+            manifest.apply_permissions(int(config.EXTRACTION_FILES_MASK, 8), should_skip_linked_files=is_linked)
         # Handle new path.
         if is_file:
-            process_file(new_path)
+            is_done = process_file(new_path)
         else:
-            extract_all(new_path)
+            # Extraction, subtitles and upload run as a pipeline, and cleanup waits for all of them.
+            should_extract = stage != journal.TORRENT_EXTRACTED
+            successful_files = process_torrent_directory(new_path, manifest, should_extract)
+            if should_extract:
+                journal.set_torrent_stage(torrent_path, journal.TORRENT_EXTRACTED)
             # Perform cleanup only if at least one file was processed successfully. Otherwise, there was a problem.
-            if process_directory(new_path) > 0:
+            is_done = successful_files > 0
+            if is_done:
                 cleanup(new_path)
+        # Unfinished torrents stay in the journal, so the next run resumes them.
+        if is_done:
+            journal.remove_torrent(torrent_path)
+            if is_file:
+                journal.remove_file(new_path)
+            else:
+                journal.remove_files(new_path)
     except OSError as ex:
         logger.exception('Failed to {} {}: {}'.format(handler.__name__, torrent_path, ex))
-    logger.info('Done!')
+    return is_done
 
 
 def expand_torrent_from_transmission():
@@ -95,35 +140,119 @@ def expand_torrent_from_transmission():
     expand_torrent(torrent_path)
 
 
+def _get_torrent_path_from_arguments():
+    """
+    Get the torrent path from the command line arguments, or from transmission if there are none.
+
+    :return: The torrent path to expand.
+    """
+    if len(sys.argv) == 3:
+        directory = sys.argv[1]
+        filename = sys.argv[2]
+        if directory == config.DEFAULT_PATH:
+            torrent_path = os.path.join(directory, filename)
+            logger.info('Input is a file: {}'.format(torrent_path))
+        else:
+            torrent_path = directory
+            logger.info('Input is a dir: {}'.format(torrent_path))
+        return torrent_path
+    elif len(sys.argv) == 2:
+        return sys.argv[1]
+    return get_environment_variables_from_transmission()
+
+
+def _configure_subtitles():
+    """
+    Set the subliminal cache, if subtitles are needed.
+    """
+    if config.SHOULD_FIND_SUBTITLES:
+        logger.debug('Setting subtitles cache...')
+        # Subliminal is heavy, so it is only imported when subtitles are needed.
+        from pyexpander.subtitles import configure_subtitles_cache
+        configure_subtitles_cache()
+
+
+def _backfill_subtitles():
+    """
+    Search the missing subtitles of the uploaded videos in the subtitles backlog (those that are due).
+    """
+    if config.SHOULD_UPLOAD and config.SHOULD_FIND_SUBTITLES and backlog.is_enabled():
+        from pyexpander.postprocess import backfill_subtitles
+        try:
+            uploaded_subtitles = backfill_subtitles()
+        except Exception:
+            # The backlog is tried again on the next run.
+            logger.exception('Failed to backfill subtitles!')
+            return
+        if uploaded_subtitles:
+            logger.info('Uploaded {} backfilled subtitles'.format(uploaded_subtitles))
+
+
+def _drain_deferred_uploads():
+    """
+    Upload the deferred files whose quota window has passed.
+    """
+    # Guessit is only imported when there is something to upload.
+    if config.SHOULD_UPLOAD and deferred.get_due_uploads():
+        from pyexpander.upload import drain_deferred_uploads
+        try:
+            uploaded_files = drain_deferred_uploads()
+        except Exception:
+            # The deferred files are tried again on the next run.
+            logger.exception('Failed to upload deferred files!')
+            return
+        if uploaded_files:
+            logger.info('Uploaded {} deferred files'.format(uploaded_files))
+
+
+def _run_periodic_tasks():
+    """
+    Run the periodic maintenance tasks: upload deferred files whose quota window has passed,
+    and search the missing subtitles of the subtitles backlog.
+    """
+    _drain_deferred_uploads()
+    _backfill_subtitles()
+
+
 def main():
     """
     This function is designed to be called from command line.
+    If '--daemon' is provided, the script will run as a daemon and expand torrents sent to it.
+    If '--drain-deferred' is provided, deferred uploads whose quota window has passed are uploaded.
+    If '--backfill' is provided, the missing subtitles of the subtitles backlog videos are searched.
+    If '--import-history' is provided, the original names log (or the given log) is imported to the upload history.
     If an argument (either as the full path, or as a base dir and a file) is provided,
     the script will try to expand it.
     Else, we assume transmission is calling the script.
+    If a daemon is enabled and running, the torrent is forwarded to it instead.
+    Otherwise, the due deferred uploads and backlog subtitles are handled after the torrent (like the daemon timer).
     """
     with logbook.NestedSetup(_get_log_handlers()).applicationbound():
         logger.info('Py-expander started!')
         try:
-            # Set subliminal cache first.
-            if config.SHOULD_FIND_SUBTITLES:
-                logger.debug('Setting subtitles cache...')
-                configure_subtitles_cache()
+            if sys.argv[1:] == ['--daemon']:
+                _configure_subtitles()
+                serve(expand_torrent, _run_periodic_tasks)
+                return
+            if sys.argv[1:] == ['--drain-deferred']:
+                _drain_deferred_uploads()
+                return
+            if sys.argv[1:] == ['--backfill']:
+                _configure_subtitles()
+                _backfill_subtitles()
+                return
+            if sys.argv[1:2] == ['--import-history']:
+                history.import_original_names_log(sys.argv[2] if len(sys.argv) > 2 else config.ORIGINAL_NAMES_LOG)
+                return
             # Parse input arguments.
-            if len(sys.argv) == 3:
-                directory = sys.argv[1]
-                filename = sys.argv[2]
-                if directory == config.DEFAULT_PATH:
-                    torrent_path = os.path.join(directory, filename)
-                    logger.info('Input is a file: {}'.format(torrent_path))
-                else:
-                    torrent_path = directory
-                    logger.info('Input is a dir: {}'.format(torrent_path))
-                expand_torrent(torrent_path)
-            elif len(sys.argv) == 2:
-                expand_torrent(sys.argv[1])
-            else:
-                expand_torrent_from_transmission()
+            torrent_path = _get_torrent_path_from_arguments()
+            if config.SHOULD_USE_DAEMON and send_torrent(torrent_path):
+                logger.info('Torrent {} was sent to the daemon'.format(torrent_path))
+                return
+            _configure_subtitles()
+            expand_torrent(torrent_path)
+            # Without a daemon timer, whatever is due (deferred uploads, backlog subtitles) runs after each torrent.
+            _run_periodic_tasks()
         except:
             logger.exception('Critical exception occurred!')
             raise
@@ -0,0 +1,244 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+from collections import Counter
+
+import logbook
+
+from . import config, fingerprint
+from .utils import is_wanted_file
+
+# The Linux FICLONE ioctl request (clone a whole file, as in 'cp --reflink').
+FICLONE = 0x40049409
+# Errors meaning the fast path is not supported here, so the next strategy should be tried.
+UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM,
+                      errno.EBADF, errno.ETXTBSY}
+
+logger = logbook.Logger('transfer')
+
+
+def _is_unsupported(ex):
+    """
+    Check whether the given error means a strategy is not supported for the given files.
+
+    :param ex: The raised OSError.
+    :return: True if the next strategy should be tried, and False otherwise.
+    """
+    return ex.errno in UNSUPPORTED_ERRORS
+
+
+def _reflink(source, destination):
+    """
+    Clone the source file into the destination file (copy-on-write, no data is copied).
+
+    :param source: The source file path.
+    :param destination: The destination file path.
+    """
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            destination_file.close()
+            os.remove(destination)
+            raise
+
+
+def _kernel_copy(source, destination):
+    """
+    Copy the source file into the destination file inside the kernel, using large chunks.
+    copy_file_range is tried first, then sendfile, and finally a regular buffered copy.
+
+    :param source: The source file path.
+    :param destination: The destination file path.
+    :return: The name of the strategy that was used.
+    """
+    chunk_size = config.TRANSFER_CHUNK_SIZE
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        size = os.fstat(source_fd).st_size
+        for strategy in ('copy_file_range', 'sendfile'):
+            copy_function = getattr(os, strategy, None)
+            if copy_function is None:
+                continue
+            offset = 0
+            try:
+                while offset < size:
+                    if strategy == 'copy_file_range':
+                        copied = copy_function(source_fd, destination_fd, chunk_size)
+                    else:
+                        copied = copy_function(destination_fd, source_fd, offset, chunk_size)
+                    if copied == 0:
+                        break
+                    offset += copied
+                return strategy
+            except OSError as ex:
+                # Only fall back if nothing was written yet.
+                if offset > 0 or not _is_unsupported(ex):
+                    raise
+        shutil.copyfileobj(source_file, destination_file, chunk_size)
+        return 'buffered copy'
+
+
+def _hashing_copy(source, destination):
+    """
+    Copy the source file into the destination file, computing its MD5 from the copied data on the way.
+    The data is read once anyway, so checksums don't need another read later.
+
+    :param source: The source file path.
+    :param destination: The destination file path.
+    :return: The MD5 hex digest.
+    """
+    md5 = hashlib.md5()
+    buffer = memoryview(bytearray(config.TRANSFER_CHUNK_SIZE))
+    with open(source, 'rb', buffering=0) as source_file, open(destination, 'wb', buffering=0) as destination_file:
+        while True:
+            read_size = source_file.readinto(buffer)
+            if not read_size:
+                break
+            md5.update(buffer[:read_size])
+            written_size = 0
+            while written_size < read_size:
+                written_size += destination_file.write(buffer[written_size:read_size])
+    return md5.hexdigest()
+
+
+def _should_compute_checksum(file_path):
+    """
+    Check whether the MD5 of the given file should be computed while it is copied.
+    Only plain uploads compare MD5 checksums with the remote (Drive hashes the encrypted data otherwise), so in any
+    other case the kernel copy is cheaper.
+
+    :param file_path: The copied file path.
+    :return: True if the MD5 should be computed, and False otherwise.
+    """
+    return config.TRANSFER_COMPUTE_CHECKSUMS and config.SHOULD_UPLOAD and config.SHOULD_VERIFY_UPLOADS and \
+        not config.SHOULD_ENCRYPT and is_wanted_file(file_path)
+
+
+def _copy_file(source, destination, allow_hardlink):
+    """
+    Copy a single file using the cheapest available strategy.
+
+    :param source: The source file path.
+    :param destination: The destination file path.
+    :param allow_hardlink: Whether the destination may share the source inode.
+    :return: The name of the strategy that was used.
+    """
+    if allow_hardlink:
+        try:
+            os.link(source, destination)
+            return 'hardlink'
+        except OSError as ex:
+            if not _is_unsupported(ex) and ex.errno != errno.EMLINK:
+                raise
+    md5 = None
+    try:
+        _reflink(source, destination)
+        strategy = 'reflink'
+    except OSError as ex:
+        if not _is_unsupported(ex):
+            raise
+        if _should_compute_checksum(source):
+            md5 = _hashing_copy(source, destination)
+            strategy = 'hashing copy'
+        else:
+            strategy = _kernel_copy(source, destination)
+    # Keep the modification time as well (like shutil.move does), since rclone compares it.
+    shutil.copystat(source, destination)
+    if md5:
+        fingerprint.add_md5(destination, md5)
+    elif strategy == 'reflink':
+        fingerprint.link(source, destination)
+    return strategy
+
+
+def _copy_tree(source, destination, allow_hardlink, strategies):
+    """
+    Copy a directory tree, file by file.
+
+    :param source: The source directory path.
+    :param destination: The destination directory path.
+    :param allow_hardlink: Whether the destination files may share the source inodes.
+    :param strategies: A counter of the used strategies (updated in place).
+    """
+    for dir_path, _, file_names in os.walk(source):
+        destination_dir = os.path.join(destination, os.path.relpath(dir_path, source))
+        os.makedirs(destination_dir, exist_ok=True)
+        shutil.copymode(dir_path, destination_dir)
+        for file_name in file_names:
+            strategies[_copy_file(os.path.join(dir_path, file_name), os.path.join(destination_dir, file_name),
+                                  allow_hardlink)] += 1
+
+
+def _get_size(path):
+    """
+    Get the total size of the given file or directory.
+
+    :param path: The path.
+    :return: The size in bytes.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(dir_path, file_name))
+               for dir_path, _, file_names in os.walk(path) for file_name in file_names)
+
+
+def _transfer(source, destination, should_remove_source, allow_hardlink):
+    """
+    Transfer the given file or directory using the cheapest available strategy, and log it.
+
+    :param source: The source path.
+    :param destination: The destination path.
+    :param should_remove_source: True to move the source, and False to copy it.
+    :param allow_hardlink: Whether copied files may share the source inodes.
+    """
+    start_time = time.monotonic()
+    strategies = Counter()
+    size = _get_size(source)
+    renamed = False
+    if should_remove_source:
+        try:
+            os.rename(source, destination)
+            strategies['rename'] += 1
+            renamed = True
+        except OSError as ex:
+            if ex.errno != errno.EXDEV:
+                raise
+    if not renamed:
+        if os.path.isdir(source):
+            _copy_tree(source, destination, allow_hardlink, strategies)
+            if should_remove_source:
+                shutil.rmtree(source)
+        else:
+            strategies[_copy_file(source, destination, allow_hardlink)] += 1
+            if should_remove_source:
+                os.remove(source)
+    elapsed_time = time.monotonic() - start_time
+    logger.info('Transferred {} to {} ({:.1f} MB) using {} in {:.2f} seconds ({:.1f} MB/s)'.format(
+        source, destination, size / 1024 / 1024, dict(strategies), elapsed_time,
+        size / 1024 / 1024 / elapsed_time if elapsed_time > 0 else 0))
+
+
+def move(source, destination):
+    """
+    Move the given file or directory (rename if possible, otherwise copy and delete).
+
+    :param source: The source path.
+    :param destination: The destination path.
+    """
+    _transfer(source, destination, should_remove_source=True, allow_hardlink=False)
+
+
+def copy(source, destination):
+    """
+    Copy the given file or directory, keeping the source intact.
+    Hardlinks are only used when config.TRANSFER_ALLOW_HARDLINKS is set, since the copy then shares the source inodes.
+
+    :param source: The source path.
+    :param destination: The destination path.
+    """
+    _transfer(source, destination, should_remove_source=False, allow_hardlink=config.TRANSFER_ALLOW_HARDLINKS)
@@ -1,18 +1,55 @@
+import json
 import os
+import re
 import subprocess
 import shutil
 import random
 import string
+import tempfile
+import time
 
 import logbook
 from guessit import guessit
 from showsformatter import format_show
 
-from . import config
+from . import backlog, config, deferred, fingerprint, history, journal, metrics, remote, scheduler, transfer
+from .cache import get_cache, get_statistics
+
+# The guessit properties used for building cloud paths.
+GUESSIT_PROPERTIES = ['type', 'title', 'season', 'episode', 'year']
+# The supported encryption backends (see config.ENCRYPTION_BACKEND).
+ENCRYPTION_BACKENDS = ['encfs', 'crypt']
+# Upload error classes, from the most severe.
+QUOTA_EXHAUSTED = 'quota exhausted'
+FATAL = 'fatal'
+RATE_LIMITED = 'rate limited'
+TRANSIENT = 'transient'
+ERROR_CLASSES = [QUOTA_EXHAUSTED, FATAL, RATE_LIMITED, TRANSIENT]
+# Error message patterns of each class (anything else is considered transient).
+ERROR_PATTERNS = [
+    (QUOTA_EXHAUSTED, re.compile(r'uploadLimitExceeded|dailyLimitExceeded|storageQuotaExceeded|quotaExceeded|'
+                                 r'upload limit exceeded|max transfer limit reached', re.IGNORECASE)),
+    (FATAL, re.compile(r'invalid_grant|unauthorized|Error 401|didn\'t find section in config|'
+                       r'permission denied|no such file or directory', re.IGNORECASE)),
+    (RATE_LIMITED, re.compile(r'rateLimitExceeded|Error 429|too many requests', re.IGNORECASE))
+]
 
 logger = logbook.Logger('uploader')
 
+# Uploads are deferred without trying until this time, once the upload quota was exhausted.
+_quota_exhausted_until = 0
 
+
+def _uses_encfs():
+    """
+    Check whether files are encrypted by an encfs mount (rather than in-stream, by an rclone crypt remote).
+
+    :return: True if an encfs mount is needed, and False otherwise.
+    """
+    return config.SHOULD_ENCRYPT and config.ENCRYPTION_BACKEND == 'encfs'
+
+
+@metrics.measure('encrypt')
 def _encrypt(encrypted_dir, plain_dir):
     """
     Encrypt the given plain directory.
@@ -27,8 +64,8 @@ def _encrypt(encrypted_dir, plain_dir):
         logger.info('{} environment variable is not defined. Defining: {}'.format(
             config.ENCFS_ENVIRONMENT_VARIABLE, config.ENCFS_CONFIG_PATH))
         os.environ[config.ENCFS_ENVIRONMENT_VARIABLE] = config.ENCFS_CONFIG_PATH
-    # Encrypt!
-    os.makedirs(encrypted_dir)
+    # Encrypt! (the encrypted directory already exists when remounting a previous staging tree).
+    os.makedirs(encrypted_dir, exist_ok=True)
     return_code = subprocess.call('echo {} | {} -S "{}" "{}"'.format(
         config.ENCFS_PASSWORD, config.ENCFS_PATH, encrypted_dir, plain_dir), shell=True)
     if return_code != 0:
@@ -37,6 +74,20 @@ def _encrypt(encrypted_dir, plain_dir):
     return True
 
 
+def _guessit(file_name):
+    """
+    Run guessit on the given file name, using the memoization cache.
+
+    :param file_name: The file name to guess on.
+    :return: A dict of the guessed properties we use.
+    """
+    def compute():
+        guess_results = guessit(file_name)
+        return {key: guess_results[key] for key in GUESSIT_PROPERTIES if key in guess_results}
+
+    return get_cache('guessit').get_or_compute(file_name.strip(), compute)
+
+
 def _extract_ufc_path(file_name):
     """
     Extract UFC cloud dir and cloud file name from the given file name.
@@ -44,7 +95,7 @@ def _extract_ufc_path(file_name):
     :param file_name: The file name to extract data from.
     :return: A tuple of format (cloud_dir, cloud_file)
     """
-    guess_results = guessit(file_name)
+    guess_results = _guessit(file_name)
 
     # Get real episode number.
     episode_num = guess_results.get('episode')
@@ -85,7 +136,20 @@ def _extract_masterclass_path(file_name):
     return cloud_dir, cloud_file
 
 
+@metrics.measure('guess_path')
 def _guess_path(file_name):
+    """
+    Guess cloud dir and cloud file name from the given file name, using the memoization cache.
+
+    :param file_name: The file name to guess on.
+    :return: A tuple of format (cloud_dir, cloud_file)
+    """
+    # Cloud paths depend on the cloud directories settings as well.
+    key = json.dumps([file_name.strip(), config.CLOUD_TV_PATH, config.CLOUD_MOVIES_PATH])
+    return tuple(get_cache('cloud_path').get_or_compute(key, lambda: _compute_guess_path(file_name)))
+
+
+def _compute_guess_path(file_name):
     """
     Guess cloud dir and cloud file name from the given file name.
 
@@ -95,7 +159,7 @@ def _guess_path(file_name):
     cloud_dir = None
     cloud_file = None
     # Start guessing!
-    guess_results = guessit(file_name)
+    guess_results = _guessit(file_name)
     video_type = guess_results.get('type')
     title = guess_results.get('title')
     if isinstance(title, list):
@@ -126,30 +190,29 @@ def _guess_path(file_name):
     return cloud_dir, cloud_file
 
 
-def upload_file(file_path):
+def _get_cloud_path(file_path):
     """
-    Upload the given file to its proper Google Drive directory.
+    Get the cloud dir and cloud file name for the given file.
 
-    :param: file_path: The file to upload.
-    :return: True if the file was upload successfully, and False otherwise.
+    :param file_path: The file to upload.
+    :return: A tuple of format (cloud_dir, cloud_file, is_subtitles), or None if the file shouldn't be uploaded.
     """
-    logger.info('Uploading file: {}'.format(file_path))
     fixed_file_path = file_path
     file_parts = os.path.splitext(file_path)
 
     # Verify file name.
     if len(file_parts) != 2:
         logger.info('File has no extension! Skipping...')
-        return False
+        return None
     file_name, file_extension = file_parts
     file_extension = file_extension.lower()
     if file_extension not in config.EXTENSIONS_WHITE_LIST:
         logger.info('File extension is not in white list! Skipping...')
-        return False
+        return None
     for black_list_word in config.NAMES_BLACK_LIST:
         if black_list_word in file_name.lower():
             logger.info('File name contains a black listed word ({})! Skipping...'.format(black_list_word))
-            return False
+            return None
     language_extension = None
     is_subtitles = file_extension in config.SUBTITLES_EXTENSIONS
 
@@ -183,81 +246,689 @@ def upload_file(file_path):
     else:
         cloud_dir, cloud_file = _guess_path(fixed_file_name)
 
-    if cloud_dir and cloud_file:
-        if is_kids:
-            cloud_dir = cloud_dir.replace(config.CLOUD_MOVIES_PATH, config.CLOUD_KIDS_MOVIES_PATH, 1).replace(config.CLOUD_TV_PATH, config.CLOUD_KIDS_TV_PATH, 1)
-            cloud_file += ' - Hebrew'
-        if language_extension:
-            cloud_file += language_extension
-
-        cloud_file += file_extension
-        logger.info('Cloud path: {}'.format(os.path.join(cloud_dir, cloud_file)))
-        # Create a temporary random cloud dir structure.
-        original_dir = os.path.dirname(file_path)
-        random_dir_name = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
-        base_dir = os.path.join(original_dir, random_dir_name)
-        plain_base_dir = os.path.join(base_dir, config.CLOUD_PLAIN_PATH)
-        os.makedirs(plain_base_dir)
+    if not cloud_dir or not cloud_file:
+        logger.info('Couldn\'t guess file info. Skipping...')
+        return None
+    if is_kids:
+        cloud_dir = cloud_dir.replace(config.CLOUD_MOVIES_PATH, config.CLOUD_KIDS_MOVIES_PATH, 1).replace(config.CLOUD_TV_PATH, config.CLOUD_KIDS_TV_PATH, 1)
+        cloud_file += ' - Hebrew'
+    if language_extension:
+        cloud_file += language_extension
+    cloud_file += file_extension
+    return cloud_dir, cloud_file, is_subtitles
+
+
+def _list_inodes(directory):
+    """
+    List all files under the given directory by their inode numbers.
+
+    :param directory: The directory to list.
+    :return: A dict mapping each inode number to its file path, relative to the given directory.
+    """
+    return {os.stat(os.path.join(dir_path, file_name)).st_ino:
+            os.path.relpath(os.path.join(dir_path, file_name), directory)
+            for dir_path, _, file_names in os.walk(directory) for file_name in file_names}
+
+
+def _stage_files(items, base_dir, plain_base_dir, upload_base_dir):
+    """
+    Move the given files into the staging tree, under their cloud paths.
+
+    :param items: A list of tuples of format (file_path, cloud_dir, cloud_file).
+    :param base_dir: The staging tree root.
+    :param plain_base_dir: The plain staging directory.
+    :param upload_base_dir: The directory that will be uploaded (plain or encrypted).
+    :return: A dict mapping each staged file path to its path inside the upload directory.
+    """
+    upload_paths = {}
+    for file_path, cloud_dir, cloud_file in items:
         cloud_temp_path = os.path.join(plain_base_dir, cloud_dir)
         final_file_path = os.path.join(cloud_temp_path, cloud_file)
-        # Use the plain directory when uploading, unless encryption is enabled.
-        upload_base_dir = plain_base_dir
-        # Set up encryption if needed.
-        if config.SHOULD_ENCRYPT:
-            encrypted_base_dir = os.path.join(base_dir, config.CLOUD_ENCRYPTED_PATH)
-            encryption_successful = _encrypt(encrypted_base_dir, plain_base_dir)
-            if not encryption_successful:
-                # Delete directories and stop.
-                shutil.rmtree(base_dir)
-                return False
-            # Upload the encrypted directory tree instead of the plain one.
-            upload_base_dir = encrypted_base_dir
-        gdrive_dir = upload_base_dir.split(base_dir)[1].strip(os.path.sep)
-        logger.info('Moving file to temporary path: {}'.format(cloud_temp_path))
-        os.makedirs(cloud_temp_path)
-        shutil.move(file_path, cloud_temp_path)
-        os.rename(os.path.join(cloud_temp_path, os.path.basename(file_path)), final_file_path)
+        logger.info('Moving file {} to temporary path: {}'.format(file_path, cloud_temp_path))
+        os.makedirs(cloud_temp_path, exist_ok=True)
+        transfer.move(file_path, final_file_path)
+        upload_paths[file_path] = os.path.join(cloud_dir, cloud_file)
+        journal.set_file_stage(file_path, journal.FILE_STAGED, staging_dir=base_dir, location=final_file_path)
+    if upload_base_dir != plain_base_dir:
+        # Encrypted names are only known once encfs writes the files. Encfs passes the inode numbers of the
+        # encrypted files through, so a single walk of the encrypted tree finds all of them.
+        encrypted_paths = _list_inodes(upload_base_dir)
+        upload_paths = {file_path: encrypted_paths.get(os.stat(os.path.join(plain_base_dir, upload_path)).st_ino)
+                        for file_path, upload_path in upload_paths.items()}
+    return upload_paths
+
+
+def _unmount(plain_base_dir):
+    """
+    Unmount the ENCFS plain directory.
 
-        # Upload!
-        upload_tries = 0
-        return_code = 1
-        while return_code != 0 and upload_tries < config.MAX_UPLOAD_TRIES:
-            logger.info('Uploading file...')
-            upload_tries += 1
+    :param plain_base_dir: The plain directory to unmount.
+    """
+    subprocess.call('{} -u "{}"'.format(config.FUSERMOUNT_PATH, plain_base_dir), shell=True)
+
+
+def _log_original_name(file_path):
+    """
+    Add the given file path to the original names log.
+
+    :param file_path: The original file path.
+    """
+    open(config.ORIGINAL_NAMES_LOG, 'a', encoding='UTF-8').write(file_path + '\n')
+    journal.set_file_stage(file_path, journal.FILE_LOGGED)
+
+
+def reclaim_staging_dirs(path):
+    """
+    Reclaim staging directories left behind by an interrupted run of the given torrent.
+    Staged files are moved back to their original paths (so they are uploaded again),
+    and uploaded files that weren't logged yet are added to the original names log.
+
+    :param path: The torrent path (in the data directory).
+    """
+    for base_dir, staged_files in journal.get_staging_dirs(path):
+        logger.info('Reclaiming staging directory {}'.format(base_dir))
+        plain_base_dir = os.path.join(base_dir, config.CLOUD_PLAIN_PATH)
+        if os.path.isdir(base_dir):
+            is_mounted = False
+            if _uses_encfs() and any(stage == journal.FILE_STAGED for _, stage, _ in staged_files):
+                # The old mount died with its process, so mount the encrypted tree again to get the plain files.
+                _unmount(plain_base_dir)
+                is_mounted = _encrypt(os.path.join(base_dir, config.CLOUD_ENCRYPTED_PATH), plain_base_dir)
+            for file_path, stage, staged_path in staged_files:
+                if stage == journal.FILE_STAGED and staged_path and os.path.isfile(staged_path):
+                    logger.info('Moving {} back to {}'.format(staged_path, file_path))
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    transfer.move(staged_path, file_path)
+                    journal.remove_file(file_path)
+                elif stage == journal.FILE_UPLOADED and \
+                        os.path.splitext(staged_path or '')[1] not in config.SUBTITLES_EXTENSIONS:
+                    _log_original_name(file_path)
+            if is_mounted:
+                _unmount(plain_base_dir)
+            shutil.rmtree(base_dir)
+        journal.remove_staging_dir(base_dir)
+
+
+def _classify_error(message):
+    """
+    Classify an rclone error message.
+
+    :param message: The error message.
+    :return: One of the error classes (QUOTA_EXHAUSTED, FATAL, RATE_LIMITED or TRANSIENT).
+    """
+    for error_class, pattern in ERROR_PATTERNS:
+        if pattern.search(message):
+            return error_class
+    return TRANSIENT
+
+
+def _parse_errors(rclone_output):
+    """
+    Find the errors of an rclone run, according to its JSON log.
+
+    :param rclone_output: The rclone output (with --use-json-log).
+    :return: A tuple of format (failed_objects, error_class), where failed_objects maps each failed object path
+             (relative to the transferred directory) to its error class, and error_class is the most severe class.
+    """
+    failed_objects = {}
+    error_classes = set()
+    for line in rclone_output.splitlines():
+        try:
+            log_record = json.loads(line)
+        except ValueError:
+            # Some errors (bad config, etc.) are written before JSON logging starts.
+            log_record = {'level': 'error', 'msg': line} if 'error' in line.lower() else None
+        if not isinstance(log_record, dict) or log_record.get('level') not in ('error', 'critical'):
+            continue
+        error_class = _classify_error(str(log_record.get('msg', '')))
+        error_classes.add(error_class)
+        if log_record.get('object'):
+            # An object may fail several times, keep its most severe error.
+            failed_objects[log_record['object']] = min(
+                error_class, failed_objects.get(log_record['object'], error_class), key=ERROR_CLASSES.index)
+    error_class = min(error_classes, key=ERROR_CLASSES.index) if error_classes else TRANSIENT
+    return failed_objects, error_class
+
+
+def _get_backoff_delay(error_class, upload_tries):
+    """
+    Get the delay before the next upload try: exponential backoff with full jitter.
+
+    :param error_class: The error class of the last try.
+    :param upload_tries: The number of tries so far.
+    :return: The delay in seconds.
+    """
+    base_delay = config.UPLOAD_RATE_LIMIT_BACKOFF if error_class == RATE_LIMITED else config.UPLOAD_BACKOFF
+    return random.uniform(0, min(config.UPLOAD_MAX_BACKOFF, base_delay * 2 ** (upload_tries - 1)))
+
+
+def _is_already_uploaded(remote_path, upload_base_dir, upload_path):
+    """
+    Check whether the given staged file is already on the remote, according to the remote listing cache.
+    The file is considered identical like rclone's --update does: same size, and the remote copy is not older.
+
+    :param remote_path: The remote root path.
+    :param upload_base_dir: The directory that will be uploaded.
+    :param upload_path: The file path, relative to the uploaded directory.
+    :return: True if the file doesn't need to be uploaded, and False otherwise.
+    """
+    remote_file = remote.get_file(remote_path, upload_path)
+    if not remote_file:
+        return False
+    remote_size, remote_modified = remote_file
+    file_stat = os.stat(os.path.join(upload_base_dir, upload_path))
+    # Remote modification times may be rounded (to milliseconds on Google Drive).
+    return remote_size == file_stat.st_size and remote_modified >= int(file_stat.st_mtime)
 
+
+def _write_files_list(upload_paths):
+    """
+    Write the given paths to a temporary files list, for rclone's --files-from-raw.
+
+    :param upload_paths: The file paths (relative to the transferred directory).
+    :return: The list file path (to be removed by the caller).
+    """
+    # Raw file lists are read verbatim (no comments or escaping), so any file name is safe.
+    with tempfile.NamedTemporaryFile('w', encoding='UTF-8', suffix='.lst', delete=False) as list_file:
+        list_file.write(''.join(upload_path + '\n' for upload_path in upload_paths))
+    return list_file.name
+
+
+def _upload_directory(upload_base_dir, remote_path, upload_paths=None, should_overwrite=False):
+    """
+    Upload the given directory tree with a single rclone process, retrying if needed.
+
+    :param upload_base_dir: The directory to upload.
+    :param remote_path: The remote path to upload to (for example 'GDrive:Media').
+    :param upload_paths: The files to upload (relative to the directory), or None for the whole directory.
+                         When given, rclone only looks up these files instead of listing the remote directories.
+    :param should_overwrite: True to upload the files even if the remote has them with the same size and time.
+    :return: A tuple of format (return_code, failed_objects, error_class), see _run_upload.
+    """
+    filter_arguments = '--ignore-times ' if should_overwrite else ''
+    if upload_paths is not None:
+        list_file_path = _write_files_list(upload_paths)
+        filter_arguments += f'--files-from-raw "{list_file_path}" --no-traverse '
+    if upload_paths is None:
+        size = sum(os.path.getsize(os.path.join(dir_path, file_name))
+                   for dir_path, _, file_names in os.walk(upload_base_dir) for file_name in file_names)
+    else:
+        size = sum(os.path.getsize(os.path.join(upload_base_dir, upload_path)) for upload_path in upload_paths)
+    try:
+        with metrics.measure('upload', size):
+            return _run_upload(upload_base_dir, remote_path, filter_arguments)
+    finally:
+        if upload_paths is not None:
+            os.remove(list_file_path)
+
+
+def _list_uploaded_files(remote_path, upload_paths):
+    """
+    Get the remote sizes and MD5 checksums of the given files, with a single rclone call (no directory listing).
+
+    :param remote_path: The remote root path.
+    :param upload_paths: The file paths (relative to the remote root).
+    :return: A dict mapping each found path to a tuple of format (size, md5 or None), or None if the call failed.
+    """
+    list_file_path = _write_files_list(upload_paths)
+    # Crypt remotes have no hashes (Drive hashes the encrypted data).
+    hash_argument = '' if config.SHOULD_ENCRYPT and config.ENCRYPTION_BACKEND == 'crypt' else '--hash '
+    try:
+        process_result = subprocess.run(
+            f'{config.RCLONE_PATH} --config {config.RCLONE_CONFIG_PATH} lsjson --files-only --recursive '
+            f'{hash_argument}--files-from-raw "{list_file_path}" "{remote_path}"', shell=True, text=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    finally:
+        os.remove(list_file_path)
+    if process_result.returncode != 0:
+        logger.error(f'Failed to list uploaded files ({process_result.returncode}): {process_result.stderr}')
+        return None
+    return {entry['Path']: (entry['Size'], (entry.get('Hashes') or {}).get('md5'))
+            for entry in json.loads(process_result.stdout)}
+
+
+def _has_remote_copy(previous_upload):
+    """
+    Check whether the remote still has the file of a past upload (with the same size), with a single rclone call.
+
+    :param previous_upload: The past upload, as returned by history.find_upload.
+    :return: True if the remote has the file, and False otherwise (or if its remote location is unknown).
+    """
+    remote_path, upload_path, upload_size = previous_upload[4:]
+    if not upload_path:
+        return False
+    remote_files = _list_uploaded_files(remote_path, [upload_path]) or {}
+    return remote_files.get(upload_path, (None,))[0] == upload_size
+
+
+def _find_crypt_mismatches(upload_base_dir, remote_path, upload_paths):
+    """
+    Compare the checksums of the given files with their copies on the crypt remote, with a single rclone cryptcheck
+    call (the local files are encrypted with the nonces of their remote copies, and hashed like Drive does).
+
+    :param upload_base_dir: The uploaded (plain) directory.
+    :param remote_path: The crypt remote root path.
+    :param upload_paths: The file paths (relative to the directory).
+    :return: The set of mismatched (or missing) paths, or None if the check failed.
+    """
+    list_file_path = _write_files_list(upload_paths)
+    try:
+        process_result = subprocess.run(
+            f'{config.RCLONE_PATH} --config {config.RCLONE_CONFIG_PATH} cryptcheck --one-way --combined - '
+            f'--files-from-raw "{list_file_path}" "{upload_base_dir}" "{remote_path}"', shell=True, text=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    finally:
+        os.remove(list_file_path)
+    # Each checked file gets a report line ('= path' if it matches), and differences fail the call as well.
+    report = [line.split(' ', 1) for line in process_result.stdout.splitlines() if ' ' in line]
+    if not report and process_result.returncode != 0:
+        logger.error(f'Failed to check uploaded files ({process_result.returncode}): {process_result.stderr}')
+        return None
+    return {path for symbol, path in report if symbol != '='}
+
+
+@metrics.measure('verify')
+def _find_mismatched_uploads(upload_base_dir, remote_path, upload_paths):
+    """
+    Compare the given uploaded files with their remote copies.
+    Sizes are always compared. Checksums are compared as well, except with encfs:
+    - Plain uploads: the MD5 checksums that were computed while the files were copied (files that were moved or
+      linked aren't read again just for verifying them, so only their sizes are compared).
+    - Crypt uploads: rclone cryptcheck, which reads the local files again.
+    - Encfs uploads: sizes only, since Drive hashes the encrypted files (which encfs writes without hashing them).
+
+    :param upload_base_dir: The uploaded directory.
+    :param remote_path: The remote root path.
+    :param upload_paths: The file paths (relative to the directory).
+    :return: The set of mismatched (or missing) paths.
+    """
+    remote_files = _list_uploaded_files(remote_path, upload_paths)
+    if remote_files is None:
+        # Nothing can be verified, so rclone's result is trusted.
+        return set()
+    mismatched_paths = set()
+    for upload_path in upload_paths:
+        local_path = os.path.join(upload_base_dir, upload_path)
+        local_md5 = fingerprint.find_md5(local_path)
+        remote_file = remote_files.get(upload_path)
+        if remote_file is None:
+            logger.error('{} is missing from the remote'.format(upload_path))
+            mismatched_paths.add(upload_path)
+        elif remote_file[0] != os.path.getsize(local_path):
+            logger.error('{} size mismatch: {} locally, {} remotely'.format(
+                upload_path, os.path.getsize(local_path), remote_file[0]))
+            mismatched_paths.add(upload_path)
+        elif remote_file[1] and local_md5 and remote_file[1] != local_md5:
+            logger.error('{} checksum mismatch: {} locally, {} remotely'.format(upload_path, local_md5, remote_file[1]))
+            mismatched_paths.add(upload_path)
+    checked_paths = [upload_path for upload_path in upload_paths if upload_path not in mismatched_paths]
+    if config.SHOULD_ENCRYPT and config.ENCRYPTION_BACKEND == 'crypt' and checked_paths:
+        for upload_path in sorted(_find_crypt_mismatches(upload_base_dir, remote_path, checked_paths) or ()):
+            logger.error('{} checksum mismatch (cryptcheck)'.format(upload_path))
+            mismatched_paths.add(upload_path)
+    return mismatched_paths
+
+
+def _verify_uploads(upload_base_dir, remote_path, upload_paths):
+    """
+    Verify the given uploaded files, uploading mismatched files again (up to config.UPLOAD_VERIFY_TRIES times).
+    Files that still don't match are removed from the remote, so the next upload doesn't skip them.
+
+    :param upload_base_dir: The uploaded directory.
+    :param remote_path: The remote root path.
+    :param upload_paths: The file paths (relative to the directory).
+    :return: The set of paths that still don't match.
+    """
+    mismatched_paths = _find_mismatched_uploads(upload_base_dir, remote_path, upload_paths)
+    verify_tries = 0
+    while mismatched_paths and verify_tries < config.UPLOAD_VERIFY_TRIES:
+        verify_tries += 1
+        logger.warning('{} files don\'t match their remote copies. Uploading them again...'.format(
+            len(mismatched_paths)))
+        metrics.add('verify', retries=1)
+        _upload_directory(upload_base_dir, remote_path, sorted(mismatched_paths), should_overwrite=True)
+        mismatched_paths = _find_mismatched_uploads(upload_base_dir, remote_path, sorted(mismatched_paths))
+    if mismatched_paths:
+        logger.error('{} files still don\'t match their remote copies. Removing them...'.format(len(mismatched_paths)))
+        list_file_path = _write_files_list(sorted(mismatched_paths))
+        try:
+            subprocess.run(f'{config.RCLONE_PATH} --config {config.RCLONE_CONFIG_PATH} delete '
+                           f'--files-from-raw "{list_file_path}" "{remote_path}"', shell=True, check=False)
+        finally:
+            os.remove(list_file_path)
+    return mismatched_paths
+
+
+def _run_upload(upload_base_dir, remote_path, filter_arguments):
+    """
+    Run rclone for uploading the given directory tree, retrying if needed.
+
+    :param upload_base_dir: The directory to upload.
+    :param remote_path: The remote path to upload to (for example 'GDrive:Media').
+    :param filter_arguments: Extra rclone arguments for choosing the uploaded files.
+    :return: A tuple of format (return_code, failed_objects, error_class), where failed_objects maps each failed
+             object path to its error class, and error_class is the most severe class of the last try (or None).
+    """
+    upload_tries = 0
+    return_code = 1
+    failed_objects = {}
+    error_class = None
+    while return_code != 0 and upload_tries < config.MAX_UPLOAD_TRIES:
+        logger.info('Uploading files...')
+        upload_tries += 1
+
+        # Upload limit errors are fatal, so rclone doesn't keep burning the quota with its own retries.
+        # The upload slot is only held while rclone runs, so other uploads can use it during the backoff.
+        with scheduler.slot('upload', config.UPLOAD_SLOTS):
             process_result = subprocess.run(
-                f'{config.RCLONE_PATH} --config {config.RCLONE_CONFIG_PATH} copyto --update "{upload_base_dir}" '
-                f'"GDrive:{gdrive_dir}"', shell=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                check=False)
-
-            # Check results.
-            return_code = process_result.returncode
-            if return_code != 0:
-                logger.error(
-                    f'Bad return code ({return_code}) for file: {cloud_file}. Output:\n{process_result.stdout}')
-
-                if upload_tries < config.MAX_UPLOAD_TRIES:
-                    logger.info('Trying again!')
-                else:
-                    logger.error('Max retries with no success! Skipping...')
-        # If everything went smoothly, add the file name to the original names log.
+                f'{config.RCLONE_PATH} --config {config.RCLONE_CONFIG_PATH} copy --update {filter_arguments}'
+                f'--transfers {config.UPLOAD_TRANSFERS} --drive-stop-on-upload-limit --use-json-log --verbose '
+                f'"{upload_base_dir}" "{remote_path}"', shell=True, text=True, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, check=False)
+
+        # Check results.
+        return_code = process_result.returncode
         if return_code == 0:
-            upload_succeeded = True
-            logger.info('Upload succeeded! Deleting original file...')
-            if not is_subtitles:
-                open(config.ORIGINAL_NAMES_LOG, 'a', encoding='UTF-8').write(file_path + '\n')
+            return return_code, {}, None
+        failed_objects, error_class = _parse_errors(process_result.stdout)
+        logger.error(f'Bad return code ({return_code}) for {len(failed_objects)} files ({error_class} error). '
+                     f'Output:\n{process_result.stdout}')
+        if error_class in (QUOTA_EXHAUSTED, FATAL):
+            logger.error('Trying again would not help! Skipping...')
+            break
+        if upload_tries < config.MAX_UPLOAD_TRIES:
+            delay = _get_backoff_delay(error_class, upload_tries)
+            logger.info(f'Trying again in {delay:.0f} seconds!')
+            metrics.add('upload', retries=1)
+            time.sleep(delay)
         else:
-            upload_succeeded = False
-            # Reverse everything.
-            logger.info('Upload failed! Reversing all changes...')
-            shutil.move(final_file_path, original_dir)
-            os.rename(os.path.join(original_dir, cloud_file), file_path)
-        # Unmount ENCFS directory.
-        if config.SHOULD_ENCRYPT:
-            subprocess.call('{} -u "{}"'.format(config.FUSERMOUNT_PATH, plain_base_dir), shell=True)
-        # Delete all temporary directories.
-        shutil.rmtree(base_dir)
-        return upload_succeeded
+            logger.error('Max retries with no success! Skipping...')
+    return return_code, failed_objects, error_class
+
+
+def _defer_upload(file_path, cloud_dir, cloud_file, content_fingerprint, original_path):
+    """
+    Move the given file to the deferred files directory, and queue it for uploading after the quota window.
+
+    :param file_path: The file path.
+    :param cloud_dir: The cloud dir of the file.
+    :param cloud_file: The cloud file name.
+    :param content_fingerprint: The file content fingerprint, if known.
+    :param original_path: The original file path.
+    """
+    deferred_root = os.path.join(config.DATA_PATH, config.DEFERRED_FILES_DIR_NAME)
+    deferred_path = file_path
+    # Files that were already deferred just wait for the next window.
+    if not file_path.startswith(os.path.join(deferred_root, '')):
+        os.makedirs(deferred_root, exist_ok=True)
+        deferred_path = os.path.join(tempfile.mkdtemp(dir=deferred_root), os.path.basename(file_path))
+        transfer.move(file_path, deferred_path)
+    deferred.add_upload(deferred_path, original_path, os.path.join(cloud_dir, cloud_file), content_fingerprint,
+                        time.time() + config.UPLOAD_QUOTA_WINDOW)
+
+
+def upload_files(file_paths, missing_languages=None):
+    """
+    Upload the given files to their proper Google Drive directories.
+    All files are staged into a single tree, encrypted once and uploaded by a single rclone process.
+
+    :param file_paths: The files to upload.
+    :param missing_languages: A dict mapping videos to their missing subtitles languages, which are added to the
+                              subtitles backlog once the videos are uploaded, or None.
+    :return: A dict mapping each file path to True if it was uploaded successfully, and False otherwise.
+    """
+    missing_languages = missing_languages or {}
+    if config.SHOULD_ENCRYPT and config.ENCRYPTION_BACKEND not in ENCRYPTION_BACKENDS:
+        raise Exception('Unknown encryption backend: {}'.format(config.ENCRYPTION_BACKEND))
+    results = {file_path: False for file_path in file_paths}
+    items = []
+    cloud_paths = set()
+    fingerprints = {}
+    for file_path in results:
+        logger.info('Uploading file: {}'.format(file_path))
+        if not os.path.exists(file_path):
+            logger.warning('File {} no longer exists. Skipping...'.format(file_path))
+            continue
+        cloud_path_info = _get_cloud_path(file_path)
+        if not cloud_path_info:
+            continue
+        cloud_dir, cloud_file, _ = cloud_path_info
+        cloud_path = os.path.join(cloud_dir, cloud_file)
+        if cloud_path in cloud_paths:
+            logger.info('Cloud path {} is already taken by another file. Skipping...'.format(cloud_path))
+            continue
+        # Skip content that was already uploaded (re-seeds, identical repacks, etc.).
+        if history.is_enabled():
+            fingerprints[file_path] = fingerprint.get_content_fingerprint(file_path)
+            previous_upload = history.find_upload(fingerprint=fingerprints[file_path]) \
+                if config.SHOULD_SKIP_DUPLICATE_UPLOADS else None
+            # The local file may be the only copy left, so the remote copy is checked before it is deleted.
+            if previous_upload and _has_remote_copy(previous_upload):
+                logger.info('Identical content was already uploaded to {} (from {}). Deleting duplicate...'.format(
+                    previous_upload[1], previous_upload[0]))
+                history.add_upload(file_path, *previous_upload[1:3], os.path.getsize(file_path), *previous_upload[4:])
+                if os.path.splitext(file_path)[1] not in config.SUBTITLES_EXTENSIONS:
+                    _log_original_name(file_path)
+                os.remove(file_path)
+                results[file_path] = True
+                continue
+            if previous_upload:
+                logger.info('Identical content was uploaded to {} (from {}), but the remote no longer has it. '
+                            'Uploading...'.format(previous_upload[1], previous_upload[0]))
+        logger.info('Cloud path: {}'.format(cloud_path))
+        cloud_paths.add(cloud_path)
+        items.append((file_path, cloud_dir, cloud_file))
+    if not items:
+        return results
+    # The files are gone after the upload, so the backlog videos are fingerprinted first.
+    backlog_fingerprints = {file_path: (fingerprint.get_content_fingerprint(file_path),
+                                        fingerprint.get_provider_hashes(file_path))
+                            for file_path, _, _ in items if missing_languages.get(file_path)}
+    upload_results, _ = _upload_items(items, fingerprints)
+    results.update(upload_results)
+    for file_path, cloud_dir, cloud_file in items:
+        if results[file_path] and file_path in backlog_fingerprints:
+            backlog.add_video(os.path.join(cloud_dir, cloud_file), os.path.basename(file_path),
+                              *backlog_fingerprints[file_path], missing_languages[file_path])
+    return results
+
+
+def upload_subtitles(subtitles):
+    """
+    Upload subtitles next to already uploaded videos.
+    Subtitles are named after their video cloud path, the way upload_files names the subtitles of a torrent.
+
+    :param subtitles: A dict mapping each video cloud path to its subtitles files (named <name>.<language>.srt).
+    :return: A dict mapping each subtitles path to True if it was uploaded successfully, and False otherwise.
+    """
+    items = []
+    for video_cloud_path, subtitles_paths in subtitles.items():
+        cloud_dir, video_cloud_file = os.path.split(video_cloud_path)
+        for subtitles_path in subtitles_paths:
+            file_name, file_extension = os.path.splitext(subtitles_path)
+            language_extension = os.path.splitext(file_name)[1]
+            if language_extension not in config.LANGUAGE_EXTENSIONS:
+                language_extension = config.DEFAULT_LANGUAGE_EXTENSION
+            cloud_file = os.path.splitext(video_cloud_file)[0] + language_extension + file_extension
+            logger.info('Uploading subtitles {} to: {}'.format(subtitles_path, os.path.join(cloud_dir, cloud_file)))
+            items.append((subtitles_path, cloud_dir, cloud_file))
+    if not items:
+        return {}
+    return _upload_items(items, {})[0]
+
+
+def _upload_items(items, fingerprints, original_paths=None):
+    """
+    Upload the given files to their cloud paths.
+    All files are staged into a single tree, encrypted once and uploaded by a single rclone process.
+    Files that hit the upload quota are deferred (if enabled), and count as handled.
+
+    :param items: A list of tuples of format (file_path, cloud_dir, cloud_file).
+    :param fingerprints: A dict mapping file paths to their content fingerprints (if known).
+    :param original_paths: A dict mapping file paths to their original paths (if they were moved), or None.
+    :return: A tuple of format (results, deferred_paths), where results maps each file path to True if it was
+             uploaded (or deferred) successfully, and False otherwise.
+    """
+    global _quota_exhausted_until
+    original_paths = original_paths or {}
+    results = {file_path: False for file_path, _, _ in items}
+    deferred_paths = set()
+    # Don't even try while the upload quota is known to be exhausted.
+    if deferred.is_enabled() and time.time() < _quota_exhausted_until:
+        for file_path, cloud_dir, cloud_file in items:
+            _defer_upload(file_path, cloud_dir, cloud_file, fingerprints.get(file_path),
+                          original_paths.get(file_path, file_path))
+            results[file_path] = True
+            deferred_paths.add(file_path)
+        return results, deferred_paths
+
+    # Create a temporary random cloud dir structure (next to the files, so moving them is cheap).
+    original_dir = os.path.commonpath([os.path.dirname(file_path) for file_path, _, _ in items])
+    random_dir_name = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
+    base_dir = os.path.join(original_dir, random_dir_name)
+    plain_base_dir = os.path.join(base_dir, config.CLOUD_PLAIN_PATH)
+    os.makedirs(plain_base_dir)
+    journal.add_staging_dir(base_dir)
+    # Use the plain directory when uploading, unless encryption is enabled.
+    upload_base_dir = plain_base_dir
+    # Set up encryption if needed.
+    if _uses_encfs():
+        encrypted_base_dir = os.path.join(base_dir, config.CLOUD_ENCRYPTED_PATH)
+        encryption_successful = _encrypt(encrypted_base_dir, plain_base_dir)
+        if not encryption_successful:
+            # Delete directories and stop.
+            shutil.rmtree(base_dir)
+            journal.remove_staging_dir(base_dir)
+            return results, deferred_paths
+        # Upload the encrypted directory tree instead of the plain one.
+        upload_base_dir = encrypted_base_dir
+    if config.SHOULD_ENCRYPT and config.ENCRYPTION_BACKEND == 'crypt':
+        # The crypt remote (wrapping GDrive:{CLOUD_ENCRYPTED_PATH}) encrypts the plain tree while uploading it.
+        remote_path = f'{config.RCLONE_CRYPT_REMOTE}:'
     else:
-        logger.info('Couldn\'t guess file info. Skipping...')
-        return False
+        remote_path = 'GDrive:{}'.format(upload_base_dir.split(base_dir)[1].strip(os.path.sep))
+    upload_paths = _stage_files(items, base_dir, plain_base_dir, upload_base_dir)
+
+    # Skip files the remote already has, without asking the remote about each of them.
+    uploaded_paths = set()
+    if all(upload_paths.values()) and remote.refresh(remote_path):
+        uploaded_paths = {upload_path for upload_path in upload_paths.values()
+                          if _is_already_uploaded(remote_path, upload_base_dir, upload_path)}
+        if uploaded_paths:
+            # The listing may be hours old, and the local copies are deleted, so the remote is asked once more.
+            remote_files = _list_uploaded_files(remote_path, sorted(uploaded_paths)) or {}
+            uploaded_paths = {upload_path for upload_path in uploaded_paths
+                              if remote_files.get(upload_path, (None,))[0] ==
+                              os.path.getsize(os.path.join(upload_base_dir, upload_path))}
+        for upload_path in sorted(uploaded_paths):
+            logger.info('{} is already on the remote. Skipping upload...'.format(upload_path))
+        metrics.add('remote', cache_hits=len(uploaded_paths), cache_misses=len(upload_paths) - len(uploaded_paths))
+        pending_paths = sorted(set(upload_paths.values()) - uploaded_paths)
+        # Upload!
+        return_code, failed_objects, error_class = _upload_directory(upload_base_dir, remote_path, pending_paths) \
+            if pending_paths else (0, {}, None)
+    else:
+        # Upload!
+        return_code, failed_objects, error_class = _upload_directory(upload_base_dir, remote_path)
+    if error_class == QUOTA_EXHAUSTED:
+        _quota_exhausted_until = time.time() + config.UPLOAD_QUOTA_WINDOW
+    # Without per-file errors (or once rclone stopped on the upload quota), a bad return code means nothing
+    # can be trusted.
+    is_trusted = failed_objects and error_class != QUOTA_EXHAUSTED
+    # Files skipped thanks to the remote cache were already compared with the remote.
+    new_upload_paths = [upload_path for upload_path in upload_paths.values()
+                        if upload_path and upload_path not in uploaded_paths and
+                        (return_code == 0 or (is_trusted and upload_path not in failed_objects))]
+    mismatched_paths = set()
+    if config.SHOULD_VERIFY_UPLOADS and new_upload_paths:
+        mismatched_paths = _verify_uploads(upload_base_dir, remote_path, new_upload_paths)
+    new_remote_files = []
+    for file_path, cloud_dir, cloud_file in items:
+        upload_path = upload_paths[file_path]
+        if upload_path not in mismatched_paths and (return_code == 0 or upload_path in uploaded_paths or
+                                                    (is_trusted and upload_path and upload_path not in failed_objects)):
+            results[file_path] = True
+            logger.info('Upload of {} succeeded! Deleting original file...'.format(cloud_file))
+            upload_size = None
+            if upload_path:
+                file_stat = os.stat(os.path.join(upload_base_dir, upload_path))
+                upload_size = file_stat.st_size
+                if upload_path not in uploaded_paths:
+                    new_remote_files.append((upload_path, file_stat.st_size, file_stat.st_mtime))
+            journal.set_file_stage(file_path, journal.FILE_UPLOADED, staging_dir=base_dir,
+                                   location=os.path.join(plain_base_dir, cloud_dir, cloud_file))
+            original_path = original_paths.get(file_path, file_path)
+            if file_path in fingerprints:
+                history.add_upload(original_path, os.path.join(cloud_dir, cloud_file), fingerprints[file_path],
+                                   int(fingerprints[file_path].split(':', 1)[0]), remote_path if upload_path else None,
+                                   upload_path, upload_size)
+            # If everything went smoothly, add the file name to the original names log.
+            if os.path.splitext(cloud_file)[1] not in config.SUBTITLES_EXTENSIONS:
+                _log_original_name(original_path)
+        else:
+            # Reverse everything.
+            logger.info('Upload of {} failed! Reversing all changes...'.format(cloud_file))
+            transfer.move(os.path.join(plain_base_dir, cloud_dir, cloud_file), file_path)
+            journal.remove_file(file_path)
+            # Files without their own error failed for the same reason as the whole run.
+            if deferred.is_enabled() and failed_objects.get(upload_path, error_class) == QUOTA_EXHAUSTED:
+                _defer_upload(file_path, cloud_dir, cloud_file, fingerprints.get(file_path),
+                              original_paths.get(file_path, file_path))
+                results[file_path] = True
+                deferred_paths.add(file_path)
+    # Keep the remote listing cache fresh, without listing the remote again.
+    remote.add_files(remote_path, new_remote_files)
+    # Unmount ENCFS directory.
+    if _uses_encfs():
+        _unmount(plain_base_dir)
+    # Delete all temporary directories.
+    shutil.rmtree(base_dir)
+    journal.remove_staging_dir(base_dir)
+    logger.debug('Cache statistics: {}'.format(get_statistics()))
+    return results, deferred_paths
+
+
+def drain_deferred_uploads():
+    """
+    Upload the deferred files whose quota window has passed (files that hit the quota again are deferred again).
+
+    :return: The number of uploaded files.
+    """
+    deferred_root = os.path.join(config.DATA_PATH, config.DEFERRED_FILES_DIR_NAME)
+    # Staging directories of an interrupted drain hold deferred files.
+    reclaim_staging_dirs(deferred_root)
+    items = []
+    fingerprints = {}
+    original_paths = {}
+    for file_path, original_path, cloud_path, content_fingerprint in deferred.get_due_uploads():
+        if not os.path.isfile(file_path):
+            logger.warning('Deferred file {} ({}) is gone. Dropping it...'.format(file_path, original_path))
+            deferred.remove_upload(file_path)
+            continue
+        items.append((file_path, os.path.dirname(cloud_path), os.path.basename(cloud_path)))
+        if content_fingerprint:
+            fingerprints[file_path] = content_fingerprint
+        original_paths[file_path] = original_path
+    if not items:
+        return 0
+    logger.info('Uploading {} deferred files...'.format(len(items)))
+    results, deferred_paths = _upload_items(items, fingerprints, original_paths)
+    uploaded_files = 0
+    for file_path, is_uploaded in results.items():
+        if is_uploaded and file_path not in deferred_paths:
+            uploaded_files += 1
+            deferred.remove_upload(file_path)
+            journal.remove_file(file_path)
+            # Each deferred file has a directory of its own.
+            shutil.rmtree(os.path.dirname(file_path), ignore_errors=True)
+    return uploaded_files
+
+
+def upload_file(file_path):
+    """
+    Upload the given file to its proper Google Drive directory.
+
+    :param: file_path: The file to upload.
+    :return: True if the file was upload successfully, and False otherwise.
+    """
+    return upload_files([file_path])[file_path]
@@ -1,9 +1,16 @@
+import contextlib
+import functools
 import os
+import sqlite3
 
+from . import config
 
+
+@functools.lru_cache(maxsize=None)
 def find_executable(filename):
     """
     Searches for a file in paths exported to the PATH environmental variable.
+    Results are memoized, so the search runs once per process for each executable.
 
     :param filename: The file to search for.
     :return: The full executable path.
@@ -12,9 +19,43 @@ def find_executable(filename):
     if os.name == 'nt':
         filename += '.exe'
     for directory in os.getenv('PATH').split(os.pathsep):
-        # Ensure the directory in the path is a real directory.
-        if os.path.exists(directory):
-            files = os.listdir(directory)
-            if filename in files:
-                return os.path.join(directory, filename)
+        executable_path = os.path.join(directory, filename)
+        # A single stat per directory, instead of listing its entire content.
+        if os.path.isfile(executable_path):
+            return executable_path
     raise Exception('{} not found or is not in system PATH'.format(filename))
+
+
+def is_wanted_file(file_path):
+    """
+    Check whether the given file passes the extensions white list and the names black list.
+
+    :param file_path: The file path to check.
+    :return: True if the file is wanted, and False otherwise.
+    """
+    file_name, file_extension = os.path.splitext(file_path)
+    if file_extension.lower() not in config.EXTENSIONS_WHITE_LIST:
+        return False
+    return not any(black_list_word in file_name.lower() for black_list_word in config.NAMES_BLACK_LIST)
+
+
+@contextlib.contextmanager
+def open_database(database_path):
+    """
+    Open a connection to a local SQLite database, creating its directory if needed.
+    WAL mode is used, so several processes can safely share the database.
+    The transaction is committed (or rolled back on errors) and the connection is closed on exit.
+
+    :param database_path: The database file path.
+    :return: The SQLite connection.
+    """
+    database_dir = os.path.dirname(database_path)
+    if database_dir:
+        os.makedirs(database_dir, exist_ok=True)
+    connection = sqlite3.connect(database_path, timeout=30)
+    try:
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            yield connection
+    finally:
+        connection.close()
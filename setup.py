@@ -4,7 +4,7 @@ from setuptools import setup, find_packages
 setup(
     name='pyexpander',
     version='0.1dev',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     long_description=open('README.md').read(),
     install_requires=['logbook', 'guessit', 'subliminal', 'babelfish', 'showsformatter'],
     entry_points={
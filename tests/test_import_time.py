@@ -0,0 +1,49 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Heavy dependencies, which are only imported when their stage actually runs.
+HEAVY_MODULES = ['babelfish', 'guessit', 'subliminal']
+# A generous import time limit (in seconds): the light modules take a fraction of it, and subliminal alone takes more.
+IMPORT_TIME_LIMIT = 0.5
+# Imports the module in the child interpreter, and prints the import time and the imported modules.
+IMPORT_SCRIPT = '''
+import json, sys, time
+start_time = time.perf_counter()
+import {}
+print(json.dumps([time.perf_counter() - start_time, list(sys.modules)]))
+'''
+
+
+def _import_module(module_name):
+    """
+    Import the given module in a fresh interpreter.
+
+    :param module_name: The module to import.
+    :return: A tuple of format (import time in seconds, set of imported top level module names).
+    """
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT.format(module_name)],
+                                     env=dict(os.environ, PYTHONPATH=REPOSITORY_PATH), cwd=REPOSITORY_PATH)
+    import_time, module_names = json.loads(output.decode('UTF-8'))
+    return import_time, {name.split('.')[0] for name in module_names}
+
+
+class ImportTimeTest(unittest.TestCase):
+    def _assert_is_light(self, module_name):
+        import_time, module_names = _import_module(module_name)
+        self.assertFalse(set(HEAVY_MODULES) & module_names)
+        self.assertLess(import_time, IMPORT_TIME_LIMIT)
+
+    def test_config_is_light(self):
+        self._assert_is_light('pyexpander.config')
+
+    def test_entry_point_is_light(self):
+        # Torrents that need no processing (and torrents sent to the daemon) never pay for the heavy imports.
+        self._assert_is_light('pyexpander.torrent_handler')
+
+
+if __name__ == '__main__':
+    unittest.main()